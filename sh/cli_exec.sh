@@ -0,0 +1,31 @@
+# Check that each module imports within its time budget (IMPORT_TIME_BUDGET). 
+python -m source.modules.benchmark imports 
+
+# Benchmark the grouped rolling aggregations against pandas. 
+python -m source.modules.benchmark rolling 
+
+# Benchmark the fundamental scoring of all the tickers at once against each ticker and metric. 
+python -m source.modules.benchmark scoring 
+
+# Benchmark the extra fundamentals computed in one pass against column by column. 
+python -m source.modules.benchmark fundamental 
+
+# Check the quality ranks updated in steps against a single build, with missing and infinite values. 
+python -m source.modules.benchmark quality 
+
+# Benchmark the index membership lookups against a merge on the intervals. 
+python -m source.modules.benchmark membership 
+
+# Check the quarterly Compustat statements loaded from a SQLite stand-in of (comp.fundq). 
+python -m source.modules.benchmark compustat 
+
+# Run the pipeline (fetch, compile, features, train, backtest). Stages with unchanged inputs are skipped. 
+# Pass stage names to run only them and their upstream stages, e.g. (features), or (--force) to rerun. 
+python -m source.modules.pipeline 
+
+# Append the features of the new bars up to the date to the last build, without rebuilding the history. 
+python -m source.modules.pipeline --refresh 2022-03-31 
+
+# Record the tracing spans of a run, then export them to a Chrome trace and summarise them. 
+python -m source.modules.pipeline --trace 
+python -m source.modules.tracer 
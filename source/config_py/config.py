@@ -19,6 +19,7 @@ DIR_DATASET_SENTIMENT = f"{DIR_DATASET}/sentiment"
 DIR_DATASET_UTIL = f"{DIR_DATASET}/util" 
 DIR_DATASET_WRDS_RAVENPACK = f"{DIR_DATASET}/wrds_ravenpack" 
 DIR_DATASET_WRDS_COMPUSTAT = f"{DIR_DATASET}/wrds_compustat" 
+DIR_DATASET_CACHE = f"{DIR_DATASET}/cache" 
 
 # Directory path for saving and loading models. 
 DIR_MLMODEL = "model" 
@@ -77,6 +78,15 @@ TICKER_DATE_COLLECT = "1998-12-01", "2022-02-28"
 # assign them to (TICKER_TO_COLLECT) variable. 
 TICKER_FROM_SNP = True 
 
+# Snapshot of the S&P 500 membership over time (ticker, date_beg, date_end) in (DIR_DATASET_UTIL). 
+# Build it with (build_snp_membership), then load it with (IndexMembership.load). 
+SNP_MEMBERSHIP_FILENAME = "snp500_membership.csv" 
+
+# Membership snapshot in (DIR_DATASET_UTIL) to take the tickers of the pipeline from, all the 
+# members between the (TICKER_DATE_COLLECT) dates including those removed since, e.g. 
+# (SNP_MEMBERSHIP_FILENAME). None to take them from (TICKER_TO_COLLECT). 
+TICKER_MEMBERSHIP = None 
+
 # Uncomment the any of the feature below if you want to use it. 
 # Define the list of tickers we are interested to investigate on. 
 TICKER_TO_COLLECT = set([
@@ -110,8 +120,6 @@ TICKER_TO_COLLECT = set([
 TICKER_TO_EXCLUDE = set([
 	# # Can't get the technical indicator data for this ticker. 
 	"ANTM", 
-	# # Inconsistent quarterly reporting date. 
-	"AAP", "NLOK", "PKI", "CI", "MPWR", 
 	# # Download issue. 
 	"DD", "LIN", "VICI", 
 ])
@@ -141,6 +149,182 @@ YIELD_CURVE_INVERSION = [
 
 ]
 
+# -------------------------------------------------------
+# Define the API request budget 
+# -------------------------------------------------------
+
+# Check the cost for the API request here: https://www.alphavantage.co/premium/ 
+# Free version offers only 5 API calls per minute. Change it based on your plan. 
+ALPHAV_CALLS_PER_MINUTE = 5 
+
+# Number of calls that can be sent in a burst before the rate applies. 
+ALPHAV_CALLS_BURST = 1 
+
+# Number of tickers to fetch concurrently. 
+ALPHAV_MAX_WORKERS = 4 
+
+# Max number of concurrent requests for each Alpha Vantage endpoint. 
+ALPHAV_ENDPOINT_CONCURRENCY = {
+	"overview": 1, 
+	"fundamental": 2, 
+	"techind": 2, 
+}
+
+# Retry with exponential backoff (seconds) when the request is throttled. 
+FETCH_MAX_RETRIES = 5 
+FETCH_BACKOFF_RANGE = (2, 120) 
+
+# -------------------------------------------------------
+# Define the response cache for remote data sources 
+# -------------------------------------------------------
+
+# Whether to cache the responses from (yfinance), (Alpha Vantage), (FRED) and (WRDS). 
+# Assign (False) to always call the APIs. 
+CACHE_ENABLED = True 
+
+# Time to live (seconds) of the cached responses for each data source. 
+CACHE_TTL = {
+	"yfinance": 60 * 60 * 24, 
+	"alphavantage": 60 * 60 * 24 * 7, 
+	"fred": 60 * 60 * 24, 
+	"wrds": 60 * 60 * 24 * 30, 
+}
+
+# Max size (bytes) of the cache. The least recently used responses are evicted first. 
+CACHE_MAX_BYTES = 5 * 1024 ** 3 
+
+# -------------------------------------------------------
+# Define the WRDS extraction 
+# -------------------------------------------------------
+
+# Number of tickers in the (IN) list of each batched query. 
+WRDS_BATCH_SIZE = 100 
+
+# Number of rows to stream from the server-side cursor at a time. 
+WRDS_CHUNK_SIZE = 100000 
+
+# Columns to extract from RavenPack. Only these columns are sent over the network. 
+WRDS_RP_COLUMNS = [
+	# # Information. 
+	"company", "rpna_date_utc", "timestamp_utc", 
+	"news_type", "source", "position_name", 
+	# # Categorical features. 
+	"topic", "group", "type", "sub_type", "category", 
+	# # Numerical features. 
+	"relevance", "ess", "aes", "aev", "ens", "ens_similarity_gap", 
+	"css", "nip", "peq", "bee", "bmq", "bam", "bca", "ber", "anl_chg", "mcq", 
+]
+
+# Rows of the standard, consolidated and domestic statements of the industrial companies. 
+# The other formats (e.g. the summary restatements) repeat the same periods. 
+COMPUSTAT_FILTERS = {"indfmt": "INDL", "datafmt": "STD", "popsrc": "D", "consol": "C"} 
+
+# Compustat items of the Alpha Vantage statements (FINANCIAL_KEEP_FEATURES), for the annual 
+# (comp.funda) and the quarterly (comp.fundq) tables. 
+# –   The items are in millions, and converted to units as Alpha Vantage reports them. 
+# –   An item can be combined from others, as in (FINANCIAL_COMPUTE_COMBINATION). 
+# –   The (ytd) items are reported from the start of the fiscal year, and are converted 
+#     to the amount of each quarter. 
+COMPUSTAT_TO_ALPHAV = {
+	"annual": {
+		"table": "comp.funda", 
+		"ytd": [], 
+		"items": {
+			# # Income statement. 
+			"totalRevenue": "revt", 
+			"researchAndDevelopment": "xrd", 
+			"capitalExpenditures": "capx", 
+			"depreciationAndAmortization": "dp", 
+			"grossProfit": "gp", 
+			"interestExpense": "xint", 
+			"ebit": "ebit", 
+			"incomeBeforeTax": "pi", 
+			"netIncomeFromContinuingOperations": "ib", 
+			"netIncome_x": "ni", 
+			# # Balance sheet. 
+			"inventory": "invt", 
+			"totalAssets": "at", 
+			"totalCurrentAssets": "act", 
+			"totalCurrentLiabilities": "lct", 
+			"totalLiabilities": "lt", 
+			"longTermDebtNoncurrent": "dltt", 
+			"totalShareholderEquity": "ceq", 
+			"commonStockSharesOutstanding": "csho", 
+			# # Cash flow. 
+			"operatingCashflow": "oancf", 
+		}, 
+	}, 
+	"quarter": {
+		"table": "comp.fundq", 
+		"ytd": ["capxy", "oancfy"], 
+		"items": {
+			# # Income statement. 
+			"totalRevenue": "revtq", 
+			"researchAndDevelopment": "xrdq", 
+			"capitalExpenditures": "capxy", 
+			"depreciationAndAmortization": "dpq", 
+			"grossProfit": {"add": ["revtq"], "sub": ["cogsq"]}, 
+			"interestExpense": "xintq", 
+			"ebit": "oiadpq", 
+			"incomeBeforeTax": "piq", 
+			"netIncomeFromContinuingOperations": "ibq", 
+			"netIncome_x": "niq", 
+			# # Balance sheet. 
+			"inventory": "invtq", 
+			"totalAssets": "atq", 
+			"totalCurrentAssets": "actq", 
+			"totalCurrentLiabilities": "lctq", 
+			"totalLiabilities": "ltq", 
+			"longTermDebtNoncurrent": "dlttq", 
+			"totalShareholderEquity": "ceqq", 
+			"commonStockSharesOutstanding": "cshoq", 
+			# # Cash flow. 
+			"operatingCashflow": "oancfy", 
+		}, 
+	}, 
+}
+
+# Categories of the RavenPack events. Events without any category are not 
+# classified, so they are skipped when aggregating the daily features. 
+RP_EVENT_CATCOLS = ["topic", "group", "type", "sub_type", "category"] 
+
+# Scores of the RavenPack events to aggregate to daily features. 
+RP_EVENT_NUMCOLS = [
+	"relevance", "ess", "aes", "aev", "ens", "ens_similarity_gap", 
+	"css", "nip", "peq", "bee", "bmq", "bam", "bca", "ber", "anl_chg", "mcq", 
+]
+
+# Weight of each event (0 to 100) in the weighted mean of the scores. 
+RP_EVENT_WEIGHTCOL = "relevance" 
+
+# Number of events to read at a time when aggregating. 
+RP_EVENT_CHUNK_SIZE = 200000 
+
+# -------------------------------------------------------
+# Define the model artifact store 
+# -------------------------------------------------------
+
+# Compression of the saved model artifacts (zstd, lz4, gzip or None). 
+ARTIFACT_COMPRESSION = "zstd" 
+
+# -------------------------------------------------------
+# Define the incremental refresh 
+# -------------------------------------------------------
+
+# File name of the refresh state (tail bars and clip bounds of each ticker). 
+REFRESH_STATE_FILENAME = "refresh_state.pickle" 
+
+# Extra bars kept in the tail beyond the rolling window and the lags. Covers 
+# the lookback of the candlestick patterns and other short-window steps. 
+REFRESH_TAIL_MARGIN = 21 
+
+# Relative tolerance when comparing the refetched bars with the tail. A larger 
+# difference means the prices were adjusted for a split or dividend since. 
+REFRESH_ADJUST_RTOL = 1e-4 
+
+# Relative tolerance when comparing the refreshed features with a full rebuild. 
+REFRESH_CHECK_RTOL = 1e-6 
+
 # -------------------------------------------------------
 # Define the economic data to collect 
 # -------------------------------------------------------
@@ -301,6 +485,10 @@ TECHNIND_FEATURES = {
 	# )
 }
 
+# Source of the technical indicators. Either (talib), computed locally from the daily bars 
+# with (compute_techind_talib), or (alphavantage), fetched for each ticker with (get_techind_alphav). 
+TECHNIND_SOURCE = "talib" 
+
 # -------------------------------------------------------
 # Define candlesticks 
 # -------------------------------------------------------
@@ -412,6 +600,10 @@ FINANCIAL_KEEP_FEATURES = ["ticker", "fiscalDateEnding"] \
 	+ FINANCIAL_BALANCE_SHEET \
 	+ FINANCIAL_CASHFLOW
 
+# Source of the financial statements. Either (alphavantage), fetched for each ticker, or 
+# (compustat), extracted in bulk from WRDS and mapped with (COMPUSTAT_TO_ALPHAV). 
+FUNDAMENTAL_SOURCE = "alphavantage" 
+
 # For computing change or growth rate. 
 # Example: "new_feature_name": "feature_name" 
 FINANCIAL_COMPUTE_CHANGE = {
@@ -551,6 +743,23 @@ FINANCIAL_EVAL_QUALITY = {
 	}, 
 }
 
+# Days after the fiscal period end before the report is assumed to be public. 
+# The SEC deadline is 40 to 45 days for a 10-Q and 60 to 90 days for a 10-K. 
+FINANCIAL_PUBLICATION_LAG = "45D" 
+
+# Max days a report stays attached to the daily rows once it is public. Older 
+# reports are left missing rather than carried forward, e.g. for delisted tickers. 
+FINANCIAL_REPORT_TOLERANCE = "200D" 
+
+# Dates to rank the fundamental quality as of, as a period frequency ("Q" for the 
+# quarter ends, "M" for the month ends), with only the reports public by then. 
+QUALITY_RANK_FREQ = "Q" 
+
+# File names of the point-in-time quality ranks, and of the running aggregates of 
+# each ticker that the ranks are updated from. 
+QUALITY_HISTORY_FILENAME = "quality_rank_history.parquet" 
+QUALITY_STATE_FILENAME = "quality_rank_state.pickle" 
+
 # -------------------------------------------------------
 # Define parameters 
 # -------------------------------------------------------
@@ -689,3 +898,101 @@ EXPERIMENT_MODEL_CL = {
 		"bayes_opt": True, 
 	}
 }
+
+# -------------------------------------------------------
+# Define the feature dtypes 
+# -------------------------------------------------------
+
+# Dtypes of the consolidated feature panel. Each column takes the dtype of the 
+# first pattern its name matches, and keeps its dtype if none matches or the 
+# dtype is (None). The prices, the volumes and the targets (return_c2c_lag1, 
+# tscore_c2c_lag1) are not matched and stay (float64) or (int64). 
+# A float dtype only applies to float columns, so the merged dates are kept. 
+FEATURE_DTYPE_SCHEMA = {
+	"ticker": "category", 
+	"date": "datetime64[ns]", 
+	"event_bits_*": None, 
+	"event_*": "int8", 
+	"candle_*": "int8", 
+	"*_autolag*": "float32", 
+	"vl_*": "float32", 
+	"vix_*": "float32", 
+	"econ_*": "float32", 
+	"rp_*": "float32", 
+	"techind_*": "float32", 
+}
+
+# -------------------------------------------------------
+# Define the pipeline 
+# -------------------------------------------------------
+
+# Directory of the stage records (key and outputs of the last successful run). 
+PIPELINE_STATE_DIR = f"{DIR_DATASET_CACHE}/pipeline" 
+
+# Number of stages to run at the same time. Only stages whose upstream stages 
+# are done are started, so the independent fetches run in parallel. 
+PIPELINE_MAX_WORKERS = 4 
+
+# Model training of the (train) stage. Same setup as the (build_ml_regression) notebook. 
+PIPELINE_TRAIN = {
+	"ticker": "AAPL", 
+	"targcol": "tscore_c2c_lag1", 
+	"year_beg": 2000, 
+	"train_size": .8, 
+	"n_splits": 10, 
+	"n_trials": 25, 
+	"scoring": "neg_root_mean_squared_error", 
+}
+
+# Backtest of the (backtest) stage. Same setup as the (backtesting_framework) notebook. 
+PIPELINE_BACKTEST = {
+	"tickers": ["AAPL", "AMZN", "MSFT", "JNJ", "LMT", "JPM", "GS"], 
+	"date_beg": "2000-03-31", 
+	"cash": 100000, 
+	"n_positions": 2, 
+	"min_positions": 1, 
+	"include_short": False, 
+	"topn": -1, 
+	# # Only trade the tickers on the dates they were members of the index, from the 
+	# # (SNP_MEMBERSHIP_FILENAME) snapshot, e.g. to avoid the survivorship bias. 
+	"membership": None, 
+}
+
+# -------------------------------------------------------
+# Define the tracing 
+# -------------------------------------------------------
+
+# Whether to record the tracing spans (wall and CPU time, peak memory, rows and bytes) 
+# of the processors, the file operations and the pipeline stages. Assign (True), or 
+# pass (--trace) to the pipeline. 
+TRACE_ENABLED = False 
+
+# Directory of the trace files. Each run writes a new (trace_YYYYmmdd_HHMMSS_pid.jsonl). 
+TRACE_DIR = f"{DIR_DATASET_CACHE}/trace" 
+
+# -------------------------------------------------------
+# Define the import time budget 
+# -------------------------------------------------------
+
+# Max seconds to import each module in a fresh interpreter. Batch jobs and workers import 
+# them on start, so heavy packages and API clients are imported on first use instead. 
+IMPORT_TIME_BUDGET = {
+	"source.modules.manage_files": 1.5, 
+	"source.modules.fetch_scheduler": 1.5, 
+	"source.modules.response_cache": 1.5, 
+	"source.modules.processor_ticker": 1.5, 
+	"source.modules.processor_technical": 1.5, 
+	"source.modules.processor_fundamental": 1.5, 
+	"source.modules.processor_fred": 1.5, 
+	"source.modules.processor_wrds": 1.5, 
+	"source.modules.processor_features": 1.5, 
+	"source.modules.processor_refresh": 1.5, 
+	"source.modules.pipeline": 1.5, 
+	"source.modules.tracer": 1.5, 
+	"source.modules.processor_membership": 1.5, 
+	"source.modules.processor_estim": 3, 
+	"source.modules.visualizer": 3, 
+}
+
+# Number of fresh interpreters to time each import with. The median is compared to the budget. 
+IMPORT_TIME_REPEAT = 3 
@@ -0,0 +1,417 @@
+# Python module. 
+import os, sys, time, subprocess, statistics 
+import numpy as np 
+import pandas as pd 
+from typing import Dict, List, Tuple 
+
+# Custom modules. 
+from source.modules.manage_files import ManageFiles 
+
+# Custom configs. 
+from source.config_py.config import IMPORT_TIME_BUDGET, IMPORT_TIME_REPEAT 
+
+
+
+# %% 
+def time_import(module:str, repeat:int=IMPORT_TIME_REPEAT) -> float: 
+    '''Time (import module) in fresh interpreters and return the median in seconds.'''
+
+    # Hide the API secrets so that any module reading them on import fails the check. 
+    env = {k: v for k, v in os.environ.items() if not k.endswith("_API_SECRET")} 
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)" 
+
+    timings = list() 
+    for _ in range(repeat): 
+        result = subprocess.run( 
+            [sys.executable, "-c", code], env=env, capture_output=True, text=True, 
+        ) 
+        if result.returncode != 0: 
+            raise ImportError(f"Failed to import ({module}).\n{result.stderr}") 
+        timings.append(float(result.stdout.strip().splitlines()[-1])) 
+
+    return statistics.median(timings) 
+
+
+
+# %% 
+def check_import_budget(budget:Dict[str,float]=IMPORT_TIME_BUDGET, repeat:int=IMPORT_TIME_REPEAT) -> pd.DataFrame: 
+    '''
+    Check that each module imports within its budget.
+
+    –   Each module is imported in a fresh interpreter from the project directory,
+        so the timing includes every package it pulls in.
+    –   Raise (AssertionError) listing the modules over budget.
+    '''
+
+    ManageFiles()._confirm_current_working_directory() 
+
+    ls_row = list() 
+    for module, seconds in budget.items(): 
+        elapsed = time_import(module, repeat=repeat) 
+        ls_row.append({"module": module, "seconds": elapsed, "budget": seconds, "within": elapsed <= seconds}) 
+        print(f"Imported ({module}) in ({elapsed:.3f}s) with budget ({seconds:.3f}s).") 
+
+    df_report = pd.DataFrame(ls_row) 
+
+    over = df_report.loc[~df_report["within"], "module"].to_list() 
+    assert not over, f"Modules over the import time budget ({', '.join(over)})." 
+
+    return df_report 
+
+
+
+# %% 
+def benchmark_rolling_agg( 
+    ngroups:int=500, 
+    nperiods:int=80, 
+    ncols:int=30, 
+    window:int=4, 
+    aggs:List[str]=["sum", "mean", "std", "min", "max"], 
+    repeat:int=3, 
+) -> pd.DataFrame: 
+    '''
+    Benchmark (rolling_agg_bygroup) against (groupby().rolling()) on a random quarterly panel.
+
+    –   The defaults mimic the quarterly income statements of the S&P 500 over 20 years.
+    –   Raise (AssertionError) if the results differ.
+    '''
+
+    from source.modules.processor_features import rolling_agg_bygroup 
+
+    # Random panel with missing values, and the rows of the groups interleaved. 
+    rng = np.random.default_rng(0) 
+    usecols = [f"col_{i}" for i in range(ncols)] 
+    df = pd.DataFrame(rng.normal(1e9, 1e8, (ngroups * nperiods, ncols)), columns=usecols) 
+    df[df > 1.2e9] = np.nan 
+    df.insert(0, "ticker", np.tile(np.arange(ngroups), nperiods)) 
+
+    ls_row = list() 
+    for agg in aggs: 
+        timings_engine, timings_pandas = list(), list() 
+        for _ in range(repeat): 
+            t = time.perf_counter() 
+            df_engine = rolling_agg_bygroup(df, groupby=["ticker"], window=window, usecols=usecols, aggs=[agg]) 
+            timings_engine.append(time.perf_counter() - t) 
+
+            t = time.perf_counter() 
+            df_pandas = getattr(df.groupby("ticker", sort=False)[usecols].rolling(window=window, min_periods=window), agg)() 
+            timings_pandas.append(time.perf_counter() - t) 
+
+        # Check that both give the same values on the same rows. 
+        df_pandas = df_pandas.reset_index(level=0, drop=True).reindex(df.index) 
+        assert np.allclose(df_engine.to_numpy(), df_pandas.to_numpy(), rtol=1e-8, equal_nan=True), f"Mismatch for ({agg})." 
+
+        engine, pandas = statistics.median(timings_engine), statistics.median(timings_pandas) 
+        ls_row.append({"agg": agg, "engine": engine, "pandas": pandas, "speedup": pandas / engine}) 
+        print(f"Rolling ({agg}) over ({len(df):,}) rows: ({engine:.3f}s) against ({pandas:.3f}s) in pandas.") 
+
+    return pd.DataFrame(ls_row) 
+
+
+
+# %% 
+def benchmark_score_fundamental(ntickers:int=500, nreports:int=20, repeat:int=3) -> pd.DataFrame: 
+    '''
+    Benchmark (rank_fundamental) scoring all the tickers at once against scoring
+    each ticker and metric with (score_fundamental), on a random annual panel.
+
+    –   The defaults mimic the annual reports of the S&P 500 over 20 years.
+    –   Raise (AssertionError) if the ranks differ.
+    '''
+
+    from source.modules.processor_fundamental import rank_fundamental, score_fundamental 
+    from source.config_py.config import FINANCIAL_EVAL_QUALITY 
+
+    # Random panel with missing and infinite values, e.g. the growth from zero. 
+    rng = np.random.default_rng(0) 
+    usecols = list(FINANCIAL_EVAL_QUALITY.keys()) 
+    df = pd.DataFrame(rng.normal(.3, .6, (ntickers * nreports, len(usecols))), columns=usecols) 
+    df[df < -.5] = np.nan 
+    df.iloc[::97, 0] = np.inf 
+    df.insert(0, "ticker", np.repeat([f"T{i:04d}" for i in range(ntickers)], nreports)) 
+
+    # Wrap the function so that it is applied to each group. 
+    def score_each(series:pd.Series, eval_method:dict) -> float: 
+        return score_fundamental(series, eval_method) 
+
+    timings_engine, timings_pandas = list(), list() 
+    for _ in range(repeat): 
+        t = time.perf_counter() 
+        df_engine = rank_fundamental(None, df) 
+        timings_engine.append(time.perf_counter() - t) 
+
+        t = time.perf_counter() 
+        df_pandas = rank_fundamental(score_each, df) 
+        timings_pandas.append(time.perf_counter() - t) 
+
+    pd.testing.assert_frame_equal(df_engine, df_pandas) 
+
+    engine, pandas = statistics.median(timings_engine), statistics.median(timings_pandas) 
+    print(f"Scored ({ntickers:,}) tickers: ({engine:.3f}s) against ({pandas:.3f}s) for each ticker and metric.") 
+
+    return pd.DataFrame([{"engine": engine, "pandas": pandas, "speedup": pandas / engine}]) 
+
+
+
+# %% 
+def benchmark_extra_fundamental(ntickers:int=500, nquarters:int=80, repeat:int=3) -> pd.DataFrame: 
+    '''
+    Benchmark (compute_extra_fundamental) against inserting each new column in turn
+    with a groupby for each growth rate, on a random quarterly panel.
+
+    –   The defaults mimic the quarterly reports of the S&P 500 over 20 years.
+    –   Raise (AssertionError) if the results differ.
+    '''
+
+    from source.modules.processor_fundamental import compute_extra_fundamental 
+    from source.config_py.config import ( 
+        FINANCIAL_KEEP_FEATURES, FINANCIAL_COMPUTE_CHANGE, FINANCIAL_COMPUTE_COMBINATION, FINANCIAL_COMPUTE_RATIO, 
+    ) 
+
+    def compute_each(df:pd.DataFrame) -> pd.DataFrame: 
+        df_proc = df[FINANCIAL_KEEP_FEATURES].copy() 
+        for outcol, computecol in FINANCIAL_COMPUTE_CHANGE.items(): 
+            df_proc[outcol] = df_proc.groupby("ticker")[computecol].pct_change(periods=1) 
+        for outcol, dict_compute in FINANCIAL_COMPUTE_COMBINATION.items(): 
+            df_proc[outcol] = 0 
+            for computecol in dict_compute["add"]: 
+                df_proc[outcol] += df_proc[computecol] 
+            for computecol in dict_compute["sub"]: 
+                df_proc[outcol] -= df_proc[computecol].abs() 
+        for outcol, (numcol, dencol) in FINANCIAL_COMPUTE_RATIO.items(): 
+            df_proc[outcol] = df_proc[numcol] / df_proc[dencol] 
+        return df_proc 
+
+    # Random panel with missing and zero values, with the reports of each ticker in order. 
+    rng = np.random.default_rng(0) 
+    numcols = FINANCIAL_KEEP_FEATURES[2:] 
+    df = pd.DataFrame(rng.normal(1e9, 5e8, (ntickers * nquarters, len(numcols))).round(-3), columns=numcols) 
+    df[df < 2e8] = np.nan 
+    df[df > 1.9e9] = 0 
+    df.insert(0, "ticker", np.repeat([f"T{i:04d}" for i in range(ntickers)], nquarters)) 
+    df.insert(1, "fiscalDateEnding", np.tile(pd.date_range("2000-03-31", periods=nquarters, freq="91D").strftime("%Y-%m-%d"), ntickers)) 
+
+    timings_engine, timings_pandas = list(), list() 
+    for _ in range(repeat): 
+        t = time.perf_counter() 
+        df_engine = compute_extra_fundamental(df) 
+        timings_engine.append(time.perf_counter() - t) 
+
+        t = time.perf_counter() 
+        df_pandas = compute_each(df) 
+        timings_pandas.append(time.perf_counter() - t) 
+
+    pd.testing.assert_frame_equal(df_engine, df_pandas) 
+
+    engine, pandas = statistics.median(timings_engine), statistics.median(timings_pandas) 
+    print(f"Computed the extra fundamentals of ({len(df):,}) reports: ({engine:.3f}s) against ({pandas:.3f}s) column by column.") 
+
+    return pd.DataFrame([{"engine": engine, "pandas": pandas, "speedup": pandas / engine}]) 
+
+
+
+# %% 
+def benchmark_quality_history(ntickers:int=500, nquarters:int=80, nupdates:int=4) -> pd.DataFrame: 
+    '''
+    Benchmark (update_quality_history) updated in (nupdates) steps against a single build,
+    on a random quarterly panel with missing and infinite values.
+
+    –   The defaults mimic the quarterly reports of the S&P 500 over 20 years.
+    –   Raise (AssertionError) if the ranks of the updates differ from the single build.
+    '''
+
+    import tempfile, shutil 
+    from source.modules.processor_fundamental import update_quality_history 
+    from source.config_py.config import FINANCIAL_EVAL_QUALITY, QUALITY_HISTORY_FILENAME 
+
+    # Random panel with missing and infinite values, e.g. the growth from zero. 
+    rng = np.random.default_rng(0) 
+    usecols = list(FINANCIAL_EVAL_QUALITY.keys()) 
+    periods = pd.period_range("2000Q1", periods=nquarters, freq="Q").to_timestamp(how="end").normalize() 
+    df = pd.DataFrame(rng.normal(.3, .6, (ntickers * nquarters, len(usecols))), columns=usecols) 
+    df[df < -.5] = np.nan 
+    df.iloc[::31, 0] = np.inf 
+    df.iloc[::89, 0] = -np.inf 
+    df.insert(0, "ticker", np.repeat([f"T{i:04d}" for i in range(ntickers)], nquarters)) 
+    df.insert(1, "fiscalDateEnding", np.tile(periods, ntickers)) 
+
+    # Only the mean, sum, min, max, std and var can be updated. 
+    eval_method = {m: dict(spec, func="np.mean" if "median" in spec["func"] else spec["func"]) for m, spec in FINANCIAL_EVAL_QUALITY.items()} 
+
+    def run(date_ends:List[str]) -> Tuple[pd.DataFrame,float]: 
+        dirpath = tempfile.mkdtemp() 
+        try: 
+            t = time.perf_counter() 
+            for date_end in date_ends: 
+                update_quality_history(df, date_end, dirpath=dirpath, eval_method=eval_method) 
+            elapsed = time.perf_counter() - t 
+            return pd.read_parquet(os.path.join(dirpath, QUALITY_HISTORY_FILENAME)), elapsed 
+        finally: 
+            shutil.rmtree(dirpath, ignore_errors=True) 
+
+    date_last = periods[-1] + pd.Timedelta("180D") 
+    date_ends = [f"{d:%Y-%m-%d}" for d in pd.date_range(periods[0], date_last, periods=nupdates + 1)[1:]] 
+    df_full, full = run(date_ends[-1:]) 
+    df_incr, incremental = run(date_ends) 
+
+    pd.testing.assert_frame_equal(df_full, df_incr, check_categorical=False) 
+
+    print(f"Ranked ({ntickers:,}) tickers as of ({df_full['date'].nunique()}) dates: ({full:.3f}s) at once against ({incremental:.3f}s) in ({nupdates}) updates.") 
+
+    return pd.DataFrame([{"full": full, "incremental": incremental}]) 
+
+
+
+# %% 
+def benchmark_membership(ntickers:int=1000, ndays:int=6000, nlookups:int=5_000_000, repeat:int=3) -> pd.DataFrame: 
+    '''
+    Benchmark (IndexMembership.is_member) against checking each ticker's intervals with
+    pandas, on random intervals and (ticker, date) lookups.
+
+    –   The defaults mimic the S&P 500 changes since the 2000s and the rows of a daily panel.
+    –   Raise (AssertionError) if the lookups differ.
+    '''
+
+    from source.modules.processor_membership import IndexMembership 
+
+    # Random intervals of one to three spells per ticker. 
+    rng = np.random.default_rng(0) 
+    dates = pd.bdate_range("2000-01-03", periods=ndays) 
+    tickers = np.array([f"T{i:04d}" for i in range(ntickers)], dtype=object) 
+    nspells = ntickers * 2 
+    beg = rng.integers(0, ndays, nspells) 
+    df_intervals = pd.DataFrame({ 
+        "ticker": rng.choice(tickers, nspells), 
+        "date_beg": dates[beg], 
+        "date_end": dates[np.minimum(beg + rng.integers(20, 2000, nspells), ndays - 1)], 
+    }) 
+    membership = IndexMembership(df_intervals) 
+
+    lookup_ticker = rng.choice(tickers, nlookups) 
+    lookup_date = dates[rng.integers(0, ndays, nlookups)].to_numpy() 
+
+    def lookup_each() -> np.ndarray: 
+        df = pd.DataFrame({"ticker": lookup_ticker, "date": lookup_date, "row": np.arange(nlookups)}) 
+        df = df.merge(df_intervals, on="ticker", how="inner") 
+        inside = df.loc[(df["date"] >= df["date_beg"]) & (df["date"] < df["date_end"]), "row"] 
+        return np.isin(np.arange(nlookups), inside.to_numpy()) 
+
+    timings_engine, timings_pandas = list(), list() 
+    for _ in range(repeat): 
+        t = time.perf_counter() 
+        member_engine = membership.is_member(lookup_ticker, lookup_date) 
+        timings_engine.append(time.perf_counter() - t) 
+
+        t = time.perf_counter() 
+        member_pandas = lookup_each() 
+        timings_pandas.append(time.perf_counter() - t) 
+
+    assert np.array_equal(member_engine, member_pandas), "Lookups differ." 
+
+    engine, pandas = statistics.median(timings_engine), statistics.median(timings_pandas) 
+    print(f"Looked up ({nlookups:,}) pairs: ({engine:.3f}s) against ({pandas:.3f}s) with a merge on the intervals.") 
+
+    return pd.DataFrame([{"engine": engine, "pandas": pandas, "speedup": pandas / engine}]) 
+
+
+
+# %% 
+def benchmark_compustat(ntickers:int=100, nyears:int=10, repeat:int=3) -> pd.DataFrame: 
+    '''
+    Benchmark (load_compustat_fundamental) of the quarterly statements, through (engine=)
+    on a SQLite stand-in of (comp.fundq) with random items.
+
+    –   Some items are stored as text, and a quarter of the first ticker is missing.
+    –   Raise (AssertionError) if the year-to-date items are not converted to the amount
+        of each quarter, or the items are not scaled from millions to units.
+    '''
+
+    import tempfile, shutil 
+    from sqlalchemy import create_engine, event 
+    from source.modules.processor_wrds import load_compustat_fundamental, _get_item_names 
+    from source.config_py.config import COMPUSTAT_TO_ALPHAV, COMPUSTAT_FILTERS 
+
+    spec = COMPUSTAT_TO_ALPHAV["quarter"] 
+    dirpath = tempfile.mkdtemp() 
+
+    # Random quarterly amounts, with the year-to-date items as their sum since the first quarter. 
+    rng = np.random.default_rng(0) 
+    quarters = pd.period_range(f"{2020 - nyears}Q1", periods=nyears * 4, freq="Q") 
+    df = pd.DataFrame({ 
+        "tic": np.repeat([f"T{i:03d}" for i in range(ntickers)], len(quarters)), 
+        "datadate": np.tile(quarters.to_timestamp(how="end").strftime("%Y-%m-%d"), ntickers), 
+        "fyearq": np.tile(quarters.year, ntickers), 
+        "fqtr": np.tile(quarters.quarter, ntickers), 
+        **COMPUSTAT_FILTERS, 
+    }) 
+    items = _get_item_names(spec["items"], spec["ytd"]) 
+    amounts = pd.DataFrame(rng.uniform(1, 100, (len(df), len(items))).round(3), columns=items) 
+    for col in spec["ytd"]: 
+        df[col] = amounts[col].groupby([df["tic"], df["fyearq"]]).cumsum() 
+    for col in items: 
+        if col not in spec["ytd"]: 
+            df[col] = amounts[col] 
+    df["xrdq"] = df["xrdq"].astype(str) 
+
+    # The quarter after the missing one cannot be converted. 
+    missing = 6 
+    df = df.drop(index=missing) 
+    amounts.loc[missing + 1, spec["ytd"]] = np.nan 
+
+    engine = create_engine("sqlite://") 
+
+    @event.listens_for(engine, "connect") 
+    def attach(conn, record): 
+        conn.execute(f"ATTACH DATABASE '{os.path.join(dirpath, 'comp.db')}' AS comp") 
+
+    try: 
+        with engine.begin() as conn: 
+            df.to_sql("fundq", conn, schema="comp", index=False) 
+
+        timings = list() 
+        for _ in range(repeat): 
+            t = time.perf_counter() 
+            df_loaded = load_compustat_fundamental( 
+                df["tic"].unique(), (2021 - nyears, 2019), annual=False, 
+                dirpath=dirpath, rawpath=os.path.join(dirpath, "fundq"), engine=engine, load_cache=False, 
+            ) 
+            timings.append(time.perf_counter() - t) 
+    finally: 
+        engine.dispose() 
+        shutil.rmtree(dirpath, ignore_errors=True) 
+
+    # Expected amounts of the loaded quarters, in units. 
+    expected = amounts.assign(tic=np.repeat([f"T{i:03d}" for i in range(ntickers)], len(quarters)), fyearq=np.tile(quarters.year, ntickers)) 
+    expected = expected.drop(index=missing).loc[lambda x: x["fyearq"] >= 2021 - nyears].reset_index(drop=True) 
+    df_loaded = df_loaded.sort_values(["ticker", "fiscalDateEnding"]).reset_index(drop=True) 
+
+    assert len(df_loaded) == len(expected), "Quarters differ." 
+    for name, item in spec["items"].items(): 
+        value = expected[item] if isinstance(item, str) else expected[item["add"]].sum(axis=1) - expected[item["sub"]].sum(axis=1) 
+        assert np.allclose(df_loaded[name], value * 1e6, equal_nan=True), f"Item ({name}) differs." 
+
+    elapsed = statistics.median(timings) 
+    print(f"Loaded ({len(df_loaded):,}) quarterly statements of ({ntickers}) tickers in ({elapsed:.3f}s).") 
+
+    return pd.DataFrame([{"elapsed": elapsed, "nrows": len(df_loaded)}]) 
+
+
+
+# %% 
+# Benchmarks to run from the command line, e.g. (python -m source.modules.benchmark rolling). 
+BENCHMARKS = { 
+    "imports": check_import_budget, 
+    "rolling": benchmark_rolling_agg, 
+    "scoring": benchmark_score_fundamental, 
+    "fundamental": benchmark_extra_fundamental, 
+    "quality": benchmark_quality_history, 
+    "membership": benchmark_membership, 
+    "compustat": benchmark_compustat, 
+} 
+
+
+
+# %% 
+if __name__ == "__main__": 
+    for name in sys.argv[1:] or BENCHMARKS.keys(): 
+        BENCHMARKS[name]() 
@@ -0,0 +1,171 @@
+# Python module. 
+import time, random, threading 
+from concurrent.futures import ThreadPoolExecutor, as_completed 
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple 
+
+# Custom configs. 
+from source.config_py.config import ( 
+    ALPHAV_CALLS_PER_MINUTE, ALPHAV_CALLS_BURST, ALPHAV_MAX_WORKERS, 
+    ALPHAV_ENDPOINT_CONCURRENCY, FETCH_MAX_RETRIES, FETCH_BACKOFF_RANGE, 
+) 
+
+
+
+# %% 
+# Messages returned by the APIs when the request is throttled. 
+THROTTLE_MESSAGES = ("call frequency", "rate limit", "too many requests", "429") 
+
+
+
+# %% 
+def format_eta(t:float) -> str: 
+    '''Format seconds as (HH:MM:SS).'''
+
+    m_, s = divmod(t, 60) 
+    h , m = divmod(m_, 60) 
+    return f"{h:>02.0f}:{m:>02.0f}:{s:>02.0f}" 
+
+
+
+# %% 
+def is_throttled(error:Exception) -> bool: 
+    '''Check whether the error is caused by the API rate limit.'''
+
+    # HTTP client errors carry the response status code. 
+    response = getattr(error, "response", None) 
+    if getattr(response, "status_code", getattr(error, "code", None)) == 429: 
+        return True 
+
+    # (alpha_vantage) raises (ValueError) with the API note instead. 
+    message = str(error).lower() 
+    return any(m in message for m in THROTTLE_MESSAGES) 
+
+
+
+# %% 
+class TokenBucket(): 
+    def __init__(self, calls_per_minute:float, burst:int=1): 
+        '''Thread-safe token bucket that allows (calls_per_minute) with bursts up to (burst) calls.'''
+
+        self.rate = calls_per_minute / 60 
+        self.capacity = max(1, burst) 
+        self.tokens = float(self.capacity) 
+        self.updated = time.monotonic() 
+        self.lock = threading.Lock() 
+
+
+    def acquire(self, tokens:int=1): 
+        '''Block until the tokens are available, then consume them.'''
+
+        while True: 
+            with self.lock: 
+                # Refill the bucket for the elapsed time. 
+                now = time.monotonic() 
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate) 
+                self.updated = now 
+
+                if self.tokens >= tokens: 
+                    self.tokens -= tokens 
+                    return 
+
+                wait = (tokens - self.tokens) / self.rate 
+
+            time.sleep(wait) 
+
+
+
+# %% 
+class FetchScheduler(): 
+    def __init__( 
+        self, 
+        calls_per_minute:float, 
+        burst:int=1, 
+        max_workers:int=4, 
+        endpoint_concurrency:Optional[Dict[str,int]]=None, 
+        max_retries:int=FETCH_MAX_RETRIES, 
+        backoff_range:Tuple[float,float]=FETCH_BACKOFF_RANGE, 
+        throttle_check:Callable[[Exception],bool]=is_throttled, 
+    ): 
+        '''
+        Schedule rate-limited API calls from a thread pool.
+
+        –   All calls share one token bucket, so the (calls_per_minute) budget holds
+            no matter how many tickers are fetched concurrently.
+        –   Each endpoint has its own concurrency limit. Unlisted endpoints are
+            limited to (max_workers).
+        –   Throttled calls are retried with exponential backoff and jitter.
+        '''
+
+        self.bucket = TokenBucket(calls_per_minute, burst) 
+        self.max_workers = max_workers 
+        self.max_retries = max_retries 
+        self.backoff_beg, self.backoff_end = backoff_range 
+        self.throttle_check = throttle_check 
+
+        self.lock = threading.Lock() 
+        self.semaphores = {k: threading.BoundedSemaphore(v) for k, v in (endpoint_concurrency or dict()).items()} 
+
+
+    def call(self, endpoint:str, func:Callable, *args, **kwargs) -> Any: 
+        '''Call the API function within the rate budget and retry if it is throttled.'''
+
+        for attempt in range(self.max_retries + 1): 
+            with self._get_semaphore(endpoint): 
+                self.bucket.acquire() 
+
+                try: 
+                    return func(*args, **kwargs) 
+                except Exception as error: 
+                    if attempt == self.max_retries or not self.throttle_check(error): 
+                        raise 
+
+            # Back off outside of the semaphore to let other endpoints proceed. 
+            delay = min(self.backoff_end, self.backoff_beg * 2 ** attempt) * random.uniform(.5, 1) 
+            print(f"Throttled on ({endpoint}). Retry ({attempt + 1}/{self.max_retries}) in ({delay:.1f}s).") 
+            time.sleep(delay) 
+
+
+    def map(self, func:Callable, items:Iterable) -> Iterator[Tuple[Any,Any]]: 
+        '''Run (func) for each item concurrently and yield (item, result) as they complete.'''
+
+        items = list(items) 
+        total, done = len(items), 0 
+        start = time.monotonic() 
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor: 
+            futures = {executor.submit(func, item): item for item in items} 
+
+            try: 
+                for future in as_completed(futures): 
+                    item, result = futures[future], future.result() 
+
+                    # Report the progress and the estimated time to complete. 
+                    done += 1 
+                    elapsed = time.monotonic() - start 
+                    remain = elapsed / done * (total - done) 
+                    print(f"Progress ({done}/{total}) for ({item}). Elapsed ({format_eta(elapsed)}). ETA ({format_eta(remain)}).") 
+
+                    yield item, result 
+
+            finally: 
+                # Stop the pending calls if it fails or the caller stops early. 
+                for future in futures: 
+                    future.cancel() 
+
+
+    def _get_semaphore(self, endpoint:str) -> threading.BoundedSemaphore: 
+        '''Get the concurrency limit of the endpoint.'''
+
+        with self.lock: 
+            if endpoint not in self.semaphores: 
+                self.semaphores[endpoint] = threading.BoundedSemaphore(self.max_workers) 
+            return self.semaphores[endpoint] 
+
+
+
+# %% 
+# Shared by all Alpha Vantage calls so that they draw from the same budget. 
+alphav_scheduler = FetchScheduler( 
+    ALPHAV_CALLS_PER_MINUTE, burst=ALPHAV_CALLS_BURST, max_workers=ALPHAV_MAX_WORKERS, 
+    endpoint_concurrency=ALPHAV_ENDPOINT_CONCURRENCY, 
+) 
@@ -1,10 +1,20 @@
 # %%
 # Python modules. 
-import os, re, pickle 
+import os, re, json, mmap, fcntl, pickle, contextlib 
 import pandas as pd
+from typing import Any, Iterable, List, Optional, Set, Tuple, Union 
 
 # Custom configuration.
-from source.config_py.config import DIR_ROOT, DIR_DATASET, DIR_MLMODEL 
+from source.config_py.config import DIR_ROOT, DIR_DATASET, DIR_MLMODEL, ARTIFACT_COMPRESSION 
+
+# Custom modules. 
+from source.modules.tracer import traced 
+
+
+
+# %% 
+# File extension of each artifact compression. 
+ARTIFACT_EXTENSIONS = {"zstd": ".zst", "lz4": ".lz4", "gzip": ".gz", "bz2": ".bz2", "brotli": ".br"} 
 
 
 
@@ -17,6 +27,7 @@ class ManageFiles():
 		self.mlmodel_dir = mlmodel_dir 
 
 
+	@traced(io="write") 
 	def pd_write_to(self, data:pd.DataFrame, dirpath:str, filename:str, format="csv", **kwargs):
 		'''Write dataframe.'''
 
@@ -34,6 +45,7 @@ class ManageFiles():
 			data.to_parquet(filepath, index=False, **kwargs) 
 
 
+	@traced(io="read") 
 	def pd_read_from(self, dirpath:str, filename:str, format="csv", **kwargs) -> pd.DataFrame:
 		'''Read into dataframe.'''
 
@@ -53,6 +65,317 @@ class ManageFiles():
 		return df 
 
 
+	@traced(io="read") 
+	def pd_read_dataset( 
+		self, 
+		dirpath:str, 
+		filename:Optional[str]=None, 
+		columns:Optional[List[str]]=None, 
+		tickers:Optional[Iterable[str]]=None, 
+		date_range:Optional[Tuple[Any,Any]]=None, 
+		datecol:str="date", 
+		tickercol:str="ticker", 
+		filters:Optional[Union[List[Tuple[str,str,Any]],Any]]=None, 
+		as_arrow:bool=False, 
+		memory_map:bool=False, 
+	): 
+		'''
+		Read only the needed columns and rows of a (csv) or (parquet) file, or of a
+		hive-partitioned Parquet directory (dirpath/col=val/*.parquet).
+
+		–   Only the (columns) are decoded. The filters are pushed down, so the partitions
+			and the Parquet row groups that cannot match are skipped without decoding.
+		–   (filters) is an Arrow expression or a list of (column, op, value) that must
+			all hold, e.g. [("sector", "in", ["Energy"]), ("close", ">", 1)].
+		–   A (year) partition is pruned by the (date_range) as well.
+		–   Return an Arrow table if (as_arrow) is True. With (memory_map), the files
+			are memory-mapped instead of read into buffers.
+		'''
+
+		import pyarrow.dataset as ds 
+		from pyarrow import fs 
+
+		path = os.path.join(dirpath, filename) if filename else dirpath 
+		print(f"Read dataset from ({path})") 
+
+		# Check directories. 
+		self._get_ready_for_file_operation(dirpath) 
+
+		filesystem = fs.LocalFileSystem(use_mmap=memory_map) 
+		partition_cols = list() 
+
+		if os.path.isdir(path): 
+			# Skip the temporary files and directories of writes in progress. 
+			filepaths = sorted( 
+				os.path.join(root, name) for root, _, names in os.walk(path) for name in names 
+				if name.endswith(".parquet") and not root.endswith(".tmp") 
+			) 
+			dataset = ds.dataset( 
+				filepaths, format="parquet", filesystem=filesystem, 
+				partitioning=ds.partitioning(flavor="hive"), partition_base_dir=path, 
+			) 
+
+			# The partition columns are the keys of the directory names (col=val). 
+			reldir = os.path.relpath(os.path.dirname(filepaths[0]), path) if filepaths else "" 
+			partition_cols = [d.split("=")[0] for d in reldir.split(os.sep) if "=" in d] 
+		else: 
+			fileformat = "csv" if path.endswith(".csv") else "parquet" 
+			dataset = ds.dataset(path, format=fileformat, filesystem=filesystem) 
+
+		# Combine all the filters into one expression. 
+		schema = dataset.schema 
+		ls_expr = list() 
+
+		if tickers is not None: 
+			ls_expr.append(ds.field(tickercol).isin(list(tickers))) 
+
+		if date_range is not None: 
+			date_beg, date_end = pd.Timestamp(date_range[0]), pd.Timestamp(date_range[1]) 
+			date_type = schema.field(datecol).type 
+			ls_expr.append(ds.field(datecol) >= _to_arrow_scalar(date_beg, date_type)) 
+			ls_expr.append(ds.field(datecol) <= _to_arrow_scalar(date_end, date_type)) 
+
+			# Prune the (year) partitions as well. 
+			if "year" in partition_cols: 
+				year_type = schema.field("year").type 
+				ls_expr.append(ds.field("year") >= _to_arrow_scalar(date_beg.year, year_type)) 
+				ls_expr.append(ds.field("year") <= _to_arrow_scalar(date_end.year, year_type)) 
+
+		if isinstance(filters, list): 
+			ls_expr.extend(_to_arrow_expression(c, op, v, schema.field(c).type) for c, op, v in filters) 
+		elif filters is not None: 
+			ls_expr.append(filters) 
+
+		expr = None 
+		for e in ls_expr: 
+			expr = e if expr is None else expr & e 
+
+		table = dataset.to_table(columns=columns, filter=expr) 
+
+		if as_arrow: 
+			return table 
+
+		# Release the Arrow buffers while converting to keep the peak memory low. 
+		return table.to_pandas(split_blocks=True, self_destruct=True) 
+
+
+	@traced(io="write", path=lambda a: os.path.join(a["dirpath"], f"{a['partition_col']}={a['partition_val']}")) 
+	def pd_write_partition(self, data:pd.DataFrame, dirpath:str, partition_col:str, partition_val:str, **kwargs): 
+		'''Write dataframe as its own hive-style partition (dirpath/col=val/part.parquet).'''
+
+		print(f"Write partition ({partition_col}={partition_val})") 
+
+		# Check directories. 
+		partpath = os.path.join(dirpath, f"{partition_col}={partition_val}") 
+		self._get_ready_for_file_operation(partpath) 
+
+		# The partition value is kept in the directory name, not inside the file. 
+		data = data.drop(columns=[partition_col], errors="ignore") 
+
+		# Write to a temporary file, then rename, so an interrupted write never 
+		# leaves a partial partition that would be mistaken as completed. 
+		filepath = os.path.join(partpath, "part.parquet") 
+		data.to_parquet(f"{filepath}.tmp", index=False, **kwargs) 
+		os.replace(f"{filepath}.tmp", filepath) 
+
+
+	def list_partitions(self, dirpath:str, partition_col:str) -> Set[str]: 
+		'''List the values of all completed partitions.'''
+
+		# Check directories. 
+		self._get_ready_for_file_operation(dirpath) 
+
+		prefix = f"{partition_col}=" 
+		return set( 
+			name[len(prefix):] for name in os.listdir(dirpath) 
+			if name.startswith(prefix) and os.path.isfile(os.path.join(dirpath, name, "part.parquet")) 
+		) 
+
+
+	@traced(io="read") 
+	def pd_read_partitions(self, dirpath:str, partition_col:str, **kwargs) -> pd.DataFrame: 
+		'''Read all partitions into a single dataframe.'''
+
+		print(f"Read partitions from ({dirpath})") 
+
+		# Read each partition and restore the partition column. 
+		ls_df = list() 
+		for partition_val in sorted(self.list_partitions(dirpath, partition_col)): 
+			filepath = os.path.join(dirpath, f"{partition_col}={partition_val}", "part.parquet") 
+			df = pd.read_parquet(filepath, **kwargs) 
+
+			# Empty partitions only mark the value as completed. 
+			if not df.empty: 
+				df.insert(0, partition_col, partition_val) 
+				ls_df.append(df) 
+
+		# Concat once to avoid the quadratic cost of growing the dataframe. 
+		return pd.concat(ls_df, axis="index", join="outer", ignore_index=True) if ls_df else pd.DataFrame() 
+
+
+	def compact_partitions(self, dirpath:str, filepath:str, partition_col:str, **kwargs) -> pd.DataFrame: 
+		'''Consolidate all partitions into a single (csv) or (parquet) file.'''
+
+		df = self.pd_read_partitions(dirpath, partition_col) 
+
+		print(f"Compact partitions to ({filepath})") 
+
+		# Check directories. 
+		self._get_ready_for_file_operation(os.path.dirname(filepath) or ".") 
+
+		# Write to a temporary file, then rename, to keep the previous file intact on failure. 
+		tmppath = f"{filepath}.tmp" 
+		if filepath.endswith(".parquet"): 
+			df.to_parquet(tmppath, index=False, **kwargs) 
+		else: 
+			df.to_csv(tmppath, index=False, **kwargs) 
+		os.replace(tmppath, filepath) 
+
+		return df 
+
+
+	@traced(io="write") 
+	def pd_append_parquet(self, data:pd.DataFrame, filepath:str) -> int: 
+		'''
+		Append the rows to a Parquet file as a new row group and return the total rows.
+
+		–   The existing row groups are copied one at a time without decoding the
+			whole file, then the rows are written with the schema of the file.
+		–   Raise (ValueError) if the columns of (data) differ from those of the file,
+			rather than append rows with null features.
+		'''
+
+		import pyarrow as pa 
+		import pyarrow.parquet as pq 
+
+		print(f"Append ({len(data):,}) rows to ({filepath})") 
+
+		# Check directories. 
+		self._get_ready_for_file_operation(os.path.dirname(filepath) or ".") 
+
+		if not os.path.isfile(filepath): 
+			data.to_parquet(filepath, index=False) 
+			return len(data) 
+
+		reader = pq.ParquetFile(filepath) 
+		schema = reader.schema_arrow 
+
+		extra = [c for c in data.columns if c not in schema.names] 
+		if extra: 
+			raise ValueError(f"Columns not in ({filepath}): ({', '.join(map(str, extra))}). Rebuild the file instead.") 
+
+		missing = [c for c in schema.names if c not in data.columns] 
+		if missing: 
+			raise ValueError(f"Columns of ({filepath}) missing from the rows: ({', '.join(missing)}). Produce them before appending.") 
+
+		# Match the column order and types of the file. 
+		table = pa.Table.from_pandas(data, preserve_index=False) 
+		arrays = [self._cast_arrow(table.column(f.name), f.type) for f in schema] 
+		table = pa.Table.from_arrays(arrays, schema=schema) 
+
+		# Write to a temporary file, then rename, to keep the previous file intact on failure. 
+		tmppath = f"{filepath}.tmp" 
+		with pq.ParquetWriter(tmppath, schema) as writer: 
+			for i in range(reader.num_row_groups): 
+				writer.write_table(reader.read_row_group(i)) 
+			writer.write_table(table) 
+		os.replace(tmppath, filepath) 
+
+		return reader.metadata.num_rows + len(table) 
+
+
+	@traced(io="write") 
+	def pd_write_dataset(self, data:pd.DataFrame, dirpath:str): 
+		'''
+		Write the rows as a Parquet directory of a single part (dirpath/part-00000.parquet),
+		to append to with (pd_append_dataset).
+
+		–   The previous directory, or a single Parquet file at (dirpath), is replaced
+			only once the new part is written.
+		'''
+
+		import shutil 
+
+		print(f"Write dataset to ({dirpath})") 
+
+		# Check directories. 
+		self._get_ready_for_file_operation(os.path.dirname(dirpath) or ".") 
+
+		# Write to a temporary directory, then rename, to keep the previous dataset intact on failure. 
+		tmppath = f"{dirpath}.tmp" 
+		shutil.rmtree(tmppath, ignore_errors=True) 
+		os.makedirs(tmppath) 
+		data.to_parquet(os.path.join(tmppath, "part-00000.parquet"), index=False) 
+
+		if os.path.isdir(dirpath): 
+			shutil.rmtree(dirpath) 
+		elif os.path.exists(dirpath): 
+			os.remove(dirpath) 
+		os.replace(tmppath, dirpath) 
+
+
+	@traced(io="write") 
+	def pd_append_dataset(self, data:pd.DataFrame, dirpath:str) -> str: 
+		'''
+		Append the rows to a Parquet directory as a new part and return its path.
+
+		–   The existing parts are not read or rewritten, so an append only costs the
+			size of the rows. The rows are written with the schema of the first part.
+		–   Raise (ValueError) if the columns of (data) differ from those of the dataset,
+			rather than append rows with null features.
+		'''
+
+		import pyarrow as pa 
+		import pyarrow.parquet as pq 
+
+		print(f"Append ({len(data):,}) rows to ({dirpath})") 
+
+		if not os.path.isdir(dirpath): 
+			self.pd_write_dataset(data, dirpath) 
+			return os.path.join(dirpath, "part-00000.parquet") 
+
+		parts = sorted(name for name in os.listdir(dirpath) if re.fullmatch(r"part-\d+\.parquet", name)) 
+		if not parts: 
+			raise ValueError(f"No parts in ({dirpath}). Rebuild the dataset instead.") 
+
+		schema = pq.read_schema(os.path.join(dirpath, parts[0])) 
+
+		extra = [c for c in data.columns if c not in schema.names] 
+		if extra: 
+			raise ValueError(f"Columns not in ({dirpath}): ({', '.join(map(str, extra))}). Rebuild the dataset instead.") 
+
+		missing = [c for c in schema.names if c not in data.columns] 
+		if missing: 
+			raise ValueError(f"Columns of ({dirpath}) missing from the rows: ({', '.join(missing)}). Produce them before appending.") 
+
+		# Match the column order and types of the dataset. 
+		table = pa.Table.from_pandas(data, preserve_index=False) 
+		arrays = [self._cast_arrow(table.column(f.name), f.type) for f in schema] 
+		table = pa.Table.from_arrays(arrays, schema=schema) 
+
+		# Number the part after the last one. The temporary file is skipped by the readers. 
+		number = max(int(name[5:-8]) for name in parts) + 1 
+		filepath = os.path.join(dirpath, f"part-{number:05d}.parquet") 
+		pq.write_table(table, f"{filepath}.tmp") 
+		os.replace(f"{filepath}.tmp", filepath) 
+
+		return filepath 
+
+
+	def _cast_arrow(self, column, dtype): 
+		'''Cast an Arrow column to (dtype). Categoricals are encoded again with the index type of (dtype).''' 
+
+		import pyarrow as pa 
+
+		if not pa.types.is_dictionary(dtype): 
+			return column.cast(dtype) 
+
+		# The index type of a categorical depends on its number of categories. 
+		encoded = column.cast(dtype.value_type).combine_chunks().dictionary_encode() 
+		return pa.DictionaryArray.from_arrays(encoded.indices.cast(dtype.index_type), encoded.dictionary) 
+
+
+	@traced(io="write") 
 	def save_cache_pk(self, dirpath:str=None, filename:str=None, object=None): 
 		'''Cache the result.''' 
 
@@ -66,6 +389,7 @@ class ManageFiles():
 			pickle.dump(object, f) 
 
 
+	@traced(io="read") 
 	def load_cache_pk(self, dirpath:str=None, filename:str=None): 
 		'''Load the cache.''' 
 
@@ -79,72 +403,161 @@ class ManageFiles():
 			return pickle.load(f) 
 
 
-	def save_version_pk(self, dirpath:str=None, obj_name:str=None, object=None, dev_status:bool=True): 
-		'''Save the object and assign the version.''' 
+	def save_version_pk( 
+		self, 
+		dirpath:str=None, 
+		obj_name:str=None, 
+		object=None, 
+		dev_status:bool=True, 
+		compression:Optional[str]=ARTIFACT_COMPRESSION, 
+		mmap_arrays:bool=False, 
+	) -> int: 
+		'''
+		Save the object and assign the version.
+
+		–   The version is reserved under a lock, so parallel jobs never overwrite each other,
+			and the files are written to a temporary path, then renamed.
+		–   The pickle is compressed with (compression), e.g. zstd, lz4, gzip or None.
+		–   With (mmap_arrays), the contiguous NumPy arrays are kept out of the pickle in a raw
+			file, so that loading memory-maps them instead of copying them into memory.
+		'''
 
 		print(f"Save object ({obj_name}).") 
 
 		# Check directories. 
 		self._get_ready_for_file_operation(dirpath) 
+		self._confirm_version_exist(dirpath, dev_status) 
 
-		# Load the current version and get the dev folder. 
-		dev_status, version = self.resume_version(dirpath, dev_status=dev_status) 
-		obj_name = f"{obj_name}_v{version}.pickle" 
+		stage = "dev" if dev_status else "prod" 
+		path = os.path.join(dirpath, stage) 
 
-		# Save the model. 
-		filepath = os.path.join(dirpath, dev_status, obj_name) 
-		with open(filepath, "wb") as f: 
-			pickle.dump(object, f) 
+		# Reserve the version. 
+		with self._lock_versions(path): 
+			manifest = self._read_manifest(path) 
+			version = manifest["next_version"] 
+			manifest["next_version"] = version + 1 
+			self._write_manifest(path, manifest) 
+
+		# Save the model outside of the lock, since it can take a while. 
+		filename = f"{obj_name}_v{version}.pickle{ARTIFACT_EXTENSIONS.get(compression, '')}" 
+		buffers = list() 
+		with _open_atomic(os.path.join(path, filename), compression) as f: 
+			pickle.dump(object, f, protocol=5, buffer_callback=buffers.append if mmap_arrays else None) 
+
+		entry = {"filename": filename, "compression": compression, "created": pd.Timestamp.now().isoformat()} 
+		if buffers: 
+			entry["buffers_file"] = f"{obj_name}_v{version}.buffers" 
+			entry["buffers"] = _write_buffers(os.path.join(path, entry["buffers_file"]), buffers) 
 
-		# Increment the version by 1 after saving it. 
-		self.update_version(dirpath, version, dev_status=True) 
+		# Register the version once it is complete, then point (latest) to it. 
+		with self._lock_versions(path): 
+			manifest = self._read_manifest(path) 
+			versions = manifest["objects"].setdefault(obj_name, dict()) 
+			versions[str(version)] = entry 
+			self._write_manifest(path, manifest) 
+
+		print(f"Saved version: ({version}) in ({stage})") 
+
+		return version 
 
 
 	def load_version_pk(self, dirpath:str=None, obj_name:str=None, version_load:str="latest", dev_status:bool=True): 
-		'''Load the object with specific version.''' 
+		'''Load the object with specific version. The arrays saved with (mmap_arrays) are memory-mapped and read-only.'''
 
 		print(f"Load object ({obj_name}).") 
 
 		# Check directories. 
 		self._get_ready_for_file_operation(dirpath) 
 
-		# Load the model specific version and get the dev folder. 
-		dev_status, version = self.resume_version(dirpath, dev_status=dev_status) 
-		version_load = str(version) if version_load == "latest" else version_load 
-		obj_name = f"{obj_name}_v{int(version) - 1}.pickle" 
+		stage = "dev" if dev_status else "prod" 
+		path = os.path.join(dirpath, stage) 
+
+		# Resolve the version from the manifest rather than scanning the directory. 
+		versions = self._read_manifest(path)["objects"].get(obj_name, dict()) 
+		version = max(map(int, versions), default=None) if version_load == "latest" else int(version_load) 
+		if str(version) not in versions: 
+			raise FileNotFoundError(f"Version ({version_load}) of ({obj_name}) is not found in ({path}).") 
+		entry = versions[str(version)] 
+
+		buffers = None 
+		if entry.get("buffers"): 
+			buffers = _read_buffers(os.path.join(path, entry["buffers_file"]), entry["buffers"]) 
 
 		# Load the model. 
-		filepath = os.path.join(dirpath, dev_status, obj_name) 
-		with open(filepath, "rb") as f: 
-			return pickle.load(f) 
+		print(f"Loaded version: ({version}) from ({stage})") 
+		return _load_pickle(os.path.join(path, entry["filename"]), entry["compression"], buffers) 
 
 
 	def update_version(self, dirpath:str=None, version:int=None, dev_status:bool=True): 
 		'''For versioning.''' 
 
-		# Check directories. 
-		self._get_ready_for_file_operation(dirpath) 
-		
+		self._confirm_version_exist(dirpath, dev_status) 
+
 		dev_status = "dev" if dev_status else "prod" 
-		filepath = os.path.join(dirpath, dev_status, "VERSION") 
-		with open(filepath, "w") as f: 
-			version += 1 
-			print(f"Updated version: ({version}) in ({dev_status})") 
-			f.write(str(version)) 
+		path = os.path.join(dirpath, dev_status) 
+		with self._lock_versions(path): 
+			manifest = self._read_manifest(path) 
+			manifest["next_version"] = version + 1 
+			self._write_manifest(path, manifest) 
+
+		print(f"Updated version: ({version + 1}) in ({dev_status})") 
 
 
 	def resume_version(self, dirpath:str=None, dev_status:bool=True): 
 		'''Resume the latest version.''' 
 
-		# Ensure the directories and version file exists. 
+		# Ensure the directories exist. 
 		self._confirm_version_exist(dirpath, dev_status) 
 
 		dev_status = "dev" if dev_status else "prod" 
-		filepath = os.path.join(dirpath, dev_status, "VERSION") 
-		with open(filepath, "r") as f: 
-			dev_status, version = dev_status, int(f.read()) 
-			print(f"Resumed version: ({version}) from ({dev_status})") 
-			return dev_status, version 
+		version = self._read_manifest(os.path.join(dirpath, dev_status))["next_version"] 
+		print(f"Resumed version: ({version}) from ({dev_status})") 
+		return dev_status, version 
+
+
+	@contextlib.contextmanager 
+	def _lock_versions(self, path:str): 
+		'''Hold an exclusive lock on the versions of the directory, across processes.'''
+
+		with open(os.path.join(path, ".lock"), "a") as f: 
+			fcntl.flock(f, fcntl.LOCK_EX) 
+			try: 
+				yield 
+			finally: 
+				fcntl.flock(f, fcntl.LOCK_UN) 
+
+
+	def _read_manifest(self, path:str) -> dict: 
+		'''Read the manifest, i.e. the next version and the saved versions of each object.'''
+
+		filepath = os.path.join(path, "MANIFEST.json") 
+		if os.path.isfile(filepath): 
+			with open(filepath, "r") as f: 
+				return json.load(f) 
+
+		# Migrate the directories saved before the manifest. This is the only scan. 
+		manifest = {"next_version": 1, "objects": dict()} 
+		if os.path.isfile(os.path.join(path, "VERSION")): 
+			with open(os.path.join(path, "VERSION"), "r") as f: 
+				manifest["next_version"] = int(f.read()) 
+
+		for filename in sorted(os.listdir(path)): 
+			found = re.match(r"^(.+)_v(\d+)\.pickle$", filename) 
+			if found: 
+				versions = manifest["objects"].setdefault(found.group(1), dict()) 
+				versions[found.group(2)] = {"filename": filename, "compression": None} 
+				manifest["next_version"] = max(manifest["next_version"], int(found.group(2)) + 1) 
+
+		return manifest 
+
+
+	def _write_manifest(self, path:str, manifest:dict): 
+		'''Write the manifest atomically. Only called while holding the lock.'''
+
+		filepath = os.path.join(path, "MANIFEST.json") 
+		with open(f"{filepath}.tmp", "w") as f: 
+			json.dump(manifest, f, indent=2, sort_keys=True) 
+		os.replace(f"{filepath}.tmp", filepath) 
 
 
 	def _get_ready_for_file_operation(self, dirpath:str):
@@ -175,11 +588,117 @@ class ManageFiles():
 		dev_status = "dev" if dev_status else "prod" 
 		path = os.path.join(dirpath, dev_status) 
 
-		# Create the directory. 
-		if not os.path.exists(path): 
-			os.makedirs(path) 
+		# Create the directory. The manifest is created on the first save. 
+		os.makedirs(path, exist_ok=True) 
+
+
+
+# %% 
+def _to_arrow_scalar(value:Any, arrow_type): 
+	'''Convert the value to the Arrow type of the column it is compared with.'''
+
+	import pyarrow as pa 
+
+	if pa.types.is_timestamp(arrow_type): 
+		value = pd.Timestamp(value) 
+		value = value.tz_localize(arrow_type.tz) if arrow_type.tz and value.tzinfo is None else value 
+		return pa.scalar(value, type=arrow_type) 
+	if pa.types.is_date(arrow_type): 
+		return pa.scalar(pd.Timestamp(value).date(), type=arrow_type) 
+	if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type): 
+		# Dates stored as text are compared as ISO strings. 
+		return pa.scalar(value.strftime("%Y-%m-%d") if isinstance(value, pd.Timestamp) else str(value), type=arrow_type) 
+
+	return pa.scalar(value).cast(arrow_type) 
+
+
+
+# %% 
+def _to_arrow_expression(col:str, op:str, value:Any, arrow_type): 
+	'''Convert a (column, op, value) filter into an Arrow expression.'''
+
+	import pyarrow.dataset as ds 
+
+	field = ds.field(col) 
+	if op == "in": 
+		return field.isin([_to_arrow_scalar(v, arrow_type).as_py() for v in value]) 
+	if op == "not in": 
+		return ~field.isin([_to_arrow_scalar(v, arrow_type).as_py() for v in value]) 
+
+	value = _to_arrow_scalar(value, arrow_type) 
+	if op in ("=", "=="): 
+		return field == value 
+	if op == "!=": 
+		return field != value 
+	if op == "<": 
+		return field < value 
+	if op == "<=": 
+		return field <= value 
+	if op == ">": 
+		return field > value 
+	if op == ">=": 
+		return field >= value 
+
+	raise ValueError(f"Unsupported filter operator ({op}).") 
+
+
+
+# %% 
+@contextlib.contextmanager 
+def _open_atomic(filepath:str, compression:Optional[str]=None): 
+	'''Open a (compressed) stream to a temporary file, then rename it to (filepath) on success.'''
+
+	import pyarrow as pa 
+
+	tmppath = f"{filepath}.{os.getpid()}.tmp" 
+	try: 
+		with pa.output_stream(tmppath, compression=compression) as f: 
+			yield f 
+		os.replace(tmppath, filepath) 
+	finally: 
+		if os.path.exists(tmppath): 
+			os.remove(tmppath) 
+
+
+
+# %% 
+def _load_pickle(filepath:str, compression:Optional[str]=None, buffers:Optional[List]=None): 
+	'''Load the (compressed) pickle with its out-of-band buffers.'''
+
+	import pyarrow as pa 
+
+	with pa.input_stream(filepath, compression=compression) as f: 
+		return pickle.loads(f.read(), buffers=buffers) 
+
+
+
+# %% 
+def _write_buffers(filepath:str, buffers:List[pickle.PickleBuffer], align:int=64) -> List[Tuple[int,int]]: 
+	'''Write the out-of-band buffers into one raw file and return their (offset, size).'''
+
+	ls_span = list() 
+	with _open_atomic(filepath) as f: 
+		offset = 0 
+		for buffer in buffers: 
+			with buffer.raw() as view: 
+				# Align each buffer so that the memory-mapped arrays are aligned too. 
+				padding = -offset % align 
+				f.write(b"\0" * padding) 
+				f.write(view) 
+				ls_span.append((offset + padding, view.nbytes)) 
+				offset += padding + view.nbytes 
+
+	return ls_span 
+
+
+
+# %% 
+def _read_buffers(filepath:str, spans:List[Tuple[int,int]]) -> List[memoryview]: 
+	'''Memory-map the buffers file and return a read-only view of each buffer.'''
+
+	with open(filepath, "rb") as f: 
+		mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) 
+
+	view = memoryview(mm) 
+	return [view[offset:offset + size] for offset, size in spans] 
 
-			# Create the version file. 
-			with open(os.path.join((path, "VERSION")), "x") as f: 
-				version = 1 
-				f.write(str(version)) 
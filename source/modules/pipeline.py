@@ -0,0 +1,965 @@
+# Python module. 
+import os, sys, ast, json, time, inspect, hashlib, argparse, importlib.util 
+import numpy as np 
+import pandas as pd 
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait 
+from typing import Any, Callable, Dict, List, Optional, Set 
+
+# Custom modules. 
+from source.modules.manage_files import ManageFiles 
+from source.modules.response_cache import _normalise 
+from source.modules.fetch_scheduler import alphav_scheduler, format_eta 
+from source.modules.tracer import tracer 
+
+# Custom configs. 
+from source.config_py import config 
+from source.config_py.config import ( 
+    DIR_DATASET, DIR_DATASET_TICKER, DIR_DATASET_FUNDAMENTAL, DIR_DATASET_TECH_IND, 
+    DIR_DATASET_ECONOMIC_DATA, DIR_DATASET_CONSOLIDATED, DIR_DATASET_WRDS_RAVENPACK, DIR_DATASET_UTIL, 
+    DIR_MLMODEL_MLESTIM, DIR_MLMODEL_MLPERFORMANCE, 
+    TICKER_TO_COLLECT, TICKER_TO_EXCLUDE, TICKER_DATE_COLLECT, TICKER_MEMBERSHIP, 
+    MERGE_EVENT_FILENAMES, FUNDAMENTAL_SOURCE, TECHNIND_SOURCE, REFRESH_STATE_FILENAME, 
+    PIPELINE_STATE_DIR, PIPELINE_MAX_WORKERS, PIPELINE_TRAIN, PIPELINE_BACKTEST, 
+) 
+
+
+
+# %% 
+# File management setup. 
+manage_files = ManageFiles() 
+
+
+
+# %% 
+class Stage(): 
+    def __init__( 
+        self, 
+        name:str, 
+        func:Callable, 
+        deps:List[str]=list(), 
+        outputs:List[str]=list(), 
+        params:Dict[str,Any]=dict(), 
+        config:List[str]=list(), 
+        modules:List[str]=list(), 
+        inputs:List[str]=list(), 
+    ): 
+        '''
+        Stage of the pipeline that runs (func(**params)) and writes the (outputs).
+
+        –   (deps) are the stages whose outputs this stage reads.
+        –   (config) are the names of the config variables the stage depends on.
+        –   (modules) are the modules whose code the stage runs, besides its own function,
+            or only the functions it runs within a module (module.function).
+        –   (inputs) are the external files the stage reads, e.g. the event dates.
+        '''
+
+        self.name = name 
+        self.func = func 
+        self.deps = list(deps) 
+        self.outputs = list(outputs) 
+        self.params = dict(params) 
+        self.config = list(config) 
+        self.modules = list(dict.fromkeys(modules)) 
+        self.inputs = list(inputs) 
+
+
+
+# %% 
+class Pipeline(): 
+    def __init__( 
+        self, 
+        stages:List[Stage], 
+        statedir:str=PIPELINE_STATE_DIR, 
+        max_workers:int=PIPELINE_MAX_WORKERS, 
+    ): 
+        '''
+        Run a graph of stages and skip the stages whose inputs have not changed.
+
+        –   Each stage is keyed on the hash of its parameters, config, code, input files
+            and the keys of its upstream stages, so a change reruns everything downstream.
+        –   The key and outputs of the last successful run are recorded under (statedir).
+            A stage is skipped if its key is unchanged and its outputs exist.
+        –   Stages run in a thread pool as soon as their upstream stages are done.
+        '''
+
+        self.stages = {s.name: s for s in stages} 
+        self.statedir = statedir 
+        self.max_workers = max_workers 
+
+        for stage in stages: 
+            unknown = set(stage.deps).difference(self.stages) 
+            if unknown: 
+                raise ValueError(f"Stage ({stage.name}) depends on unknown stages ({', '.join(sorted(unknown))}).") 
+
+        self.order = self._sort_stages() 
+
+
+    def get_key(self, name:str, keys:Dict[str,str]) -> str: 
+        '''Hash everything the outputs of the stage depend on.'''
+
+        stage = self.stages[name] 
+
+        payload = { 
+            "name": name, 
+            "params": _normalise(stage.params), 
+            "config": {c: _normalise(getattr(config, c)) for c in stage.config}, 
+            "code": {"func": _hash_text(inspect.getsource(stage.func)), **{m: _hash_code(m) for m in stage.modules}}, 
+            "inputs": {f: _stat_file(f) for f in stage.inputs}, 
+            "deps": {d: keys[d] for d in stage.deps}, 
+        } 
+        normalised = json.dumps(payload, sort_keys=True, default=str) 
+
+        return hashlib.sha256(normalised.encode("utf-8")).hexdigest() 
+
+
+    def run(self, targets:Optional[List[str]]=None, force:bool=False) -> pd.DataFrame: 
+        '''
+        Run the (targets) and their upstream stages, or all stages if (targets) is None.
+
+        –   Set (force) to True to rerun the stages even if their key is unchanged.
+        –   A failed stage blocks its downstream stages, while the others carry on.
+        –   Return the status, duration and key of each stage.
+        '''
+
+        manage_files._confirm_current_working_directory() 
+
+        names = self._select_stages(targets) 
+        keys, status, seconds = dict(), dict(), dict() 
+
+        # Keys only depend on the upstream keys, so they are computed in order before running. 
+        for name in names: 
+            keys[name] = self.get_key(name, keys) 
+
+        pending = list(names) 
+        running = dict() 
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor: 
+            while pending or running: 
+                for name in list(pending): 
+                    deps = self.stages[name].deps 
+
+                    if any(status.get(d) in ("failed", "blocked") for d in deps): 
+                        status[name] = "blocked" 
+                        pending.remove(name) 
+                        print(f"Blocked stage ({name}) by a failed upstream stage.") 
+
+                    elif all(status.get(d) in ("skipped", "done") for d in deps): 
+                        pending.remove(name) 
+
+                        if not force and self._is_fresh(name, keys[name]): 
+                            status[name] = "skipped" 
+                            print(f"Skipped stage ({name}) with unchanged key ({keys[name][:12]}).") 
+                            continue 
+
+                        print(f"Run stage ({name}).") 
+                        running[executor.submit(self._run_stage, name, keys[name])] = name 
+
+                # Check the pending stages again once their upstream is skipped or completed. 
+                if not running: 
+                    continue 
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED) 
+                for future in done: 
+                    name = running.pop(future) 
+                    try: 
+                        seconds[name] = future.result() 
+                        status[name] = "done" 
+                        print(f"Completed stage ({name}) in ({format_eta(seconds[name])}).") 
+                    except Exception as error: 
+                        status[name] = "failed" 
+                        print(f"Failed stage ({name}): {error!r}") 
+
+        df_report = pd.DataFrame([ 
+            {"stage": n, "status": status[n], "seconds": seconds.get(n, 0.0), "key": keys[n]} for n in names 
+        ]) 
+
+        return df_report 
+
+
+    def _run_stage(self, name:str, key:str) -> float: 
+        '''Run the stage, then record its key and outputs.'''
+
+        stage = self.stages[name] 
+
+        start = time.monotonic() 
+        with tracer.span(f"stage.{name}", key=key): 
+            stage.func(**stage.params) 
+        elapsed = time.monotonic() - start 
+
+        missing = [f for f in stage.outputs if not os.path.exists(f)] 
+        if missing: 
+            raise FileNotFoundError(f"Stage ({name}) did not write ({', '.join(missing)}).") 
+
+        # Write the record last, so an interrupted stage is rerun. 
+        record = {"key": key, "outputs": stage.outputs, "seconds": elapsed, "finished": time.time()} 
+        manage_files._get_ready_for_file_operation(self.statedir) 
+        filepath = os.path.join(self.statedir, f"{name}.json") 
+        with open(f"{filepath}.tmp", "w") as f: 
+            json.dump(record, f, indent=4) 
+        os.replace(f"{filepath}.tmp", filepath) 
+
+        return elapsed 
+
+
+    def _is_fresh(self, name:str, key:str) -> bool: 
+        '''Check whether the last run of the stage has the same key and its outputs still exist.'''
+
+        filepath = os.path.join(self.statedir, f"{name}.json") 
+        if not os.path.isfile(filepath): 
+            return False 
+
+        with open(filepath, "r") as f: 
+            record = json.load(f) 
+
+        return record["key"] == key and all(os.path.exists(p) for p in record["outputs"]) 
+
+
+    def _select_stages(self, targets:Optional[List[str]]) -> List[str]: 
+        '''Select the (targets) and all their upstream stages, in the order to run.'''
+
+        if targets is None: 
+            return list(self.order) 
+
+        unknown = set(targets).difference(self.stages) 
+        if unknown: 
+            raise ValueError(f"Unknown stages ({', '.join(sorted(unknown))}).") 
+
+        selected, stack = set(), list(targets) 
+        while stack: 
+            name = stack.pop() 
+            if name not in selected: 
+                selected.add(name) 
+                stack.extend(self.stages[name].deps) 
+
+        return [n for n in self.order if n in selected] 
+
+
+    def _sort_stages(self) -> List[str]: 
+        '''Sort the stages so that each comes after its upstream stages. Raise (ValueError) on a cycle.'''
+
+        order, visiting, visited = list(), set(), set() 
+
+        def visit(name:str): 
+            if name in visited: 
+                return 
+            if name in visiting: 
+                raise ValueError(f"Cycle in the pipeline at stage ({name}).") 
+
+            visiting.add(name) 
+            for dep in self.stages[name].deps: 
+                visit(dep) 
+            visiting.remove(name) 
+
+            visited.add(name) 
+            order.append(name) 
+
+        for name in self.stages: 
+            visit(name) 
+
+        return order 
+
+
+
+# %% 
+def _get_module_file(module:str) -> str: 
+    '''Get the source file of the module without importing it.'''
+
+    # Stages declared in a script run as (__main__) are only found in (sys.modules). 
+    loaded = sys.modules.get(module) 
+    if getattr(loaded, "__file__", None): 
+        return loaded.__file__ 
+
+    return importlib.util.find_spec(module).origin 
+
+
+
+# %% 
+def _hash_code(name:str) -> str: 
+    '''
+    Hash the code of a module, or of a function or class within a module (module.function),
+    without importing it.
+    '''
+
+    # The name is a module if its parent is a package, else a function of its parent. 
+    module, attr = name.rsplit(".", 1) 
+    filepath = _get_module_file(module) 
+    if os.path.basename(filepath) == "__init__.py": 
+        return _hash_file(_get_module_file(name)) 
+
+    # Only the definition of the function is hashed, so the other code of its module 
+    # does not rerun the stage. 
+    with open(filepath, "r", encoding="utf-8") as f: 
+        source = f.read() 
+
+    for node in ast.parse(source).body: 
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name == attr: 
+            return _hash_text(ast.get_source_segment(source, node)) 
+
+    raise ValueError(f"No function or class ({attr}) in the module ({module}).") 
+
+
+
+# %% 
+def _hash_text(text:str) -> str: 
+    '''Hash the text.'''
+
+    return hashlib.sha256(text.encode("utf-8")).hexdigest() 
+
+
+
+# %% 
+def _hash_file(filepath:str) -> str: 
+    '''Hash the content of the file.'''
+
+    with open(filepath, "rb") as f: 
+        return hashlib.sha256(f.read()).hexdigest() 
+
+
+
+# %% 
+def _stat_file(filepath:str) -> Optional[List[int]]: 
+    '''Get the size and modified time of the file, or None if it is missing.'''
+
+    try: 
+        stat = os.stat(filepath) 
+    except FileNotFoundError: 
+        return None 
+
+    return [stat.st_size, stat.st_mtime_ns] 
+
+
+
+# %% 
+def fetch_ticker(tickers:List[str], date_beg:str, date_end:str): 
+    '''Fetch the daily bars from Yahoo Finance. Same as the (compile_features) notebook.'''
+
+    from source.modules.processor_features import compile_features_each_ticker 
+    from source.modules.processor_ticker import get_ticker_yfinance 
+
+    # Recompile all tickers. The unchanged requests are served by the response cache. 
+    filepath = os.path.join(DIR_DATASET_TICKER, "ticker_dailydata.csv") 
+    compile_features_each_ticker( 
+        get_ticker_yfinance, filepath, set(tickers), load_cache=False, 
+        **dict(date_beg=date_beg, date_end=date_end), 
+    ) 
+
+
+
+# %% 
+def fetch_fundamental(tickers:List[str]): 
+    '''Fetch the annual and quarterly financial statements from Alpha Vantage.'''
+
+    from source.modules.processor_features import compile_features_each_ticker 
+    from source.modules.processor_fundamental import get_fundamental_alphav 
+
+    for period, annual in (("annual", True), ("quarter", False)): 
+        filepath = os.path.join(DIR_DATASET_FUNDAMENTAL, f"financial_statement_{period}.csv") 
+        compile_features_each_ticker( 
+            get_fundamental_alphav, filepath, set(tickers), load_cache=False, 
+            scheduler=alphav_scheduler, **dict(annual=annual), 
+        ) 
+
+
+
+# %% 
+def fetch_compustat(tickers:List[str], yearrange:List[int]): 
+    '''Extract the annual and quarterly financial statements from WRDS Compustat, in the schema of Alpha Vantage.'''
+
+    from source.modules.processor_wrds import load_compustat_fundamental 
+
+    # The years already extracted for the same tickers and items are kept. 
+    for annual in (True, False): 
+        load_compustat_fundamental(tickers, tuple(yearrange), annual=annual) 
+
+
+
+# %% 
+def fetch_technical(tickers:List[str], source:str=TECHNIND_SOURCE): 
+    '''
+    Compute the technical indicators from the daily bars of (fetch_ticker), or fetch them
+    from Alpha Vantage if (source) is (alphavantage).
+    '''
+
+    filepath = os.path.join(DIR_DATASET_TECH_IND, "technical_indicator.csv") 
+
+    if source == "alphavantage": 
+        from source.modules.processor_features import compile_features_each_ticker 
+        from source.modules.processor_technical import get_techind_alphav 
+
+        compile_features_each_ticker( 
+            get_techind_alphav, filepath, set(tickers), load_cache=False, scheduler=alphav_scheduler, 
+        ) 
+        return 
+
+    from source.modules.processor_technical import compute_techind_talib 
+
+    # Same columns as Alpha Vantage (ticker, date, <name>_<col>), without any request. 
+    df_tickers = pd.read_csv(os.path.join(DIR_DATASET_TICKER, "ticker_dailydata.csv")) 
+    df_techind = compute_techind_talib(df_tickers.loc[df_tickers["ticker"].isin(set(tickers))]) 
+    _write_atomic(df_techind, filepath) 
+
+
+
+# %% 
+def fetch_fred(): 
+    '''Fetch the econometrics from FRED.'''
+
+    from source.modules.processor_features import compile_features_each_econometric 
+    from source.modules.processor_fred import get_econometric_fred 
+
+    filepath = os.path.join(DIR_DATASET_ECONOMIC_DATA, "econometric_fred.csv") 
+    compile_features_each_econometric(get_econometric_fred, filepath, load_cache=False) 
+
+
+
+# %% 
+def fetch_wrds(tickers:List[str], yearrange:List[int]): 
+    '''Extract the RavenPack sentiment from WRDS.'''
+
+    from source.modules.processor_wrds import extract_rp_sentiment_bulk 
+
+    # The years already extracted for the same tickers and columns are kept. 
+    extract_rp_sentiment_bulk(tickers, tuple(yearrange)) 
+
+
+
+# %% 
+def compile_fundamental(source:str=FUNDAMENTAL_SOURCE): 
+    '''Compute the extra fundamental data. Same as the (get_fundamental) notebook.'''
+
+    from source.modules.processor_fundamental import compute_extra_fundamental 
+
+    for period, abbr in (("annual", "ann"), ("quarter", "qrt")): 
+        if source == "compustat": 
+            df = manage_files.pd_read_dataset(DIR_DATASET_FUNDAMENTAL, f"financial_statement_{period}").drop(columns=["year"]) 
+        else: 
+            df = pd.read_csv(os.path.join(DIR_DATASET_FUNDAMENTAL, f"financial_statement_{period}.csv")) 
+        df_ext = compute_extra_fundamental(df) 
+        _write_atomic(df_ext, os.path.join(DIR_DATASET_FUNDAMENTAL, f"financial_statement_{abbr}_ext.csv")) 
+
+
+
+# %% 
+def build_features( 
+    date_beg:str, 
+    date_end:str, 
+    returns_lags:List[int], 
+    autocorr_lags:List[int], 
+    trim_out:float, 
+    window:int, 
+    fundamental_cols:List[str], 
+    sentiment_catcols:List[str], 
+    sentiment_numcols:List[str], 
+): 
+    '''
+    Build the consolidated feature dataset. Same steps as the (compile_features) notebook,
+    except that all the feature sources are merged in one pass.
+
+    –   The features are written as a Parquet directory, which (refresh) appends the
+        features of the new bars to, with the state it needs.
+    '''
+
+    from source.modules.processor_ticker import compute_forward_return 
+    from source.modules.processor_refresh import build_refresh_state 
+
+    # Create numerical labels. 
+    df_tickers = pd.read_csv(os.path.join(DIR_DATASET_TICKER, "ticker_dailydata.csv")) 
+    df_feature = compute_forward_return( 
+        df_tickers, returns_lags, trim_out, window=window, autocorr_lags=autocorr_lags, 
+    ) 
+
+    # Merge the feature sources. 
+    feature_steps = get_feature_steps( 
+        set(df_tickers["ticker"]), date_beg, date_end, fundamental_cols, sentiment_catcols, sentiment_numcols, 
+    ) 
+    for step in feature_steps: 
+        df_feature = step(df_feature) 
+
+    manage_files.pd_write_dataset(df_feature, os.path.join(DIR_DATASET_CONSOLIDATED, "consolidated_feature.parquet")) 
+
+    # Freeze the tail and clip bounds of the bars for the refreshes. 
+    build_refresh_state( 
+        df_tickers, returns_lags=returns_lags, trim_out=trim_out, window=window, autocorr_lags=autocorr_lags, 
+    ) 
+
+
+
+# %% 
+def get_feature_steps( 
+    tickers:Set[str], 
+    date_beg:str, 
+    date_end:str, 
+    fundamental_cols:List[str], 
+    sentiment_catcols:List[str], 
+    sentiment_numcols:List[str], 
+) -> List[Callable[[pd.DataFrame],pd.DataFrame]]: 
+    '''
+    Get the steps of (build_features) after (compute_forward_return), with the feature
+    sources loaded from the cached files between the dates.
+
+    –   The steps are the as-of merge of the quarterly reports, the exact merges of the
+        VIX, econometrics, sentiment and technical indicators, the price-to ratios, the
+        event flags, the candlesticks and the compact dtypes.
+    –   Each step only looks back within a few bars, so they can be passed to
+        (refresh_features) as the (feature_steps).
+    '''
+
+    from source.modules.processor_ticker import get_ticker_yfinance 
+    from source.modules.processor_technical import get_candlesticks 
+    from source.modules.processor_features import ( 
+        EventCalendar, add_eventflag, merge_features_with_ticker, 
+        rolling_sum_bygroup, align_report_asof, compute_price_to_ratio, aggregate_sentiment_daily, 
+        compact_feature_dtypes, 
+    ) 
+
+    # Get VIX features. 
+    df_vix = get_ticker_yfinance("^vix", date_beg, date_end)[["date", "open", "close"]] 
+
+    # Rolling sum of the last 4 quarters, in the order of the period end. 
+    infcols = ["ticker", "fiscalDateEnding"] 
+    filepath = os.path.join(DIR_DATASET_FUNDAMENTAL, "financial_statement_qrt_ext.csv") 
+    df_finstate_qrt = pd.read_csv(filepath, usecols=infcols + fundamental_cols) 
+    df_finstate_qrt = df_finstate_qrt \
+        .assign(fiscalDateEnding=pd.to_datetime(df_finstate_qrt["fiscalDateEnding"])) \
+        .sort_values(["ticker", "fiscalDateEnding"], kind="stable") 
+    df_finstate_qrt = rolling_sum_bygroup(df_finstate_qrt, groupby=["ticker"], window=4, usecols=fundamental_cols) 
+
+    # Econometrics, forward filled to every date. 
+    df_econometric = pd.read_csv(os.path.join(DIR_DATASET_ECONOMIC_DATA, "econometric_fred.csv")) \
+        .pivot(index="date", columns="econometric", values="value") \
+        .ffill() \
+        .reset_index(drop=False) 
+
+    # Sentiment of each ticker and date, streamed from the events of each year. 
+    # The daily max keeps the previous names (rp_ess), next to the other aggregates (rp_ess_mean). 
+    df_sentiment = aggregate_sentiment_daily( 
+        os.path.join(DIR_DATASET_WRDS_RAVENPACK, "dj_equities"), 
+        keep_tickers=set(tickers), 
+        yearrange=(pd.Timestamp(date_beg).year, pd.Timestamp(date_end).year), 
+        catcols=sentiment_catcols, 
+        numcols=sentiment_numcols, 
+    ) 
+    df_sentiment = df_sentiment.rename(columns={f"{c}_max": c for c in sentiment_numcols}) 
+
+    # Technical indicators. 
+    df_techind = pd.read_csv(os.path.join(DIR_DATASET_TECH_IND, "technical_indicator.csv")) 
+
+    # Compute price-to ratio. 
+    compute_cols = { 
+        "vl_pe": ("open", "vl_eps"), 
+        "vl_pe_continuing": ("open", "vl_eps_continuing"), 
+        "vl_ps": ("open", "vl_rps"), 
+    } 
+    calendar = EventCalendar.from_files() 
+
+    return [ 
+        lambda df: df.assign(date=pd.to_datetime(df["date"])), 
+        # Attach the latest quarterly report that is public on each date. 
+        lambda df: align_report_asof(df, df_finstate_qrt, usecols=fundamental_cols, merge_suffix="vl"), 
+        lambda df: merge_features_with_ticker(df, { 
+            "vix": {"data": df_vix, "on": ["date"]}, 
+            "econ": {"data": df_econometric, "on": ["date"]}, 
+            "rp": {"data": df_sentiment, "on": ["ticker", "date"], "relation": "one_to_many"}, 
+            "techind": {"data": df_techind, "on": ["ticker", "date"], "relation": "one_to_many"}, 
+        }), 
+        lambda df: compute_price_to_ratio(df, compute_cols), 
+        # Get the event date flags and the candlestick data. 
+        lambda df: add_eventflag(df, calendar), 
+        get_candlesticks, 
+        # Compact the dtypes before writing. 
+        compact_feature_dtypes, 
+    ] 
+
+
+
+# %% 
+def refresh( 
+    tickers:List[str], 
+    date_end:str, 
+    fundamental_cols:List[str], 
+    sentiment_catcols:List[str], 
+    sentiment_numcols:List[str], 
+) -> pd.DataFrame: 
+    '''
+    Append the features of the bars after the last build or refresh up to (date_end),
+    with the steps of (build_features), see (refresh_features).
+
+    –   The feature sources are loaded from the start of the tail kept in the refresh
+        state, since the features of the new bars do not look back any further.
+    –   Return the appended rows.
+    '''
+
+    from source.modules.processor_refresh import refresh_features 
+
+    state = manage_files.load_cache_pk(DIR_DATASET_CONSOLIDATED, REFRESH_STATE_FILENAME) 
+    date_beg = state["tail"]["date"].min().strftime("%Y-%m-%d") 
+
+    feature_steps = get_feature_steps(set(tickers), date_beg, date_end, fundamental_cols, sentiment_catcols, sentiment_numcols) 
+    df_feature, _ = refresh_features(tickers, date_end, feature_steps=feature_steps) 
+
+    return df_feature 
+
+
+
+# %% 
+def train_model( 
+    ticker:str, 
+    targcol:str, 
+    year_beg:int, 
+    train_size:float, 
+    n_splits:int, 
+    n_trials:int, 
+    scoring:str, 
+): 
+    '''Run the multiverse analysis and save the best pipeline. Same as the (build_ml_regression) notebook.'''
+
+    import re 
+    from sklearn.model_selection import TimeSeriesSplit 
+    from sklearn.pipeline import Pipeline as SklearnPipeline 
+    from source.modules.processor_estim import ColumnSelector, multiverse_analysis 
+
+    df_feature = pd.read_parquet(os.path.join(DIR_DATASET_CONSOLIDATED, "consolidated_feature.parquet")) 
+    df_feature["date"] = pd.to_datetime(df_feature["date"]) 
+    df_feature_proc = df_feature[(df_feature["ticker"] == ticker) & (df_feature["date"].dt.year >= year_beg)].copy() 
+
+    # Ignore the negative sign for either return and t-score. 
+    abscols = [c for c in df_feature.columns if re.match(r"\w+_c2c_lag\d{1,4}(_autolag\d{1,2})?$", c)] 
+    df_feature_proc.loc[:, abscols] = df_feature_proc.loc[:, abscols].abs() 
+
+    # Define the training and label dataset, then split by time. 
+    targetcols = [c for c in df_feature.columns if re.match(r"\w+_c2c_lag\d{1,4}$", c)] 
+    usecols = df_feature.columns.difference(targetcols) 
+    X, y = df_feature_proc.loc[:, usecols], df_feature_proc.loc[:, targcol] 
+
+    split_frm = int(X.shape[0] * train_size) 
+    X_train, y_train = X.iloc[:split_frm], y.iloc[:split_frm] 
+    timeseries_cv = list(TimeSeriesSplit(n_splits=n_splits).split(X_train)) 
+
+    # Perform multiverse analysis. The scoring is negated for errors, so take the absolute. 
+    df_performances = multiverse_analysis( 
+        X_train, y_train, cv=timeseries_cv, n_trials=n_trials, scoring=scoring, verbose=0, 
+    ) 
+    df_performances["score_avg"] = df_performances["score_avg"].abs() 
+    df_performances = df_performances.sort_values(["score_avg", "score_std"], ascending=False, ignore_index=True) 
+    df_performances["score_intv0025"] = df_performances["score_avg"] - (df_performances["score_std"] * 2) 
+    df_performances["score_intv0975"] = df_performances["score_avg"] + (df_performances["score_std"] * 2) 
+
+    manage_files.save_cache_pk(DIR_MLMODEL_MLPERFORMANCE, "regression_performance.pickle", df_performances) 
+
+    # Save the pipeline of the best score. The errors are the lower the better. 
+    best = df_performances["score_avg"].idxmin() if scoring.startswith("neg_") else df_performances["score_avg"].idxmax() 
+    mlpipe_estim = SklearnPipeline([ 
+        ("select_col", ColumnSelector(var_proc=df_performances.loc[best, "feat_name"])), 
+        ("estimator", df_performances.loc[best, "estimator"]), 
+    ]) 
+    manage_files.save_version_pk(DIR_MLMODEL_MLESTIM, "mlpipe_estim", mlpipe_estim) 
+
+
+
+# %% 
+def compute_rule_signal(df:pd.DataFrame) -> pd.Series: 
+    '''Long on the bullish MACD and short on the bearish MACD. Same rules as the (backtesting_framework) notebook.'''
+
+    macd_hist, macd_line, macd_sign = \
+        df["techind_macd_MACD_Hist"], df["techind_macd_MACD"], df["techind_macd_MACD_Signal"] 
+
+    boo_condition_longs = (macd_hist > 0) & (macd_hist < 1) & (macd_line > 0.15) & (macd_sign > 0.15) 
+    boo_condition_short = (macd_hist < 0) & (macd_hist > -1) & (macd_line < -0.15) & (macd_sign < -0.15) 
+
+    # The trade will be executed on the next day at opening price. 
+    return pd.Series( 
+        np.select([boo_condition_longs, boo_condition_short], [1, -1], default=0), index=df.index, name="signal", 
+    ) 
+
+
+
+# %% 
+def run_backtest( 
+    tickers:List[str], 
+    date_beg:str, 
+    date_end:str, 
+    cash:float, 
+    n_positions:int, 
+    min_positions:int, 
+    include_short:bool, 
+    topn:int, 
+    membership:Optional[str]=None, 
+): 
+    '''
+    Backtest the rule-based strategy and save the (pyfolio) items.
+
+    –   With a (membership) snapshot in (DIR_DATASET_UTIL), the tickers only get a
+        signal on the dates they were members of the index.
+    '''
+
+    import backtrader as bt 
+    from source.modules.backtesting import FixedCommisionScheme, SignalData, RuleBasedStrategy 
+
+    defcols = ["ticker", "date", "open", "high", "low", "volume", "close"] 
+    getcols = ["techind_macd_MACD_Hist", "techind_macd_MACD", "techind_macd_MACD_Signal"] 
+
+    df_feature = manage_files.pd_read_dataset( 
+        DIR_DATASET_CONSOLIDATED, "consolidated_feature.parquet", columns=defcols + getcols, tickers=tickers, 
+    ) 
+    df_feature["date"] = pd.to_datetime(df_feature["date"]) 
+    df_feature["signal"] = compute_rule_signal(df_feature) 
+
+    if membership is not None: 
+        from source.modules.processor_membership import IndexMembership 
+
+        member = IndexMembership.load(filename=membership).is_member(df_feature["ticker"].to_numpy(), df_feature["date"].to_numpy()) 
+        df_feature["signal"] = df_feature["signal"].where(member, 0) 
+
+    # Required by (BackTrader) to rename the date column as (datetime). 
+    df_feature = df_feature \
+        .rename(columns={"date": "datetime"}) \
+        .set_index("datetime") \
+        .sort_index() \
+        .loc[date_beg:date_end, :] 
+
+    cerebro = bt.Cerebro() 
+    cerebro.broker.addcommissioninfo(FixedCommisionScheme()) 
+    cerebro.broker.setcash(cash) 
+
+    for ticker in tickers: 
+        df_data = df_feature[df_feature["ticker"] == ticker] 
+        cerebro.adddata(SignalData(dataname=df_data), name=ticker) 
+
+    cerebro.addanalyzer(bt.analyzers.PyFolio, _name="pyfolio") 
+    cerebro.addstrategy( 
+        RuleBasedStrategy, n_positions=n_positions, min_positions=min_positions, 
+        include_short=include_short, topn=topn, verbose=False, log_file=os.path.join(DIR_DATASET, "bt_log.csv"), 
+    ) 
+
+    results = cerebro.run() 
+    print(f"Final Portfolio Value: {cerebro.broker.getvalue():,.2f}") 
+
+    returns, positions, transactions, gross_lev = results[0].analyzers.getbyname("pyfolio").get_pf_items() 
+    manage_files.save_cache_pk(DIR_MLMODEL_MLPERFORMANCE, "backtest_pyfolio.pickle", dict( 
+        returns=returns, positions=positions, transactions=transactions, gross_lev=gross_lev, 
+    )) 
+
+
+
+# %% 
+def _write_atomic(df:pd.DataFrame, filepath:str): 
+    '''Write to a temporary file, then rename, so a failed stage never leaves a partial output.'''
+
+    manage_files._get_ready_for_file_operation(os.path.dirname(filepath)) 
+
+    tmppath = f"{filepath}.tmp" 
+    if filepath.endswith(".parquet"): 
+        df.to_parquet(tmppath, index=False) 
+    else: 
+        df.to_csv(tmppath, index=False) 
+    os.replace(tmppath, filepath) 
+
+
+
+# %% 
+# Functions of (compile_features_each_ticker), which the fetch stages run from (processor_features). 
+_COMPILE_EACH_TICKER = [ 
+    "source.modules.processor_features.compile_features_each_ticker", 
+    "source.modules.processor_features.get_partition_dir", 
+    "source.modules.processor_features.resume_partitions", 
+] 
+
+
+
+# %% 
+def get_stages( 
+    tickers:Optional[List[str]]=None, 
+    daterange:List[str]=list(TICKER_DATE_COLLECT), 
+    fundamental_source:str=FUNDAMENTAL_SOURCE, 
+    technind_source:str=TECHNIND_SOURCE, 
+    membership:Optional[str]=TICKER_MEMBERSHIP, 
+) -> List[Stage]: 
+    '''
+    Declare the stages of the pipeline, from fetching the data to the backtest.
+
+    –   Unless (tickers) are given, the tickers are all the members of the (membership)
+        snapshot between the dates, including those removed since, or (TICKER_TO_COLLECT)
+        without a snapshot.
+    –   The financial statements are fetched from Alpha Vantage, or extracted from
+        Compustat if (fundamental_source) is (compustat).
+    –   The technical indicators are computed from the daily bars, or fetched from
+        Alpha Vantage if (technind_source) is (alphavantage).
+    '''
+
+    date_beg, date_end = daterange 
+    yearrange = [int(date_beg[:4]), int(date_end[:4])] 
+
+    if tickers is None and membership is not None: 
+        from source.modules.processor_membership import IndexMembership 
+        tickers = sorted(IndexMembership.load(filename=membership).universe(date_beg, date_end).difference(TICKER_TO_EXCLUDE)) 
+    elif tickers is None: 
+        tickers = sorted(TICKER_TO_COLLECT.difference(TICKER_TO_EXCLUDE)) 
+
+    if fundamental_source == "compustat": 
+        stage_fundamental = Stage( 
+            "fetch_fundamental", fetch_compustat, 
+            outputs=[ 
+                os.path.join(DIR_DATASET_FUNDAMENTAL, f"financial_statement_{period}", f"year={y}") 
+                for period in ("annual", "quarter") for y in range(yearrange[0], yearrange[1] + 1) 
+            ], 
+            params=dict(tickers=tickers, yearrange=yearrange), 
+            config=["COMPUSTAT_FILTERS", "COMPUSTAT_TO_ALPHAV"], 
+            modules=["source.modules.processor_wrds"], 
+        ) 
+    else: 
+        stage_fundamental = Stage( 
+            "fetch_fundamental", fetch_fundamental, 
+            outputs=[ 
+                os.path.join(DIR_DATASET_FUNDAMENTAL, "financial_statement_annual.csv"), 
+                os.path.join(DIR_DATASET_FUNDAMENTAL, "financial_statement_quarter.csv"), 
+            ], 
+            params=dict(tickers=tickers), 
+            modules=[ 
+                "source.modules.processor_fundamental.get_fundamental_alphav", 
+                *_COMPILE_EACH_TICKER, 
+            ], 
+        ) 
+
+    if technind_source == "alphavantage": 
+        stage_technical = Stage( 
+            "fetch_technical", fetch_technical, 
+            outputs=[os.path.join(DIR_DATASET_TECH_IND, "technical_indicator.csv")], 
+            params=dict(tickers=tickers, source=technind_source), 
+            config=["TECHNIND_FEATURES", "TICKER_DATE_COLLECT"], 
+            modules=["source.modules.processor_technical.get_techind_alphav", *_COMPILE_EACH_TICKER], 
+        ) 
+    else: 
+        stage_technical = Stage( 
+            "fetch_technical", fetch_technical, deps=["fetch_ticker"], 
+            outputs=[os.path.join(DIR_DATASET_TECH_IND, "technical_indicator.csv")], 
+            params=dict(tickers=tickers, source=technind_source), 
+            config=["TECHNIND_FEATURES"], 
+            modules=[ 
+                "source.modules.processor_technical.compute_techind_talib", 
+                "source.modules.pipeline._write_atomic", 
+            ], 
+        ) 
+
+    filepath_feature = os.path.join(DIR_DATASET_CONSOLIDATED, "consolidated_feature.parquet") 
+    filepaths_event = [os.path.join(d, f) for f, d in MERGE_EVENT_FILENAMES.items()] 
+
+    return [ 
+        # Fetch. The stages draw from different APIs, so they run in parallel. 
+        Stage( 
+            "fetch_ticker", fetch_ticker, 
+            outputs=[os.path.join(DIR_DATASET_TICKER, "ticker_dailydata.csv")], 
+            params=dict(tickers=tickers, date_beg=date_beg, date_end=date_end), 
+            modules=["source.modules.processor_ticker.get_ticker_yfinance", *_COMPILE_EACH_TICKER], 
+        ), 
+        stage_fundamental, 
+        stage_technical, 
+        Stage( 
+            "fetch_fred", fetch_fred, 
+            outputs=[os.path.join(DIR_DATASET_ECONOMIC_DATA, "econometric_fred.csv")], 
+            config=["ECONOMIC_FRED_FEATURES", "TICKER_DATE_COLLECT"], 
+            modules=[ 
+                "source.modules.processor_fred", 
+                "source.modules.processor_features.compile_features_each_econometric", 
+                "source.modules.processor_features.get_partition_dir", 
+                "source.modules.processor_features.resume_partitions", 
+            ], 
+        ), 
+        Stage( 
+            "fetch_wrds", fetch_wrds, 
+            outputs=[os.path.join(DIR_DATASET_WRDS_RAVENPACK, "dj_equities", f"year={y}") for y in range(yearrange[0], yearrange[1] + 1)], 
+            params=dict(tickers=tickers, yearrange=yearrange), 
+            config=["WRDS_RP_COLUMNS"], 
+            modules=["source.modules.processor_wrds"], 
+        ), 
+
+        # Compile. 
+        Stage( 
+            "compile_fundamental", compile_fundamental, deps=["fetch_fundamental"], 
+            outputs=[ 
+                os.path.join(DIR_DATASET_FUNDAMENTAL, "financial_statement_ann_ext.csv"), 
+                os.path.join(DIR_DATASET_FUNDAMENTAL, "financial_statement_qrt_ext.csv"), 
+            ], 
+            params=dict(source=fundamental_source), 
+            config=["FINANCIAL_KEEP_FEATURES", "FINANCIAL_COMPUTE_CHANGE", "FINANCIAL_COMPUTE_COMBINATION", "FINANCIAL_COMPUTE_RATIO"], 
+            modules=["source.modules.processor_fundamental", "source.modules.pipeline._write_atomic"], 
+        ), 
+
+        # Features. 
+        Stage( 
+            "features", build_features, 
+            deps=["fetch_ticker", "compile_fundamental", "fetch_technical", "fetch_fred", "fetch_wrds"], 
+            outputs=[filepath_feature, os.path.join(DIR_DATASET_CONSOLIDATED, REFRESH_STATE_FILENAME)], 
+            params=dict( 
+                date_beg=date_beg, date_end=date_end, returns_lags=[1], autocorr_lags=[1,2,3], 
+                trim_out=0.0001, window=252, fundamental_cols=["eps", "eps_continuing", "rps"], 
+                sentiment_catcols=["topic", "group", "type", "sub_type", "category"], 
+                sentiment_numcols=[ 
+                    "relevance", "ess", "aes", "aev", "ens", "ens_similarity_gap", 
+                    "css", "nip", "peq", "bee", "bmq", "bam", "bca", "ber", "anl_chg", "mcq", 
+                ], 
+            ), 
+            config=[ 
+                "MERGE_EVENT_FILENAMES", "CANDLESTICK_FEATURES", 
+                "FINANCIAL_PUBLICATION_LAG", "FINANCIAL_REPORT_TOLERANCE", 
+                "RP_EVENT_WEIGHTCOL", "FEATURE_DTYPE_SCHEMA", 
+            ], 
+            modules=[ 
+                "source.modules.processor_ticker", "source.modules.processor_technical", 
+                "source.modules.processor_features", "source.modules.processor_refresh", 
+                "source.modules.pipeline.get_feature_steps", 
+            ], 
+            inputs=filepaths_event, 
+        ), 
+
+        # Train. 
+        Stage( 
+            "train", train_model, deps=["features"], 
+            outputs=[os.path.join(DIR_MLMODEL_MLPERFORMANCE, "regression_performance.pickle")], 
+            params=PIPELINE_TRAIN, 
+            config=["EXPERIMENT_MODEL_RG", "EXPERIMENT_COMPS", "PARAM_SEED"], 
+            modules=["source.modules.processor_estim"], 
+        ), 
+
+        # Backtest. 
+        Stage( 
+            "backtest", run_backtest, deps=["features"], 
+            outputs=[os.path.join(DIR_MLMODEL_MLPERFORMANCE, "backtest_pyfolio.pickle")], 
+            params=dict(PIPELINE_BACKTEST, date_end=date_end), 
+            modules=["source.modules.backtesting", "source.modules.processor_membership", "source.modules.pipeline.compute_rule_signal"], 
+            inputs=[os.path.join(DIR_DATASET_UTIL, PIPELINE_BACKTEST["membership"])] if PIPELINE_BACKTEST.get("membership") else list(), 
+        ), 
+    ] 
+
+
+
+# %% 
+if __name__ == "__main__": 
+    parser = argparse.ArgumentParser(description="Run the pipeline stages whose inputs have changed.") 
+    parser.add_argument("targets", nargs="*", help="Stages to run with their upstream stages. All if empty.") 
+    parser.add_argument("--force", action="store_true", help="Rerun the stages even if their key is unchanged.") 
+    parser.add_argument("--workers", type=int, default=PIPELINE_MAX_WORKERS, help="Number of stages to run at the same time.") 
+    parser.add_argument("--trace", action="store_true", help="Record the tracing spans of the run to a new trace file.") 
+    parser.add_argument("--refresh", metavar="DATE_END", help="Append the features of the new bars up to the date instead of running the stages.") 
+    args = parser.parse_args() 
+
+    if args.trace and not tracer.enabled: 
+        tracer.enable() 
+
+    if args.refresh: 
+        # Refresh with the tickers and parameters of the stages that built the features. 
+        stages = {s.name: s for s in get_stages()} 
+        params = stages["features"].params 
+        refresh( 
+            stages["fetch_ticker"].params["tickers"], args.refresh, 
+            params["fundamental_cols"], params["sentiment_catcols"], params["sentiment_numcols"], 
+        ) 
+        sys.exit(0) 
+
+    pipeline = Pipeline(get_stages(), max_workers=args.workers) 
+    df_report = pipeline.run(args.targets or None, force=args.force) 
+    print(df_report.drop(columns=["key"]).to_string(index=False)) 
+
+    if tracer.enabled: 
+        print(f"Export the spans with (python -m source.modules.tracer {tracer.filepath}).") 
+
+    sys.exit(int(df_report["status"].isin(["failed", "blocked"]).any())) 
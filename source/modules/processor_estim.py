@@ -1,20 +1,16 @@
 # %% 
 # Python modules. 
-import re, scipy, optuna 
+import re 
 import numpy as np 
 import pandas as pd 
 from typing import List, Dict, Any, Union 
-import xgboost as xgb 
-from sklearn.linear_model import ElasticNet 
 from sklearn.base import BaseEstimator, TransformerMixin 
 from sklearn.utils.validation import check_is_fitted 
-from feature_engine.encoding import OneHotEncoder 
 from sklearn.model_selection import GridSearchCV 
 from sklearn.pipeline import Pipeline 
-from feature_engine.variable_manipulation import _check_input_parameter_variables 
 
-# For clearing safe warnings. Not important. 
-from IPython.display import clear_output 
+# Custom modules. 
+from source.modules.tracer import traced 
 
 # Custom configs. 
 from source.config_py.config import PARAM_SEED, EXPERIMENT_COMPS, EXPERIMENT_MODEL_RG 
@@ -70,6 +66,7 @@ def search_opt(
     ''' 
     # Setup the optimizer. 
     if bayes: 
+        import optuna.integration 
         search_cv = optuna.integration.OptunaSearchCV(
             estimator, param_dist, cv=cv, n_trials=n_trials, 
             scoring=scoring, refit=True, timeout=600, verbose=verbose, 
@@ -100,6 +97,7 @@ def search_opt(
 
 
 # %%
+@traced() 
 def multiverse_analysis(
     X:pd.DataFrame, 
     y:pd.DataFrame,
@@ -114,6 +112,14 @@ def multiverse_analysis(
     To perform multiverse analysis for various combination of components and models. 
     '''
 
+    # Import on use, since they are slow to import. The (eval) of the model and 
+    # parameter strings below needs (optuna), (xgb) and (ElasticNet) in scope. 
+    import optuna 
+    import xgboost as xgb 
+    from IPython.display import clear_output 
+    from feature_engine.encoding import OneHotEncoder 
+    from sklearn.linear_model import ElasticNet 
+
     colnames = ["est_names", "estimator", "component", "score_avg", "score_std"]
 
     # To track the model performance for each combination of features and models. 
@@ -1,14 +1,20 @@
 # Python module. 
-import os, re, functools 
+import os, re, shutil, fnmatch, functools 
+import numpy as np 
 import pandas as pd 
-from typing import Callable, Set, Tuple, List, Dict, Optional 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor 
+from typing import Any, Callable, Iterator, Set, Tuple, List, Dict, Optional, Union 
 
 # Custom configs. 
 from source.modules.manage_files import ManageFiles 
+from source.modules.fetch_scheduler import FetchScheduler 
+from source.modules.tracer import traced 
 from source.config_py.config import (
     MERGE_FEATURE_FILENAMES, MERGE_EVENT_FILENAMES, TICKER_DATE_COLLECT, 
     TICKER_TO_COLLECT, TICKER_TO_EXCLUDE, ECONOMIC_FRED_FEATURES, 
-    FINANCIAL_INCOME_STATES, 
+    FINANCIAL_INCOME_STATES, FINANCIAL_PUBLICATION_LAG, FINANCIAL_REPORT_TOLERANCE, 
+    RP_EVENT_CATCOLS, RP_EVENT_NUMCOLS, RP_EVENT_WEIGHTCOL, RP_EVENT_CHUNK_SIZE, 
+    FEATURE_DTYPE_SCHEMA, 
 )
 
 
@@ -24,95 +30,131 @@ year_beg, year_end = int(date_beg[:4]), int(date_end[:4])
 
 
 # %% 
+@traced() 
 def compile_features_each_ticker(
     compile_func:Callable, 
     filepath:str, 
     ticker_to_collect:Set[str]=TICKER_TO_COLLECT, 
     ticker_to_exclude:Set[str]=TICKER_TO_EXCLUDE, 
     load_cache:bool=True, 
+    scheduler:Optional[FetchScheduler]=None, 
     **kwargs, 
 ) -> pd.DataFrame: 
 
-    '''Consolidate the features for each ticker.'''
+    '''
+    Consolidate the features for each ticker. 
+
+    Each ticker is checkpointed as its own partition (ticker=XYZ/part.parquet) next to 
+    the (filepath), so resuming only lists the partitions. The partitions are compacted 
+    into (filepath) at the end. 
+
+    Pass a (scheduler) such as (alphav_scheduler) to fetch the tickers concurrently 
+    within its rate budget. Otherwise, the tickers are fetched one at a time. 
+    '''
+
+    partdir = get_partition_dir(filepath) 
 
-    cache_exist = os.path.isfile(filepath) 
-    df_compiled = pd.DataFrame() 
-    
-    # Load cache if users want to. 
-    compiled_ticker = set() 
-    if load_cache and cache_exist: 
-        df_compiled = pd.read_csv(filepath) 
-        compiled_ticker = set(df_compiled["ticker"].to_list()) 
+    # Resume from the completed partitions if users want to load the cache. 
+    compiled_ticker = resume_partitions(filepath, partdir, "ticker", load_cache) 
 
     # Track the total number of ticker to collect. 
     ticker_to_collect = ticker_to_collect.difference(ticker_to_exclude).difference(compiled_ticker) 
-    save_round, max_len = 5, len(ticker_to_collect) - 1 
 
     # Modify the default arguments for the (rank_func). 
     func = functools.partial(compile_func, **kwargs) 
 
-    for i, ticker in enumerate(ticker_to_collect): 
-        # Skip the API call if users want to load the cache and the ticker already exists. 
-        if compiled_ticker and ticker in compiled_ticker: 
-            print(f"Data already exists. Skipped ({ticker}).") 
-            continue 
-        
-        # Get feature data for each ticker and consolidate them. 
-        df = func(ticker) 
-        df_compiled = pd.concat([df_compiled, df], axis="index", join="outer", ignore_index=True) 
+    # Get feature data for each ticker and checkpoint it as its own partition. 
+    results = scheduler.map(func, ticker_to_collect) if scheduler else ((t, func(t)) for t in ticker_to_collect) 
+    for ticker, df in results: 
+        manage_files.pd_write_partition(df, partdir, "ticker", ticker) 
 
-        # Save the data at every N round iteration. 
-        if i % save_round == 0 or max_len - i < save_round: 
-            df_compiled.to_csv(filepath, index=False) 
-            print(f"Save to ({filepath}).") 
+    # Consolidate the partitions. Only rewrite the file when there are new partitions. 
+    if not ticker_to_collect and os.path.isfile(filepath): 
+        return manage_files.pd_read_partitions(partdir, "ticker") 
 
-    return df_compiled 
+    return manage_files.compact_partitions(partdir, filepath, "ticker") 
 
 
 
 # %%
+@traced() 
 def compile_features_each_econometric(
     compile_func:Callable, 
     filepath:str, 
     econometric_to_collect:Dict[str,Dict]=ECONOMIC_FRED_FEATURES, 
     load_cache:bool=True, 
+    scheduler:Optional[FetchScheduler]=None, 
     **kwargs, 
 ) -> pd.DataFrame: 
 
-    '''Consolidate the features for each econometric.'''
+    '''
+    Consolidate the features for each econometric. 
+
+    Each econometric is checkpointed as its own partition (econometric=XYZ/part.parquet) 
+    next to the (filepath), so resuming only lists the partitions. The partitions are 
+    compacted into (filepath) at the end. 
+
+    Pass a (scheduler) to fetch the econometrics concurrently within its rate budget. 
+    '''
+
+    partdir = get_partition_dir(filepath) 
 
-    cache_exist = os.path.isfile(filepath) 
-    df_compiled = pd.DataFrame() 
-    
-    # Load cache if users want to. 
-    compiled_econometric = set() 
-    if load_cache and cache_exist: 
-        df_compiled = pd.read_csv(filepath) 
-        compiled_econometric = set(df_compiled["econometric"].to_list()) 
+    # Resume from the completed partitions if users want to load the cache. 
+    compiled_econometric = resume_partitions(filepath, partdir, "econometric", load_cache) 
 
     # Track the total number of econometric to collect. 
     econometric_names = set(econometric_to_collect.keys()).difference(compiled_econometric) 
-    save_round, max_len = 5, len(econometric_names) - 1 
 
     # Modify the default arguments for the (rank_func). 
     func = functools.partial(compile_func, **kwargs) 
 
-    for i, (econometric, parameters) in enumerate(econometric_to_collect.items()): 
-        # Skip the API call if users want to load the cache and the econometric already exists. 
-        if compiled_econometric and econometric in compiled_econometric: 
-            print(f"Data already exists. Skipped ({econometric}).") 
-            continue 
-        
-        # Get feature data for each econometric and consolidate them. 
-        df = func(econometric, parameters) 
-        df_compiled = pd.concat([df_compiled, df], axis="index", join="outer", ignore_index=True) 
+    # Skip the API call if users want to load the cache and the econometric already exists. 
+    for econometric in compiled_econometric.intersection(econometric_to_collect.keys()): 
+        print(f"Data already exists. Skipped ({econometric}).") 
+
+    # Get feature data for each econometric and checkpoint it as its own partition. 
+    fetch = lambda econometric: func(econometric, econometric_to_collect[econometric]) 
+    results = scheduler.map(fetch, econometric_names) if scheduler else ((e, fetch(e)) for e in econometric_names) 
+    for econometric, df in results: 
+        manage_files.pd_write_partition(df, partdir, "econometric", econometric) 
+
+    # Consolidate the partitions. Only rewrite the file when there are new partitions. 
+    if not econometric_names and os.path.isfile(filepath): 
+        return manage_files.pd_read_partitions(partdir, "econometric") 
+
+    return manage_files.compact_partitions(partdir, filepath, "econometric") 
+
 
-        # Save the data at every N round iteration. 
-        if i % save_round == 0 or max_len - i < save_round:             
-            df_compiled.to_csv(filepath, index=False) 
-            print(f"Save to ({filepath}).") 
 
-    return df_compiled 
+# %% 
+def get_partition_dir(filepath:str) -> str: 
+    '''Get the checkpoint directory for the partitions of a consolidated file.''' 
+
+    return f"{os.path.splitext(filepath)[0]}_partitions" 
+
+
+
+# %% 
+def resume_partitions(filepath:str, partdir:str, partition_col:str, load_cache:bool=True) -> Set[str]: 
+    '''Get the completed partitions, or clear them if users do not want to load the cache.''' 
+
+    # Start over if users do not want to load the cache. 
+    if not load_cache and os.path.isdir(partdir): 
+        shutil.rmtree(partdir) 
+
+    compiled = manage_files.list_partitions(partdir, partition_col) 
+
+    # Split a previously consolidated file into partitions once so that it can be resumed. 
+    if load_cache and not compiled and os.path.isfile(filepath): 
+        format = "parquet" if filepath.endswith(".parquet") else "csv" 
+        df = manage_files.pd_read_from(os.path.dirname(filepath), os.path.basename(filepath), format=format) 
+
+        for partition_val, df_part in df.groupby(partition_col, sort=False): 
+            manage_files.pd_write_partition(df_part, partdir, partition_col, partition_val) 
+
+        compiled = manage_files.list_partitions(partdir, partition_col) 
+
+    return compiled 
 
 
 
@@ -133,57 +175,413 @@ def concat_eventdates(event_filenames:Dict[str,str]=MERGE_EVENT_FILENAMES) -> pd
 
 
 # %% 
-def add_eventflag(df:pd.DataFrame, eventdates:pd.DataFrame) -> pd.DataFrame:
+class EventCalendar(): 
+    def __init__(self, events:Dict[str,Any]): 
+        '''
+        Index of event dates to flag the ticker data with.
+
+        –   Each event set is stored as a sorted array of unique int64 days.
+        –   The union of all event days keeps a bitmask of the events on each day,
+            so all the flags are found with one (searchsorted) over the dates.
+        '''
+
+        self.events = {name: np.unique(_to_days(pd.Series(dates).dropna())) for name, dates in events.items()} 
+        self.names = list(self.events.keys()) 
+
+        # Set the bit of each event on the union of days. Every 64 events take one word. 
+        self.days = np.unique(np.concatenate([np.empty(0, dtype=np.int64)] + list(self.events.values()))) 
+        self.nwords = max(1, -(-len(self.names) // 64)) 
+        self.bitmask = np.zeros((len(self.days), self.nwords), dtype=np.uint64) 
+        for i, days in enumerate(self.events.values()): 
+            self.bitmask[np.searchsorted(self.days, days), i // 64] |= np.uint64(1 << (i % 64)) 
+
+
+    @classmethod 
+    def from_files(cls, event_filenames:Dict[str,str]=MERGE_EVENT_FILENAMES) -> "EventCalendar": 
+        '''Build from the event files. Each column of each file is an event set.'''
+
+        events = dict() 
+        for filename, dirpath in event_filenames.items(): 
+            df_dates = manage_files.pd_read_from(dirpath, filename) 
+            events.update({colname: df_dates[colname] for colname in df_dates.columns}) 
+
+        return cls(events) 
+
+
+    def flags(self, dates:pd.Series, bitpack:bool=False) -> pd.DataFrame: 
+        '''
+        Flag the dates with all the events.
+
+        –   Return an (int8) column (event_name) for each event,
+        –   or if (bitpack) is True, the event bits packed into (event_bits_0, ...),
+            where bit (i) is the event (self.names[i]). Use (unpack) to get the flags back.
+        '''
+
+        days = _to_days(dates) 
+
+        # Match the days on the union of event days in one pass. 
+        pos = np.searchsorted(self.days, days).clip(0, max(len(self.days) - 1, 0)) 
+        found = self.days[pos] == days if len(self.days) else np.zeros(len(days), dtype=bool) 
+        bits = np.where(found[:, None], self.bitmask[pos] if len(self.days) else 0, np.uint64(0)).astype(np.uint64) 
+
+        if bitpack: 
+            return pd.DataFrame( 
+                {f"event_bits_{w}": bits[:, w].astype(self._get_word_dtype(w)) for w in range(self.nwords)}, 
+                index=pd.RangeIndex(len(days)), 
+            ) 
+
+        return pd.DataFrame({ 
+            f"event_{name}": ((bits[:, i // 64] >> np.uint64(i % 64)) & np.uint64(1)).astype(np.int8) 
+            for i, name in enumerate(self.names) 
+        }, index=pd.RangeIndex(len(days))) 
+
+
+    def unpack(self, df_bits:pd.DataFrame) -> pd.DataFrame: 
+        '''Unpack the (event_bits_*) columns into an (int8) column for each event.'''
+
+        return pd.DataFrame({ 
+            f"event_{name}": ((df_bits[f"event_bits_{i // 64}"].to_numpy().astype(np.uint64) >> np.uint64(i % 64)) & np.uint64(1)).astype(np.int8) 
+            for i, name in enumerate(self.names) 
+        }) 
+
+
+    def _get_word_dtype(self, w:int) -> np.dtype: 
+        '''Get the smallest unsigned dtype that holds the event bits of the word.'''
+
+        nbits = min(64, len(self.names) - w * 64) 
+        return np.dtype(next(t for t in (np.uint8, np.uint16, np.uint32, np.uint64) if np.iinfo(t).bits >= nbits)) 
+
+
+
+# %% 
+def _to_days(dates:pd.Series) -> np.ndarray: 
+    '''Convert the dates (str or datetime) to int64 days. Parse only the distinct values.'''
+
+    codes, values = pd.factorize(pd.Series(dates)) 
+    values = pd.to_datetime(values).to_numpy(dtype="datetime64[D]").view(np.int64) 
+    return np.append(values, np.iinfo(np.int64).min)[codes] 
+
+
+
+# %% 
+@traced() 
+def add_eventflag(df:pd.DataFrame, eventdates:Union[pd.DataFrame,EventCalendar], bitpack:bool=False) -> pd.DataFrame: 
     '''Add flags for each event according to matching rows in ticker data.'''
 
-    for colname in eventdates.columns: 
-        df[f"event_{colname}"] = 0 
+    # Accept the padded dataframe of (concat_eventdates) as well. 
+    if not isinstance(eventdates, EventCalendar): 
+        eventdates = EventCalendar({colname: eventdates[colname] for colname in eventdates.columns}) 
 
-        # Ensure the datetime is converted to str to be able to match dates. 
-        df["date"], eventdates[colname] = df["date"].astype(str), eventdates[colname].astype(str) 
-        
-        # Flag matching dates with 1. 
-        boo_dates = df["date"].isin(eventdates[colname].values) 
-        df.loc[boo_dates, f"event_{colname}"] = 1 
+    df_flags = eventdates.flags(df["date"], bitpack=bitpack) 
+    df_flags.index = df.index 
 
-    return df 
+    # Replace the existing flags, then add all of them at once. 
+    df = df.drop(columns=df_flags.columns, errors="ignore") 
+    return pd.concat([df, df_flags], axis="columns") 
 
 
 
 # %%
+@traced() 
 def concat_eachyear(
     dirpath:str, 
     keep_tickers:Set[str]=TICKER_TO_COLLECT, 
     keep_cols:Optional[List[str]]=list(), 
     drop_cols:Optional[List[str]]=list(), 
-    yearrange:Tuple[int,int]=(year_beg, year_end) 
-) -> pd.DataFrame: 
-    '''Concat all the datasets from different years.''' 
+    yearrange:Tuple[int,int]=(year_beg, year_end), 
+    max_workers:Optional[int]=None, 
+    use_processes:bool=True, 
+    output_dir:Optional[str]=None, 
+) -> Union[pd.DataFrame,str]: 
+    '''
+    Concat all the datasets from different years.
+
+    –   The year files are read in parallel by a process pool (or a thread pool if
+        (use_processes) is False). Each reader only keeps the (keep_cols) and (keep_tickers),
+        so the full year is never held in memory at once.
+    –   The years are concatenated once, in order.
+    –   If (output_dir) is given, each reader writes its year to (output_dir/year=YYYY/)
+        instead, and the (output_dir) is returned without holding any year in memory.
+    '''
 
-    df_allyear = pd.DataFrame() 
     keep_tickers = keep_tickers.difference(TICKER_TO_EXCLUDE) 
 
     # Define the range of year to get the data from. 
     year_beg, year_end = yearrange 
     yearrange = set(range(year_beg, year_end + 1, 1)) 
 
-    # Read, filter tickers and columns, then consolidate all datasets. 
+    # Extract the year from the filename to check if it's within the year range. 
+    dict_files = dict() 
     for filename in os.listdir(dirpath): 
-        
-        # Extract the year from the filename to check if it's within the year range. 
         found_year = re.findall(r".+_(\d{4})\.\w+$", filename) 
-
         if found_year and int(found_year[0]) in yearrange: 
-            df_peryear = manage_files.pd_read_from(dirpath, filename) 
+            dict_files[int(found_year[0])] = filename 
+
+    # Read, filter tickers and columns in parallel. 
+    reader = functools.partial( 
+        _read_year_file, dirpath=dirpath, keep_tickers=keep_tickers, 
+        keep_cols=keep_cols, drop_cols=drop_cols, output_dir=output_dir, 
+    ) 
+    years = sorted(dict_files) 
+    executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor 
+    with executor(max_workers=max_workers) as pool: 
+        results = list(pool.map(reader, [dict_files[y] for y in years], years)) 
+
+    if output_dir is not None: 
+        print(f"Wrote ({sum(results):,}) rows for ({len(years)}) years to ({output_dir}).") 
+        return output_dir 
+
+    # Consolidate the datasets for each year once. 
+    ls_df = [df for df in results if not df.empty] 
+    return pd.concat(ls_df, axis="index") if ls_df else pd.DataFrame() 
+
+
+
+# %% 
+def _read_year_file( 
+    filename:str, 
+    year:int, 
+    dirpath:str, 
+    keep_tickers:Set[str], 
+    keep_cols:List[str], 
+    drop_cols:List[str], 
+    output_dir:Optional[str]=None, 
+    chunksize:int=500000, 
+) -> Union[pd.DataFrame,int]: 
+    '''Read one year file with only the needed columns and tickers. Write it to (output_dir) if given.'''
+
+    filepath = os.path.join(dirpath, filename) 
+    print(f"Read from ({filename})") 
+
+    # Columns to read. The (ticker) column is needed for filtering even if it is not kept. 
+    if filename.endswith(".parquet"): 
+        import pyarrow.parquet as pq 
+        allcols = pq.read_schema(filepath).names 
+    else: 
+        allcols = pd.read_csv(filepath, nrows=0).columns.to_list() 
+    usecols = list(keep_cols) if keep_cols else [c for c in allcols if c not in drop_cols] 
+    readcols = usecols if "ticker" in usecols else usecols + ["ticker"] 
+
+    if filename.endswith(".parquet"): 
+        # Push the column selection and ticker filter down to the Parquet row groups. 
+        df_peryear = manage_files.pd_read_dataset(dirpath, filename, columns=readcols, tickers=keep_tickers) 
+    else: 
+        # Filter each chunk, so that only the kept rows are held in memory. 
+        ls_chunk = [ 
+            chunk[chunk["ticker"].isin(keep_tickers)] 
+            for chunk in pd.read_csv(filepath, usecols=readcols, chunksize=chunksize) 
+        ] 
+        df_peryear = pd.concat(ls_chunk, axis="index") if ls_chunk else pd.DataFrame(columns=readcols) 
+
+    # Filter columns. Without (keep_cols), the columns are sorted like (Index.difference). 
+    df_peryear = df_peryear.loc[:, usecols if keep_cols else sorted(usecols)] 
+
+    if output_dir is not None: 
+        manage_files.pd_write_partition(df_peryear, output_dir, "year", str(year)) 
+        return len(df_peryear) 
+
+    return df_peryear 
+
+
+
+# %% 
+class DailyAggregator(): 
+    def __init__( 
+        self, 
+        numcols:List[str], 
+        weightcol:str=RP_EVENT_WEIGHTCOL, 
+        keys:List[str]=["ticker", "date"], 
+        compact_rows:int=1000000, 
+    ): 
+        '''
+        Running aggregation of event rows to one row per (ticker, date).
+
+        –   Each chunk is reduced to the counts, sums, weighted sums, minimums and maximums
+            of its groups, so only the groups are held in memory, not the events.
+        –   The partial results are combined once they exceed (compact_rows).
+        '''
+
+        self.numcols = list(numcols) 
+        self.weightcol = weightcol 
+        self.keys = list(keys) 
+        self.compact_rows = compact_rows 
+
+        self.parts = list() 
+        self.nrows = 0 
+
+
+    def update(self, df:pd.DataFrame): 
+        '''Add a chunk of events.'''
+
+        if df.empty: 
+            return 
+
+        values = df[self.numcols].to_numpy(dtype=np.float64) 
+        weight = df[self.weightcol].to_numpy(dtype=np.float64)[:, None] 
+
+        # Missing scores are left out of the counts and sums, and missing weights out of the weighted sums. 
+        valid = ~np.isnan(values) 
+        wvalid = valid & ~np.isnan(weight) 
+        x = np.where(valid, values, 0) 
+        w = np.where(wvalid, weight, 0) 
+
+        df_sum = pd.DataFrame( 
+            np.hstack([np.ones((len(df), 1)), valid, x, w * x, w]), 
+            columns=["count"] + [f"{c}_{s}" for s in ("n", "sum", "wsum", "w") for c in self.numcols], 
+        ) 
+        df_min = pd.DataFrame(values, columns=self.numcols) 
+
+        keys = [df[k].to_numpy() for k in self.keys] 
+        self.parts.append(( 
+            df_sum.groupby(keys, sort=False).sum(), 
+            df_min.groupby(keys, sort=False).min(), 
+            df_min.groupby(keys, sort=False).max(), 
+        )) 
+        self.nrows += len(self.parts[-1][0]) 
+
+        if self.nrows > self.compact_rows: 
+            self._compact() 
+
+
+    def result(self, aggs:List[str]=["count", "mean", "min", "max", "wmean"]) -> pd.DataFrame: 
+        '''
+        Get the daily features sorted by the keys.
+
+        –   (count) is the number of events. The other (aggs) give one column (col_agg) per score,
+            where (wmean) is the mean weighted by (weightcol).
+        '''
+
+        self._compact() 
+        if not self.parts: 
+            return pd.DataFrame(columns=self.keys) 
 
-            # Filter columns. 
-            keep_cols = keep_cols if keep_cols else df_peryear.columns.difference(drop_cols) 
-            df_peryear = df_peryear.loc[df_peryear["ticker"].isin(keep_tickers), keep_cols] 
+        df_sum, df_min, df_max = self.parts[0] 
 
-            # Consolidate the datasets for each year. 
-            df_allyear = pd.concat([df_allyear, df_peryear], axis="index") 
+        def ratio(num:str, den:str) -> pd.DataFrame: 
+            numer = df_sum[[f"{c}_{num}" for c in self.numcols]].to_numpy() 
+            denom = df_sum[[f"{c}_{den}" for c in self.numcols]].to_numpy() 
+            with np.errstate(invalid="ignore", divide="ignore"): 
+                return pd.DataFrame(np.where(denom > 0, numer / denom, np.nan), index=df_sum.index, columns=self.numcols) 
 
-    return df_allyear 
+        dict_agg = { 
+            "mean": lambda: ratio("sum", "n"), 
+            "min": lambda: df_min, 
+            "max": lambda: df_max, 
+            "wmean": lambda: ratio("wsum", "w"), 
+        } 
+
+        ls_df = [df_sum[["count"]].astype(np.int64)] if "count" in aggs else list() 
+        for agg in aggs: 
+            if agg != "count": 
+                ls_df.append(dict_agg[agg]().rename(columns=lambda c: f"{c}_{agg}")) 
+
+        df_daily = pd.concat(ls_df, axis="columns") 
+        df_daily.index.names = self.keys 
+
+        return df_daily.sort_index().reset_index(drop=False) 
+
+
+    def _compact(self): 
+        '''Combine the partial results into one.'''
+
+        if len(self.parts) <= 1: 
+            return 
+
+        df_sum, df_min, df_max = (pd.concat(p, axis="index") for p in zip(*self.parts)) 
+        levels = list(range(len(self.keys))) 
+        self.parts = [( 
+            df_sum.groupby(level=levels, sort=False).sum(), 
+            df_min.groupby(level=levels, sort=False).min(), 
+            df_max.groupby(level=levels, sort=False).max(), 
+        )] 
+        self.nrows = len(self.parts[0][0]) 
+
+
+
+# %% 
+@traced() 
+def aggregate_sentiment_daily( 
+    dirpath:str, 
+    output_dir:Optional[str]=None, 
+    keep_tickers:Set[str]=TICKER_TO_COLLECT, 
+    yearrange:Tuple[int,int]=(year_beg, year_end), 
+    datecol:str="rpna_date_utc", 
+    catcols:List[str]=RP_EVENT_CATCOLS, 
+    numcols:List[str]=RP_EVENT_NUMCOLS, 
+    weightcol:str=RP_EVENT_WEIGHTCOL, 
+    aggs:List[str]=["count", "mean", "min", "max", "wmean"], 
+    chunksize:int=RP_EVENT_CHUNK_SIZE, 
+) -> Union[pd.DataFrame,str]: 
+    '''
+    Aggregate the RavenPack events of each year to daily features per ticker.
+
+    –   The year files (e.g. ravenpack_sentiment_YYYY.csv) or the year partitions
+        (year=YYYY/) of (extract_rp_sentiment_bulk) in (dirpath) are read in chunks
+        of (chunksize) events, so only one chunk and the daily groups of one year
+        are held in memory.
+    –   Events without any of the (catcols) are not classified and are skipped.
+    –   See (DailyAggregator.result) for the (aggs).
+    –   If (output_dir) is given, each year is written to (output_dir/year=YYYY/)
+        and the (output_dir) is returned.
+    '''
+
+    keep_tickers = set(keep_tickers).difference(TICKER_TO_EXCLUDE) 
+    readcols = list(dict.fromkeys(["ticker", datecol, *catcols, *numcols, weightcol])) 
+
+    # Find the file or partition of each year within the year range. 
+    dict_paths = dict() 
+    for name in os.listdir(dirpath): 
+        found_year = re.findall(r"^year=(\d{4})$|.+_(\d{4})\.\w+$", name) 
+        if found_year: 
+            year = int("".join(found_year[0])) 
+            if yearrange[0] <= year <= yearrange[1]: 
+                dict_paths[year] = os.path.join(dirpath, name) 
+
+    ls_df, nrows = list(), 0 
+    for year in sorted(dict_paths): 
+        print(f"Aggregate the events of ({year}).") 
+
+        aggregator = DailyAggregator(numcols, weightcol=weightcol) 
+        for chunk in _iter_event_chunks(dict_paths[year], readcols, keep_tickers, chunksize): 
+            chunk = chunk.dropna(axis="index", how="all", subset=catcols) 
+            aggregator.update(chunk.rename(columns={datecol: "date"})) 
+
+        df_daily = aggregator.result(aggs) 
+        if not df_daily.empty: 
+            df_daily["date"] = pd.to_datetime(df_daily["date"]) 
+        nrows += len(df_daily) 
+
+        if output_dir is not None: 
+            manage_files.pd_write_partition(df_daily, output_dir, "year", str(year)) 
+        elif not df_daily.empty: 
+            ls_df.append(df_daily) 
+
+    if output_dir is not None: 
+        print(f"Wrote ({nrows:,}) daily rows for ({len(dict_paths)}) years to ({output_dir}).") 
+        return output_dir 
+
+    return pd.concat(ls_df, axis="index", ignore_index=True) if ls_df else pd.DataFrame() 
+
+
+
+# %% 
+def _iter_event_chunks(path:str, readcols:List[str], keep_tickers:Set[str], chunksize:int) -> Iterator[pd.DataFrame]: 
+    '''Read the events of the kept tickers from a (csv) file, or a Parquet file or directory, in chunks.'''
+
+    if path.endswith(".csv"): 
+        for chunk in pd.read_csv(path, usecols=readcols, chunksize=chunksize): 
+            yield chunk[chunk["ticker"].isin(keep_tickers)] 
+        return 
+
+    import pyarrow.dataset as ds 
+
+    # Push the ticker filter down, so that the other tickers are not decoded. 
+    dataset = ds.dataset(path, format="parquet") 
+    batches = dataset.to_batches( 
+        columns=readcols, filter=ds.field("ticker").isin(list(keep_tickers)), batch_size=chunksize, 
+    ) 
+    for batch in batches: 
+        yield batch.to_pandas() 
 
 
 
@@ -200,11 +598,13 @@ def merge_with_ticker(
     Merge features with ticker data. Merge date format should be (YYYY-MM-DD). 
     '''
 
-    # Ensure the datetime is converted to str to be able to match dates. 
-    df[merge_datecol], merge_with[merge_datecol] = df[merge_datecol].astype(str), merge_with[merge_datecol].astype(str) 
+    # Ensure the datetime is converted to str to be able to match dates. Assign to 
+    # new frames rather than in place to leave the caller's dataframes intact. 
+    df = df.assign(**{merge_datecol: df[merge_datecol].astype(str)}) 
+    merge_with = merge_with.assign(**{merge_datecol: merge_with[merge_datecol].astype(str)}) 
 
     # Rename columns. 
-    merge_with.columns = [f"{merge_suffix}_{c}" for c in merge_with.columns] 
+    merge_with = merge_with.rename(columns=lambda c: f"{merge_suffix}_{c}") 
     right_on = [f"{merge_suffix}_{c}" for c in merge_on] 
 
     # Merge on (date) column. 
@@ -219,6 +619,141 @@ def merge_with_ticker(
 
 
 
+# %% 
+@traced() 
+def merge_features_with_ticker( 
+    df:pd.DataFrame, 
+    merge_sources:Dict[str,Dict], 
+    datecols:List[str]=["date", "date_quarter"], 
+) -> pd.DataFrame: 
+    '''
+    Left join all the feature sources onto the ticker data in one pass.
+
+    –   (merge_sources) maps each suffix to a spec. The features are named (suffix_col) like (merge_with_ticker).
+            data        : Dataframe of the features.
+            on          : Key columns, e.g. ["ticker", "date"].
+            relation    : Join cardinality to validate (e.g. many_to_one). Default (many_to_one).
+            asof        : Match the last date on or before (direction=backward) instead of the same date.
+            direction   : Direction of the as-of match (backward, forward or nearest).
+            tolerance   : Max distance of the as-of match, e.g. "95D".
+    –   The keys are matched as int64 (ticker codes and datetime64), so the date columns
+        may be strings or datetimes on either side. Neither dataframe is modified.
+    –   Each source only produces row positions. The columns are taken once at the end,
+        so the ticker data is not copied per source.
+    '''
+
+    from pandas.errors import MergeError 
+
+    df = df.reset_index(drop=True) 
+    nrows = len(df) 
+
+    # Positions into the ticker data and into each source for every output row. 
+    base_pos = np.arange(nrows) 
+    dict_pos = dict() 
+
+    # Encode each key column of the ticker data once and reuse it for all sources. 
+    dict_left = dict() 
+
+    for suffix, spec in merge_sources.items(): 
+        right = spec["data"].reset_index(drop=True) 
+        on = list(spec["on"]) 
+        relation = spec.get("relation", "many_to_one") 
+        asof = spec.get("asof", False) 
+
+        ls_left, ls_right = list(), list() 
+        for col in on: 
+            if col not in dict_left: 
+                dict_left[col] = _encode_key(df[col], is_date=col in datecols) 
+            left_key, uniques = dict_left[col] 
+            ls_left.append(left_key[base_pos]) 
+            ls_right.append(_encode_key(right[col], is_date=col in datecols, uniques=uniques)[0]) 
+
+        # Validate the join cardinality like (pd.merge(validate=...)). 
+        right_index = pd.MultiIndex.from_arrays(ls_right) if len(on) > 1 else pd.Index(ls_right[0]) 
+        if relation in ("one_to_one", "1:1", "many_to_one", "m:1") and not right_index.is_unique: 
+            raise MergeError(f"Merge keys are not unique in ({suffix}); not a {relation} merge.") 
+        if relation in ("one_to_one", "1:1", "one_to_many", "1:m"): 
+            left_index = pd.MultiIndex.from_arrays(ls_left) if len(on) > 1 else pd.Index(ls_left[0]) 
+            if not left_index.is_unique: 
+                raise MergeError(f"Merge keys are not unique in the ticker data; not a {relation} merge.") 
+
+        if asof: 
+            # The last key is matched as of the date, the others exactly. 
+            by = [f"k{i}" for i in range(len(on) - 1)] 
+            df_left = pd.DataFrame({**dict(zip(by, ls_left[:-1])), "t": ls_left[-1], "l": np.arange(len(base_pos))}) 
+            df_right = pd.DataFrame({**dict(zip(by, ls_right[:-1])), "t": ls_right[-1], "r": np.arange(len(right))}) 
+            tolerance = spec.get("tolerance") 
+            df_match = pd.merge_asof( 
+                df_left.sort_values("t", kind="stable"), df_right.sort_values("t", kind="stable"), 
+                on="t", by=by or None, direction=spec.get("direction", "backward"), 
+                tolerance=pd.Timedelta(tolerance).value if tolerance is not None else None, 
+            ).sort_values("l") 
+            right_pos = df_match["r"].fillna(-1).to_numpy(dtype=np.int64) 
+
+        elif right_index.is_unique: 
+            right_pos = right_index.get_indexer( 
+                pd.MultiIndex.from_arrays(ls_left) if len(on) > 1 else pd.Index(ls_left[0]) 
+            ) 
+
+        else: 
+            # Duplicated keys repeat the ticker rows, so the earlier positions are repeated too. 
+            df_match = pd.DataFrame({**{f"k{i}": k for i, k in enumerate(ls_left)}, "l": np.arange(len(base_pos))}) \
+                .merge( 
+                    pd.DataFrame({**{f"k{i}": k for i, k in enumerate(ls_right)}, "r": np.arange(len(right))}), 
+                    how="left", on=[f"k{i}" for i in range(len(on))], sort=False, 
+                ) 
+            repeat = df_match["l"].to_numpy() 
+            base_pos = base_pos[repeat] 
+            dict_pos = {k: (data, pos[repeat]) for k, (data, pos) in dict_pos.items()} 
+            right_pos = df_match["r"].fillna(-1).to_numpy(dtype=np.int64) 
+
+        # Keep the matched date of the as-of join. The exact keys duplicate the ticker data. 
+        keep_cols = [c for c in right.columns if c not in on or (asof and c == on[-1])] 
+        dict_pos[suffix] = (right[keep_cols], right_pos) 
+
+        matched = (right_pos >= 0).sum() 
+        print(f"Merged ({suffix}) with ({matched:,}/{len(right_pos):,}) rows matched.") 
+
+    # Take the columns once for all sources, then concat once. 
+    # The ticker rows keep their order, so they only need a take if some were repeated. 
+    ls_df = [df if len(base_pos) == nrows else df.take(base_pos).reset_index(drop=True)] 
+    for suffix, (right, right_pos) in dict_pos.items(): 
+        ls_df.append(_take_or_missing(right, right_pos).rename(columns=lambda c: f"{suffix}_{c}")) 
+
+    return pd.concat(ls_df, axis="columns") 
+
+
+
+# %% 
+def _encode_key(key:pd.Series, is_date:bool, uniques:Optional[pd.Index]=None) -> Tuple[np.ndarray,Optional[pd.Index]]: 
+    '''Encode the key as int64. Dates become datetime64 (ns) and the other keys become codes of (uniques).'''
+
+    # Convert only the distinct values, since the keys repeat for each ticker or date. 
+    codes, values = pd.factorize(key) 
+
+    if is_date: 
+        values = np.append(pd.to_datetime(values).to_numpy(dtype="datetime64[ns]"), np.datetime64("NaT", "ns")) 
+        return values.view(np.int64)[codes], None 
+
+    if uniques is None: 
+        return codes.astype(np.int64), pd.Index(values) 
+
+    # Values missing from the ticker data get (-2), so they never match the missing (-1) keys. 
+    values = np.append(uniques.get_indexer(values), -1) 
+    values[values == -1] = -2 
+    return values.astype(np.int64)[codes], uniques 
+
+
+
+# %% 
+def _take_or_missing(df:pd.DataFrame, pos:np.ndarray) -> pd.DataFrame: 
+    '''Take the rows by position. A position of (-1) gives a missing row like a left join.'''
+
+    # Reindexing the (RangeIndex) upcasts the columns only if a row is missing, like (pd.merge). 
+    return df.reindex(pos).reset_index(drop=True) 
+
+
+
 # %% 
 def rolling_sum_bygroup(
     df:pd.DataFrame, 
@@ -231,21 +766,110 @@ def rolling_sum_bygroup(
     # Make a copy to avoid (SettingWarnings). 
     df_rollsum = df.copy() 
 
-    # Process column names. 
-    getcols = groupby + usecols 
-
     # Compute the rolling value. 
-    df_rollsum[usecols] = df_rollsum \
-        .loc[:, getcols] \
-        .groupby(groupby, as_index=False, sort=False) \
-        .rolling(window=window, min_periods=window) \
-        .sum() \
-        .loc[:, usecols] 
+    df_rollsum[usecols] = rolling_agg_bygroup(df, groupby=groupby, window=window, usecols=usecols, aggs=["sum"]).to_numpy() 
 
     return df_rollsum 
 
 
 
+# %% 
+@traced() 
+def rolling_agg_bygroup( 
+    df:pd.DataFrame, 
+    groupby:List[str]=["ticker"], 
+    window:int=4, 
+    usecols:List[str]=FINANCIAL_INCOME_STATES, 
+    aggs:List[str]=["sum"], 
+    min_periods:Optional[int]=None, 
+) -> pd.DataFrame: 
+    '''
+    Compute the rolling aggregations over the last (window) rows of each group, in row order.
+
+    –   Supports (sum, mean, std, min, max) for all (usecols) at once. The result has the
+        index of (df) and a column (col_agg) for each column and aggregation.
+    –   Like (groupby().rolling()), NaN values are skipped, and the result is NaN where
+        the window holds fewer than (min_periods) values. Defaults to (window).
+    –   Sum, mean and std come from the difference of cumulative sums, which are segmented
+        by group. Min and max come from a running minimum or maximum over the lags.
+    '''
+
+    min_periods = window if min_periods is None else min_periods 
+
+    # Sort the rows by group while keeping the row order within each group. 
+    codes = df.groupby(groupby, sort=False).ngroup().to_numpy() 
+    order = np.argsort(codes, kind="stable") 
+    codes = codes[order] 
+    values = df[usecols].to_numpy(dtype=np.float64)[order] 
+    nrows = len(values) 
+
+    # Each row looks back to the later of the window start and its group start. 
+    group_beg = np.r_[0, np.flatnonzero(codes[1:] != codes[:-1]) + 1] 
+    row_beg = np.repeat(group_beg, np.diff(np.r_[group_beg, nrows])) 
+    rows = np.arange(nrows) 
+    lo = np.maximum(rows - window + 1, row_beg) 
+
+    # The cumulative sums restart every (window) rows, so that the rounding error does not grow 
+    # with the number of rows. A window then spans at most two blocks: the suffix sum of the 
+    # earlier block plus the prefix sum of the later block. 
+    nblocks = -(-nrows // window) 
+    same_block = lo // window == rows // window 
+
+    def window_total(x): 
+        padded = np.zeros((nblocks * window, x.shape[1])) 
+        padded[:nrows] = x 
+        padded = padded.reshape(nblocks, window, x.shape[1]) 
+        prefix = np.cumsum(padded, axis=1).reshape(-1, x.shape[1])[:nrows] 
+        suffix = np.cumsum(padded[:, ::-1], axis=1)[:, ::-1].reshape(-1, x.shape[1])[:nrows] 
+        return np.where(same_block[:, None], prefix - prefix[lo] + x[lo], prefix + suffix[lo]) 
+
+    valid = ~np.isnan(values) 
+    count = window_total(valid.astype(np.float64)) 
+    dict_output = dict() 
+
+    if {"sum", "mean", "std"} & set(aggs): 
+        # Center each group by its mean to limit the rounding error of the cumulative sums. 
+        group_size = np.diff(np.r_[group_beg, nrows]) 
+        with np.errstate(invalid="ignore", divide="ignore"): 
+            center = np.add.reduceat(np.where(valid, values, 0), group_beg, axis=0) \
+                / np.add.reduceat(valid, group_beg, axis=0) if nrows else values 
+        center = np.repeat(np.nan_to_num(center), group_size, axis=0) 
+        centered = np.where(valid, values - center, 0) 
+        total = window_total(centered) 
+
+        with np.errstate(invalid="ignore", divide="ignore"): 
+            if "sum" in aggs: 
+                dict_output["sum"] = total + count * center 
+            if "mean" in aggs: 
+                dict_output["mean"] = total / count + center 
+            if "std" in aggs: 
+                var = np.maximum(window_total(centered ** 2) - total ** 2 / count, 0) / (count - 1) 
+                dict_output["std"] = np.where(count > 1, np.sqrt(var), np.nan) 
+
+    for agg, func in [("min", np.fmin), ("max", np.fmax)]: 
+        if agg in aggs: 
+            # Take the running minimum or maximum over the lags within the group. 
+            output = values.copy() 
+            for lag in range(1, window): 
+                lagged = np.full_like(values, np.nan) 
+                lagged[lag:] = values[:max(nrows - lag, 0)] 
+                lagged[rows - lag < row_beg] = np.nan 
+                output = func(output, lagged) 
+            dict_output[agg] = output 
+
+    # Mask the windows with too few values, then restore the row order. 
+    inverse = np.empty_like(order) 
+    inverse[order] = rows 
+
+    dict_cols = dict() 
+    for agg in aggs: 
+        output = np.where(count >= min_periods, dict_output[agg], np.nan)[inverse] 
+        dict_cols.update({f"{col}_{agg}": output[:, i] for i, col in enumerate(usecols)}) 
+
+    return pd.DataFrame(dict_cols, index=df.index) 
+
+
+
 # %% 
 def process_quarter_date(
     df:pd.DataFrame, 
@@ -273,6 +897,61 @@ def process_quarter_date(
 
 
 
+# %% 
+@traced() 
+def align_report_asof( 
+    df:pd.DataFrame, 
+    df_report:pd.DataFrame, 
+    usecols:List[str], 
+    merge_suffix:str="vl", 
+    datecol:str="fiscalDateEnding", 
+    reportcol:Optional[str]=None, 
+    publication_lag:str=FINANCIAL_PUBLICATION_LAG, 
+    tolerance:Optional[str]=FINANCIAL_REPORT_TOLERANCE, 
+) -> pd.DataFrame: 
+    '''
+    Attach the latest report that is public on each date to the ticker data.
+
+    –   A report is public (publication_lag) after its period end in (datecol), or on
+        its filing date in (reportcol) if given. Nothing is matched before that, so
+        the features are point-in-time.
+    –   The reports are matched as of the date in one sorted pass for all tickers,
+        so irregular or 52-53 week fiscal dates need no quarter alignment and no
+        ticker is dropped.
+    –   Reports public more than (tolerance) before the date are left missing.
+    –   The features are named (merge_suffix_col), along with the matched period end
+        (merge_suffix_datecol) and public date (merge_suffix_date).
+    '''
+
+    df_data = df_report.loc[:, ["ticker", datecol] + usecols].copy() 
+    df_data[datecol] = pd.to_datetime(df_data[datecol]) 
+
+    # The date each report becomes public. 
+    df_data["date"] = df_data[datecol] + pd.Timedelta(publication_lag) 
+    if reportcol is not None: 
+        df_data["date"] = pd.to_datetime(df_report[reportcol]).fillna(df_data["date"]) 
+
+    # Keep the last restatement of each period, then the latest period of each public date. 
+    df_data = df_data \
+        .dropna(subset=[datecol]) \
+        .drop_duplicates(subset=["ticker", datecol], keep="last") \
+        .sort_values(["ticker", "date", datecol], kind="stable") \
+        .drop_duplicates(subset=["ticker", "date"], keep="last") 
+
+    # A late report of an older period must not replace a newer period that is already public. 
+    df_data = df_data.loc[df_data[datecol] >= df_data.groupby("ticker")[datecol].cummax()] 
+
+    merge_sources = { 
+        merge_suffix: { 
+            "data": df_data, "on": ["ticker", "date"], 
+            "asof": True, "direction": "backward", "tolerance": tolerance, 
+        }, 
+    } 
+
+    return merge_features_with_ticker(df, merge_sources, datecols=["date"]) 
+
+
+
 # %% 
 def compute_price_to_ratio(df:pd.DataFrame, compute_cols:Dict[str,Tuple]) -> pd.DataFrame: 
     '''Compute the price-to ratio.'''
@@ -286,3 +965,59 @@ def compute_price_to_ratio(df:pd.DataFrame, compute_cols:Dict[str,Tuple]) -> pd.
         df_data[newcol] = df_data[numcol] / df_data[dencol] 
 
     return df_data 
+
+
+
+# %% 
+@traced() 
+def compact_feature_dtypes(df:pd.DataFrame, schema:Dict[str,Optional[str]]=FEATURE_DTYPE_SCHEMA) -> pd.DataFrame: 
+    '''
+    Cast the columns of the feature panel to the compact dtypes of (schema).
+
+    –   Each column takes the dtype of the first pattern it matches, e.g. (candle_*),
+        and keeps its dtype if none matches. See (FEATURE_DTYPE_SCHEMA).
+    –   A float dtype only applies to float columns.
+    –   Dates with a time zone keep their dtype.
+    –   Integer columns with missing values are kept, and those out of the range of
+        the dtype get the smallest integer dtype that holds them.
+    –   Print the memory before and after.
+    '''
+
+    mem_beg = df.memory_usage(index=True, deep=True).sum() 
+
+    dict_cols = dict() 
+    for col in df.columns: 
+        dtype = next((d for p, d in schema.items() if fnmatch.fnmatchcase(str(col), p)), None) 
+        if dtype is None or str(df[col].dtype) == dtype: 
+            continue 
+
+        values = df[col] 
+        if dtype == "category": 
+            dict_cols[col] = values.astype("category") 
+        elif dtype.startswith("datetime64"): 
+            # Dates with a time zone are kept, since converting them would shift the dates 
+            # of a local time zone, e.g. the midnight bars of (America/New_York). 
+            if isinstance(values.dtype, pd.DatetimeTZDtype): 
+                print(f"Kept ({col}) as ({values.dtype}) because of its time zone.") 
+                continue 
+            dict_cols[col] = pd.to_datetime(values).astype(dtype) 
+        elif np.issubdtype(np.dtype(dtype), np.floating): 
+            if pd.api.types.is_float_dtype(values): 
+                dict_cols[col] = values.astype(dtype) 
+        elif values.isna().any(): 
+            print(f"Kept ({col}) as ({values.dtype}) because of missing values.") 
+        else: 
+            info = np.iinfo(dtype) 
+            if values.min() < info.min or values.max() > info.max: 
+                dict_cols[col] = pd.to_numeric(values, downcast="integer") 
+                print(f"Cast ({col}) to ({dict_cols[col].dtype}) because its values are out of the range of ({dtype}).") 
+            else: 
+                dict_cols[col] = values.astype(dtype) 
+
+    # Replace the columns at once, keeping their order. 
+    df = df.assign(**dict_cols) 
+
+    mem_end = df.memory_usage(index=True, deep=True).sum() 
+    print(f"Compacted ({len(dict_cols)}) columns from ({mem_beg / 2**20:,.1f} MB) to ({mem_end / 2**20:,.1f} MB).") 
+
+    return df 
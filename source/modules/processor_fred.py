@@ -1,8 +1,11 @@
 # Python module. 
-import os, re 
+import os, re, functools 
 import pandas as pd 
 from typing import Dict, Tuple, Any 
-from fredapi import Fred 
+
+# Custom modules. 
+from source.modules.response_cache import response_cache 
+from source.modules.tracer import traced 
 
 # Custom configs. 
 from source.config_py.config import (
@@ -15,12 +18,22 @@ from source.config_py.config import (
 # Date range. 
 date_beg, date_end = TICKER_DATE_COLLECT 
 
-# Load Alpha Vantage object. 
-datasource = Fred(api_key=os.environ["FRED_API_SECRET"]) 
+
+
+# %% 
+@functools.lru_cache(maxsize=None) 
+def get_datasource(): 
+    '''Load FRED object.'''
+
+    # Build on first use, so that importing the module needs neither the package nor the API key. 
+    from fredapi import Fred 
+    return Fred(api_key=os.environ["FRED_API_SECRET"]) 
 
 
 
 # %%
+@traced() 
+@response_cache.cached("fred") 
 def get_econometric_fred(
     econometric:str, 
     parameters:Dict[str,str], 
@@ -34,7 +47,7 @@ def get_econometric_fred(
 
     year_beg, year_end = daterange 
 
-    df_econometric = datasource \
+    df_econometric = get_datasource() \
         .get_series(observation_start=year_beg, observation_end=year_end, **parameters) \
         .reset_index(drop=False) 
 
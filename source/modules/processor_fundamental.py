@@ -1,23 +1,41 @@
 # Python module. 
-import os, math, re 
+import os, math, re, operator 
 import numpy as np 
 import pandas as pd 
 import functools 
-from typing import Callable, Dict, List, Tuple, Any 
-from alpha_vantage.fundamentaldata import FundamentalData 
+from typing import Callable, Dict, List, Optional, Tuple, Any 
+
+# Custom modules. 
+from source.modules.manage_files import ManageFiles 
+from source.modules.fetch_scheduler import alphav_scheduler 
+from source.modules.response_cache import response_cache 
+from source.modules.tracer import traced 
 
 # Custom configs. 
 from source.config_py.config import (
     FINANCIAL_KEEP_FEATURES, 
     FINANCIAL_COMPUTE_CHANGE, FINANCIAL_COMPUTE_COMBINATION, 
     FINANCIAL_COMPUTE_RATIO, FINANCIAL_EVAL_QUALITY, 
+    FINANCIAL_PUBLICATION_LAG, FINANCIAL_REPORT_TOLERANCE, DIR_DATASET_FUNDAMENTAL, 
+    QUALITY_RANK_FREQ, QUALITY_HISTORY_FILENAME, QUALITY_STATE_FILENAME, 
 )
 
 
 
+# %% 
+# File management setup. 
+manage_files = ManageFiles() 
+
+
+
 # %%
-# Load Alpha Vantage object. 
-datasource = FundamentalData(os.environ["ALPHA_VANTAGE_API_SECRET"], output_format="pandas") 
+@functools.lru_cache(maxsize=None) 
+def get_datasource(): 
+    '''Load Alpha Vantage object.'''
+
+    # Build on first use, so that importing the module needs neither the package nor the API key. 
+    from alpha_vantage.fundamentaldata import FundamentalData 
+    return FundamentalData(os.environ["ALPHA_VANTAGE_API_SECRET"], output_format="pandas") 
 
 
 
@@ -38,7 +56,35 @@ def get_snp_wikiinfo() -> pd.DataFrame:
 
 
 
+# %% 
+def get_snp_wikichanges() -> pd.DataFrame: 
+    '''
+    Get the dated changes of the S&P 500 list from Wikipedia (date, added, removed, reason).
+
+    –   The ticker added and the ticker removed on the same row replaced each other.
+        Either can be missing.
+    '''
+
+    print(f"Getting S&P changes from (Wikipedia).") 
+
+    # The second table lists the changes, with two header rows, e.g. (Added, Ticker). 
+    df_snp_changes = pd.read_html("https://en.wikipedia.org/wiki/List_of_S%26P_500_companies")[1] 
+    df_snp_changes.columns = ["_".join(dict.fromkeys(c)).lower() for c in df_snp_changes.columns] 
+
+    df_snp_changes = pd.DataFrame({ 
+        "date": pd.to_datetime(df_snp_changes["date"], errors="coerce"), 
+        "added": df_snp_changes["added_ticker"], 
+        "removed": df_snp_changes["removed_ticker"], 
+        "reason": df_snp_changes["reason"], 
+    }) 
+
+    return df_snp_changes.dropna(subset=["date"]).reset_index(drop=True) 
+
+
+
 # %%
+@traced() 
+@response_cache.cached("alphavantage") 
 def get_corporate_overview_alphav(ticker:str) -> pd.DataFrame: 
     '''
     Get corporate and stock info from Alpha Vantage. 
@@ -52,7 +98,7 @@ def get_corporate_overview_alphav(ticker:str) -> pd.DataFrame:
     print(f"Getting corporate and stock info from (Alpha Vantage) for ({ticker}).") 
 
     # Get the corporate info. 
-    df_corp_overview = datasource.get_company_overview(ticker)[0] 
+    df_corp_overview = alphav_scheduler.call("overview", get_datasource().get_company_overview, ticker)[0] 
     df_corp_overview.rename(columns={"Symbol": "ticker"}, inplace=True) 
 
     return df_corp_overview
@@ -60,6 +106,8 @@ def get_corporate_overview_alphav(ticker:str) -> pd.DataFrame:
 
 
 # %%
+@traced() 
+@response_cache.cached("alphavantage") 
 def get_fundamental_alphav(ticker:str, annual:bool=True) -> pd.DataFrame: 
     '''
     Get fundamental data from Alpha Vantage. 
@@ -78,16 +126,16 @@ def get_fundamental_alphav(ticker:str, annual:bool=True) -> pd.DataFrame:
     # Get the financial statement. 
     if annual: 
         dict_report = {
-            "is_state": datasource.get_income_statement_annual(ticker)[0], 
-            "bs_state": datasource.get_balance_sheet_annual(ticker)[0], 
-            "cf_state": datasource.get_cash_flow_annual(ticker)[0], 
+            "is_state": alphav_scheduler.call("fundamental", get_datasource().get_income_statement_annual, ticker)[0], 
+            "bs_state": alphav_scheduler.call("fundamental", get_datasource().get_balance_sheet_annual, ticker)[0], 
+            "cf_state": alphav_scheduler.call("fundamental", get_datasource().get_cash_flow_annual, ticker)[0], 
         }
     else: 
         # Get the financial statement. 
         dict_report = {
-            "is_state": datasource.get_income_statement_quarterly(ticker)[0], 
-            "bs_state": datasource.get_balance_sheet_quarterly(ticker)[0], 
-            "cf_state": datasource.get_cash_flow_quarterly(ticker)[0], 
+            "is_state": alphav_scheduler.call("fundamental", get_datasource().get_income_statement_quarterly, ticker)[0], 
+            "bs_state": alphav_scheduler.call("fundamental", get_datasource().get_balance_sheet_quarterly, ticker)[0], 
+            "cf_state": alphav_scheduler.call("fundamental", get_datasource().get_cash_flow_quarterly, ticker)[0], 
         }
 
     # Merge the financial statements. 
@@ -117,6 +165,34 @@ def get_fundamental_alphav(ticker:str, annual:bool=True) -> pd.DataFrame:
 
 
 # %% 
+def compile_fundamental_plan( 
+    compute_change: Dict[str,str]=FINANCIAL_COMPUTE_CHANGE, 
+    compute_combination: Dict[str,Dict[str,List[str]]]=FINANCIAL_COMPUTE_COMBINATION, 
+    compute_ratio: Dict[str,List[str]]=FINANCIAL_COMPUTE_RATIO, 
+) -> Tuple[Dict[str,str],List[Tuple]]: 
+    '''
+    Compile the computations to (changes, steps) for (compute_extra_fundamental).
+
+    –   (changes) maps each growth rate to its column, computed in one groupby.
+    –   (steps) are the combinations (combination, outcol, add, sub) then the ratios
+        (ratio, outcol, numerator, denominator), in the order of the config, so a
+        step can use the output of an earlier one, e.g. (assetsQuick) in a ratio.
+    '''
+
+    steps = [ 
+        ("combination", outcol, list(dict_compute.get("add", list())), list(dict_compute.get("sub", list()))) 
+        for outcol, dict_compute in compute_combination.items() 
+    ] + [ 
+        ("ratio", outcol, *tuple(computecols)) 
+        for outcol, computecols in compute_ratio.items() 
+    ] 
+
+    return dict(compute_change), steps 
+
+
+
+# %% 
+@traced() 
 def compute_extra_fundamental(
     df:pd.DataFrame, 
     keep_features:List[str]=FINANCIAL_KEEP_FEATURES, 
@@ -124,69 +200,226 @@ def compute_extra_fundamental(
     compute_combination: Dict[str,Dict[str,List[str]]]=FINANCIAL_COMPUTE_COMBINATION, 
     compute_ratio: Dict[str,List[str]]=FINANCIAL_COMPUTE_RATIO 
 ) -> pd.DataFrame: 
-    '''Compute change / growth rate, arithmetic, and ratio to create additional fundamental data.'''
+    '''
+    Compute change / growth rate, arithmetic, and ratio to create additional fundamental data.
+
+    –   All the growth rates share one groupby of the tickers.
+    –   The combinations and ratios are computed on the NumPy arrays of the columns,
+        then all the new columns are attached in one concat.
+    '''
     
     print("Compute additional fundamental data.") 
 
-    df_proc = df[keep_features].copy() 
+    changes, steps = compile_fundamental_plan(compute_change, compute_combination, compute_ratio) 
+
+    df_proc = df[keep_features] 
 
     # Compute change or growth rate. 
-    for outcol, computecol in compute_change.items(): 
-        df_proc[outcol] = df_proc.groupby("ticker")[computecol].pct_change(periods=1) 
-
-    # Compute arithmetic. 
-    for outcol, dict_compute in compute_combination.items(): 
-        df_proc[outcol] = 0 
-        for computecol in dict_compute["add"]: 
-            df_proc[outcol] += df_proc[computecol] 
-        for computecol in dict_compute["sub"]: 
-            df_proc[outcol] -= df_proc[computecol].abs() 
-
-    # Compute ratio. 
-    for outcol, computecols in compute_ratio.items(): 
-        numcol, dencol = tuple(computecols) 
-        df_proc[outcol] = df_proc[numcol] / df_proc[dencol] 
+    df_change = df_proc.groupby("ticker")[list(changes.values())].pct_change(periods=1) 
+    df_change.columns = list(changes.keys()) 
+
+    # Arrays of the columns, and of the new columns as they are computed. 
+    arrays = dict() 
+    def get_array(col:str) -> np.ndarray: 
+        if col not in arrays: 
+            arrays[col] = (df_change[col] if col in df_change.columns else df_proc[col]).to_numpy() 
+        return arrays[col] 
+
+    with np.errstate(divide="ignore", invalid="ignore"): 
+        for kind, outcol, *computecols in steps: 
+            # Compute arithmetic. 
+            if kind == "combination": 
+                addcols, subcols = computecols 
+                values = np.zeros(len(df_proc), dtype=np.int64) 
+                for computecol in addcols: 
+                    values = values + get_array(computecol) 
+                for computecol in subcols: 
+                    values = values - np.abs(get_array(computecol)) 
+
+            # Compute ratio. 
+            else: 
+                numcol, dencol = computecols 
+                values = get_array(numcol) / get_array(dencol) 
+
+            arrays[outcol] = values 
+
+    # Attach the new columns at once. The new columns replace any existing ones. 
+    newcols = list(changes.keys()) + [step[1] for step in steps] 
+    df_new = pd.DataFrame({ 
+        col: df_change[col].to_numpy() if col in changes else arrays[col] for col in dict.fromkeys(newcols) 
+    }, index=df_proc.index) 
+
+    df_proc = pd.concat([df_proc.drop(columns=df_new.columns, errors="ignore"), df_new], axis="columns") 
 
     return df_proc 
 
 
 
 # %% 
-def score_fundamental(df:pd.DataFrame, eval_method:Dict[str,Dict[str,Any]]=FINANCIAL_EVAL_QUALITY) -> pd.DataFrame: 
-    '''Score the company or ticker by the fundamental quality.'''
+# Aggregations of (FINANCIAL_EVAL_QUALITY) as the groupby method, its default parameters 
+# and whether it skips the missing values, the same as the NumPy function on a Series. 
+# (np.std) and (np.var) use (ddof=0), and (np.median) is missing if any value is. 
+SCORE_AGGS = { 
+    "np.mean": ("mean", dict(), True), 
+    "np.nanmean": ("mean", dict(), True), 
+    "np.median": ("median", dict(), False), 
+    "np.nanmedian": ("median", dict(), True), 
+    "np.sum": ("sum", dict(), True), 
+    "np.min": ("min", dict(), True), 
+    "np.max": ("max", dict(), True), 
+    "np.std": ("std", dict(ddof=0), True), 
+    "np.var": ("var", dict(ddof=0), True), 
+} 
+
+# Comparisons of the benchmarks, e.g. (>= .1). 
+SCORE_OPS = { 
+    ">=": operator.ge, 
+    "<=": operator.le, 
+    "==": operator.eq, 
+    "!=": operator.ne, 
+    ">": operator.gt, 
+    "<": operator.lt, 
+} 
+
+
+
+# %% 
+def compile_eval_method(eval_method:Dict[str,Dict[str,Any]]=FINANCIAL_EVAL_QUALITY) -> Dict[str,Tuple]: 
+    '''
+    Compile the evaluation of each metric to (aggregation, parameters, skipna, operator, threshold, weightage).
+
+    –   The aggregations are listed in (SCORE_AGGS) and the operators in (SCORE_OPS).
+    –   Raise (ValueError) for any other function or benchmark.
+    '''
+
+    dict_spec = dict() 
+    for metric, dict_func in eval_method.items(): 
+        if dict_func["func"] not in SCORE_AGGS: 
+            raise ValueError(f"Unknown function ({dict_func['func']}) of ({metric}). Use one of ({', '.join(SCORE_AGGS)}).") 
+
+        found = re.fullmatch(r"\s*(>=|<=|==|!=|>|<)\s*([-+]?[\d.]+(?:[eE][-+]?\d+)?)\s*", dict_func["benchmark"]) 
+        if not found: 
+            raise ValueError(f"Unknown benchmark ({dict_func['benchmark']}) of ({metric}), e.g. (>= .1).") 
+
+        agg, param, skipna = SCORE_AGGS[dict_func["func"]] 
+        dict_spec[metric] = ( 
+            agg, {**param, **dict_func["param"]}, skipna, found.group(1), float(found.group(2)), dict_func["weightage"], 
+        ) 
+
+    return dict_spec 
+
+
+
+# %% 
+def score_fundamental(df:pd.Series, eval_method:Dict[str,Dict[str,Any]]=FINANCIAL_EVAL_QUALITY) -> float: 
+    '''Score the company or ticker by the fundamental quality of the metric (df.name).'''
     
     # Compute score. 
-    dict_func = eval_method[df.name] 
-    score = eval(f'''{dict_func["func"]}(df, **{dict_func["param"]})''') 
+    agg, param, skipna, op, threshold, weightage = compile_eval_method({df.name: eval_method[df.name]})[df.name] 
+    score = getattr(df, agg)(**param) if skipna or not df.isna().any() else np.NaN 
 
     if np.isnan(score) or math.inf == abs(float(score)): 
         return np.NaN 
 
     # Evaluate the score. 
-    meet_criteria = eval(str(score) + " " + dict_func["benchmark"]) 
-    meet_criteria = 1 * dict_func["weightage"] if meet_criteria else 0 
+    return 1 * weightage if SCORE_OPS[op](score, threshold) else 0 
+
+
+
+# %% 
+def score_fundamental_bygroup( 
+    df:pd.DataFrame, 
+    eval_method:Dict[str,Dict[str,Any]]=FINANCIAL_EVAL_QUALITY, 
+    groupby:str="ticker", 
+) -> pd.DataFrame: 
+    '''
+    Score all the tickers by the fundamental quality at once. Same as (score_fundamental)
+    applied to each ticker and metric.
+
+    –   The metrics sharing an aggregation are aggregated in one groupby, then each
+        benchmark is compared over the (ticker x metric) matrix.
+    –   Return a column (score_metric) for each metric, indexed by (groupby).
+    '''
+
+    dict_spec = compile_eval_method(eval_method) 
+    metrics = list(dict_spec) 
+
+    # Aggregate the metrics of the same aggregation and parameters together. 
+    dict_group = dict() 
+    for metric, (agg, param, *_) in dict_spec.items(): 
+        dict_group.setdefault((agg, repr(sorted(param.items()))), (agg, param, list()))[2].append(metric) 
+
+    grouped = df.groupby(groupby) 
+    df_agg = pd.concat( 
+        [getattr(grouped[cols], agg)(**param) for agg, param, cols in dict_group.values()], axis="columns", 
+    ) 
+    values = df_agg[metrics].to_numpy(dtype=np.float64) 
+
+    # The aggregations that do not skip the missing values are missing for the groups with any. 
+    keepna = [m for m in metrics if not dict_spec[m][2]] 
+    if keepna: 
+        anyna = (grouped[keepna].count() < grouped[keepna].size().to_numpy()[:, None]).reindex(df_agg.index) 
+        values[:, [metrics.index(m) for m in keepna]] = np.where(anyna.to_numpy(), np.nan, df_agg[keepna].to_numpy()) 
+
+    scores = _score_aggregates(values, [dict_spec[m] for m in metrics]) 
+    df_score = pd.DataFrame(scores, index=df_agg.index, columns=[f"score_{m}" for m in metrics]) 
+
+    # Keep the scores as integers where none is missing and all are integers (0 or an integer 
+    # weightage), the same dtypes as the groupby of (score_fundamental). 
+    intcols = [ 
+        f"score_{m}" for m in metrics 
+        if not df_score[f"score_{m}"].isna().any() 
+        and (isinstance(dict_spec[m][5], (int, np.integer)) or not df_score[f"score_{m}"].any()) 
+    ] 
+
+    return df_score.astype({c: np.int64 for c in intcols}) 
+
+
+
+# %% 
+def _score_aggregates(values:np.ndarray, specs:List[Tuple]) -> np.ndarray: 
+    '''Compare the (group x metric) aggregates with the benchmarks of the compiled (specs) of the metrics.'''
+
+    # Compare each metric with its benchmark, one operator at a time. 
+    ops = np.array([spec[3] for spec in specs]) 
+    thresholds = np.array([spec[4] for spec in specs], dtype=np.float64) 
+    weightages = np.array([spec[5] for spec in specs], dtype=np.float64) 
+
+    meet = np.zeros(values.shape, dtype=bool) 
+    for op in np.unique(ops): 
+        mask = ops == op 
+        meet[:, mask] = SCORE_OPS[op](values[:, mask], thresholds[mask]) 
 
-    return meet_criteria 
+    # Missing or infinite aggregates are not scored. 
+    return np.where(np.isfinite(values), meet * weightages, np.nan) 
 
 
 
 # %% 
+@traced() 
 def rank_fundamental(
-    rank_func:Callable, 
+    rank_func:Optional[Callable], 
     df:pd.DataFrame, 
     eval_method:Dict[str,Dict[str,Any]]=FINANCIAL_EVAL_QUALITY
 ) -> pd.DataFrame: 
-    '''Rank the company or ticker by the fundamental quality.'''
+    '''
+    Rank the company or ticker by the fundamental quality.
 
-    print(f"Ranking the fundamental quality.") 
+    –   With (rank_func) None or (score_fundamental), all the tickers are scored at once
+        by (score_fundamental_bygroup). Any other (rank_func) is applied to each
+        ticker and metric as (rank_func(series, eval_method)).
+    '''
 
-    # Modify the default arguments for the (rank_func). 
-    func = functools.partial(rank_func, eval_method=eval_method) 
+    print(f"Ranking the fundamental quality.") 
 
     # Compute the score for each fundamental metric. 
-    agg_funcs = [f'''score_{c}=pd.NamedAgg(column="{c}", aggfunc=func)''' for c in FINANCIAL_EVAL_QUALITY.keys()] 
-    agg_funcs = ", ".join(agg_funcs) 
-    df_rank = eval(f'''df.groupby("ticker").agg({agg_funcs})''') 
+    if rank_func is None or rank_func is score_fundamental: 
+        df_rank = score_fundamental_bygroup(df, eval_method) 
+    else: 
+        func = functools.partial(rank_func, eval_method=eval_method) 
+        df_rank = df.groupby("ticker").agg(**{ 
+            f"score_{c}": pd.NamedAgg(column=c, aggfunc=func) for c in eval_method.keys() 
+        }) 
 
     # Sum the score and sort it. 
     df_rank["total_score"] = df_rank.sum(axis="columns") 
@@ -201,6 +434,218 @@ def rank_fundamental(
 
 
 
+# %% 
+@traced() 
+def update_quality_history( 
+    df:pd.DataFrame, 
+    date_end:str, 
+    dirpath:str=DIR_DATASET_FUNDAMENTAL, 
+    filename:str=QUALITY_HISTORY_FILENAME, 
+    statename:str=QUALITY_STATE_FILENAME, 
+    eval_method:Dict[str,Dict[str,Any]]=FINANCIAL_EVAL_QUALITY, 
+    datecol:str="fiscalDateEnding", 
+    publication_lag:str=FINANCIAL_PUBLICATION_LAG, 
+    tolerance:str=FINANCIAL_REPORT_TOLERANCE, 
+    freq:str=QUALITY_RANK_FREQ, 
+) -> pd.DataFrame: 
+    '''
+    Rank the fundamental quality of all the tickers as of each date (freq) up to (date_end),
+    with only the reports public by then, and append the ranks to (dirpath/filename).
+
+    –   Same scores as (rank_fundamental) over the public reports of each ticker. A report
+        is public (publication_lag) after its period end (datecol). The tickers without
+        a report public within (tolerance), e.g. delisted, are not ranked.
+    –   The running aggregates of each ticker are kept in (statename), so that each update
+        only folds in the new reports and ranks the new dates. The aggregations must
+        be (np.mean), (np.sum), (np.min), (np.max), (np.std) or (np.var).
+    –   The reports of a period already folded in, e.g. restatements, are skipped.
+    –   Return the appended rows (date, ticker, total_score, rank_quantl). Join them to the
+        daily rows with (merge_asof) by ticker.
+    '''
+
+    params = dict(eval_method=eval_method, datecol=datecol, publication_lag=publication_lag, tolerance=tolerance, freq=freq) 
+    specs = list(compile_eval_method(eval_method).values()) 
+    metrics = list(eval_method.keys()) 
+
+    unsupported = [m for m, spec in zip(metrics, specs) if spec[0] not in RUNNING_AGGS or set(spec[1]).difference({"ddof"})] 
+    if unsupported: 
+        raise ValueError(f"Cannot update the aggregations of ({', '.join(unsupported)}) from running aggregates.") 
+
+    # Load the running aggregates, or start empty. 
+    if os.path.isfile(os.path.join(dirpath, statename)): 
+        state = manage_files.load_cache_pk(dirpath, statename) 
+        if state["params"] != params: 
+            raise ValueError(f"The parameters differ from ({statename}). Delete it and ({filename}) to rebuild.") 
+    else: 
+        index = pd.Index(list(), name="ticker", dtype=object) 
+        state = dict( 
+            params=params, 
+            last_date=None, 
+            last=pd.DataFrame({"period": pd.Series(dtype="datetime64[ns]"), "public": pd.Series(dtype="datetime64[ns]")}, index=index), 
+            acc={name: pd.DataFrame(columns=metrics, index=index, dtype=np.float64) for name in RUNNING_STATE}, 
+        ) 
+
+    # Reports after the last period folded in for each ticker. 
+    df_new = df[["ticker", datecol, *metrics]].assign(period=pd.to_datetime(df[datecol]).astype("datetime64[ns]")).dropna(subset=["ticker", "period"]) 
+    df_new = df_new.loc[df_new["period"].to_numpy() > state["last"]["period"].reindex(df_new["ticker"]).fillna(pd.Timestamp.min).to_numpy()] 
+    df_new["public"] = df_new["period"] + pd.Timedelta(publication_lag) 
+
+    # New dates to rank as of, from the first public report on the first update. 
+    date_end = pd.Timestamp(date_end) 
+    date_beg = state["last_date"] if state["last_date"] is not None else df_new["public"].min() 
+    if pd.isna(date_beg): 
+        print("No reports to rank.") 
+        return pd.DataFrame(columns=["date", "ticker", "total_score", "rank_quantl"]) 
+
+    dates = pd.period_range(date_beg, date_end, freq=freq).to_timestamp(how="end").normalize().astype("datetime64[ns]") 
+    dates = dates[(dates <= date_end) & ((dates > state["last_date"]) if state["last_date"] is not None else True)] 
+    if dates.empty: 
+        print(f"No new dates to rank after ({state['last_date']}).") 
+        return pd.DataFrame(columns=["date", "ticker", "total_score", "rank_quantl"]) 
+
+    # Fold in the reports public by the last date. Later ones are folded in on a later update. 
+    df_new = df_new \
+        .loc[df_new["public"] <= dates[-1]] \
+        .drop_duplicates(subset=["ticker", "period"], keep="last") \
+        .sort_values(["ticker", "period"], kind="stable") \
+        .reset_index(drop=True) 
+    acc = _fold_reports(df_new, metrics, state["acc"]) 
+
+    # Running aggregates as of each report, after the last ones of the previous update. 
+    df_asof = pd.concat([ 
+        state["last"][["public"]].assign(**dict(zip(metrics, _running_values(state["acc"], specs).T))).reset_index(drop=False), 
+        df_new[["ticker", "public"]].assign(**dict(zip(metrics, _running_values(acc, specs).T))), 
+    ], axis="index", ignore_index=True).sort_values("public", kind="stable") 
+
+    # Latest public report of each ticker as of each date. 
+    tickers = df_asof["ticker"].unique() 
+    df_grid = pd.DataFrame({"date": np.repeat(dates.to_numpy(), len(tickers)), "ticker": pd.Series(np.tile(tickers, len(dates)), dtype=df_asof["ticker"].dtype)}) 
+    df_grid = pd.merge_asof( 
+        df_grid, df_asof, left_on="date", right_on="public", by="ticker", 
+        direction="backward", tolerance=pd.Timedelta(tolerance), 
+    ).dropna(subset=["public"]) 
+
+    # Score and rank as (rank_fundamental) does as of each date. 
+    scores = _score_aggregates(df_grid[metrics].to_numpy(dtype=np.float64), specs) 
+    df_hist = df_grid[["date", "ticker"]].assign(total_score=np.nansum(scores, axis=1)) 
+    df_hist["rank_quantl"] = df_hist.groupby("date")["total_score"].rank(method="average", ascending=False, pct=True) 
+    df_hist = df_hist \
+        .sort_values(["date", "ticker"]) \
+        .astype({"ticker": "category", "total_score": np.float32, "rank_quantl": np.float32}) \
+        .reset_index(drop=True) 
+
+    manage_files.pd_append_parquet(df_hist, os.path.join(dirpath, filename)) 
+
+    # Keep the running aggregates of the last report of each ticker, and save the state 
+    # only once the ranks are appended. 
+    last = df_new.groupby("ticker", sort=False).tail(1).index 
+    state["acc"] = { 
+        name: pd.concat([ 
+            values.drop(index=df_new.loc[last, "ticker"], errors="ignore"), 
+            pd.DataFrame(acc[name][last], index=pd.Index(df_new.loc[last, "ticker"], name="ticker"), columns=metrics), 
+        ]) 
+        for name, values in state["acc"].items() 
+    } 
+    state["last"] = pd.concat([ 
+        state["last"].drop(index=df_new.loc[last, "ticker"], errors="ignore"), 
+        df_new.loc[last, ["ticker", "period", "public"]].set_index("ticker"), 
+    ]) 
+    state["last_date"] = dates[-1] 
+
+    manage_files.save_cache_pk(dirpath, statename, state) 
+
+    print(f"Ranked up to ({df_hist['ticker'].nunique()}) tickers as of ({len(dates)}) dates up to ({dates[-1]:%Y-%m-%d}).") 
+
+    return df_hist 
+
+
+
+# %% 
+# Aggregations that (update_quality_history) can update from the running aggregates. 
+RUNNING_AGGS = {"mean", "sum", "min", "max", "std", "var"} 
+
+# Running aggregates of each ticker and metric, with the value of a ticker never seen. The 
+# count, mean and sum of squared deviations (m2) are of the finite values, and the infinite 
+# values are counted apart, e.g. the growth from zero. 
+RUNNING_STATE = {"n": 0, "mean": 0, "m2": 0, "min": np.NaN, "max": np.NaN, "pinf": 0, "ninf": 0} 
+
+
+
+# %% 
+def _fold_reports(df:pd.DataFrame, metrics:List[str], acc:Dict[str,pd.DataFrame]) -> Dict[str,np.ndarray]: 
+    '''
+    Running aggregates (RUNNING_STATE) of the metrics as of each report of each ticker,
+    in order, starting from the aggregates (acc) of each ticker.
+
+    –   The mean and m2 are updated with Welford's method, which keeps the variance
+        precise where the sum of squares would cancel out.
+    –   The k-th reports of all the tickers are folded in at once, so it loops once per
+        report of the ticker with the most reports.
+    –   Missing values are left out, as the pandas aggregations do.
+    '''
+
+    values = df[metrics].to_numpy(dtype=np.float64) 
+    inverse, tickers = pd.factorize(df["ticker"]) 
+    nth = df.groupby("ticker", sort=False).cumcount().to_numpy() 
+
+    # Only the tickers never seen start empty. The aggregates of the others are kept as 
+    # they are, even if missing, e.g. the min of a metric never reported. 
+    cur = {name: acc[name].reindex(tickers, fill_value=fill).to_numpy(dtype=np.float64, copy=True) for name, fill in RUNNING_STATE.items()} 
+    out = {name: np.empty(values.shape) for name in RUNNING_STATE} 
+
+    for k in range(nth.max() + 1 if len(nth) else 0): 
+        rows = np.flatnonzero(nth == k) 
+        g, x = inverse[rows], values[rows] 
+        finite = np.isfinite(x) 
+
+        n, mean = cur["n"][g], cur["mean"][g] 
+        n_new = n + finite 
+        delta = np.where(finite, x - mean, 0) 
+        mean_new = mean + np.divide(delta, n_new, out=np.zeros(x.shape), where=finite) 
+
+        cur["n"][g] = n_new 
+        cur["mean"][g] = mean_new 
+        cur["m2"][g] = cur["m2"][g] + delta * np.where(finite, x - mean_new, 0) 
+        cur["min"][g] = np.fmin(cur["min"][g], x) 
+        cur["max"][g] = np.fmax(cur["max"][g], x) 
+        cur["pinf"][g] = cur["pinf"][g] + (x == np.inf) 
+        cur["ninf"][g] = cur["ninf"][g] + (x == -np.inf) 
+
+        for name in RUNNING_STATE: 
+            out[name][rows] = cur[name][g] 
+
+    return out 
+
+
+
+# %% 
+def _running_values(acc:Dict[str,Any], specs:List[Tuple]) -> np.ndarray: 
+    '''Aggregates of the metrics from the running aggregates (acc), as the pandas aggregations give them.'''
+
+    n, mean, m2, pinf, ninf = (np.asarray(acc[name], dtype=np.float64) for name in ("n", "mean", "m2", "pinf", "ninf")) 
+    values = np.full(n.shape, np.NaN) 
+
+    # The mean and the sum are infinite with infinite values of one sign, and missing with both. 
+    hasinf = (pinf > 0) | (ninf > 0) 
+    infinite = np.where((pinf > 0) & (ninf > 0), np.NaN, np.where(pinf > 0, np.inf, -np.inf)) 
+
+    for i, (agg, param, *_) in enumerate(specs): 
+        if agg == "mean": 
+            values[:, i] = np.where(hasinf[:, i], infinite[:, i], np.where(n[:, i] > 0, mean[:, i], np.NaN)) 
+        elif agg == "sum": 
+            values[:, i] = np.where(hasinf[:, i], infinite[:, i], mean[:, i] * n[:, i]) 
+        elif agg in ("min", "max"): 
+            values[:, i] = np.asarray(acc[agg], dtype=np.float64)[:, i] 
+        else: 
+            # The variance is missing with any infinite value. 
+            dof = n[:, i] - param.get("ddof", 1) 
+            var = np.divide(m2[:, i], dof, out=np.full(dof.shape, np.NaN), where=(dof > 0) & ~hasinf[:, i]) 
+            values[:, i] = var if agg == "var" else np.sqrt(var) 
+
+    return values 
+
+
+
 # %% 
 def within_sector_diff(
     df:pd.DataFrame, 
@@ -261,3 +706,57 @@ def rank_within_sector_diff(df:pd.DataFrame, groupcols:List[str]) -> pd.DataFram
     df = df.merge(right=df_rank[["ticker", "rank_quantl"]], on="ticker", how="left") 
 
     return df 
+
+
+
+# %% 
+@traced() 
+def rank_within_sector_diff_allyears( 
+    df:pd.DataFrame, 
+    sector_info:pd.DataFrame, 
+    usecols:List[str], 
+    yearcol:str="fiscalDateEnding", 
+    groupcols:List[str]=["gics_sector"], 
+) -> pd.DataFrame: 
+    '''
+    Score and rank the company or ticker by the performance difference within sector
+    for every year at once. Same as (within_sector_diff) then (rank_within_sector_diff)
+    for each year of (yearcol).
+
+    –   The sector info is merged and the dates are parsed once, then the differences
+        and the ranks are computed in one groupby of (year, groupcols).
+    –   Return a row for each ticker and report, with the (ticker), (year), the other
+        categorical columns, the differences and the (rank_quantl), sorted by (year, ticker).
+    '''
+
+    print(f"Ranking the performance difference within sector for all years.") 
+
+    # Merge fundamental data with sector info. 
+    df = df.merge(right=sector_info, on="ticker", how="left", suffixes=(None, "_info")).loc[:, usecols] 
+
+    # Extract numerical and categorical columns. 
+    numcols = df.select_dtypes(include="number").columns.to_list() 
+    catcols = df.columns.difference(numcols).to_list() 
+
+    # Convert to datetime if not it's not, and drop the reports without a date. 
+    dates = df[yearcol] if pd.api.types.is_datetime64_any_dtype(df[yearcol]) else pd.to_datetime(df[yearcol]) 
+    df = df.loc[dates.notna()] 
+    df.insert(0, "year", dates.loc[df.index].dt.year.astype(np.int64)) 
+
+    # Compare the performance difference within sector and year. 
+    keys = [df[c] for c in ["year", *groupcols]] 
+    df_diffval = df[numcols] - df[numcols].groupby(keys).transform("mean") 
+
+    # Rank the differences, then the sum of the ranks, within sector and year. 
+    rank_quantl = df_diffval \
+        .groupby(keys) \
+        .rank(method="average", pct=False, ascending=False) \
+        .sum(axis="columns") \
+        .groupby(keys) \
+        .rank(method="average", pct=True, ascending=False) 
+
+    df_rank = pd.concat([ 
+        df[["ticker", "year", *[c for c in catcols if c != "ticker"]]], df_diffval, rank_quantl.rename("rank_quantl"), 
+    ], axis="columns") 
+
+    return df_rank.sort_values(["year", "ticker"], kind="stable").reset_index(drop=True) 
@@ -0,0 +1,291 @@
+# Python module. 
+import numpy as np 
+import pandas as pd 
+from typing import Iterable, List, Optional, Set 
+
+# Custom modules. 
+from source.modules.manage_files import ManageFiles 
+from source.modules.tracer import traced 
+
+# Custom configs. 
+from source.config_py.config import DIR_DATASET_UTIL, SNP_MEMBERSHIP_FILENAME 
+
+
+
+# %% 
+# File management setup. 
+manage_files = ManageFiles() 
+
+
+
+# %% 
+class IndexMembership(): 
+    def __init__(self, intervals:pd.DataFrame): 
+        '''
+        Membership of the tickers in an index over time, from the intervals (ticker,
+        date_beg, date_end) during which each ticker was a member.
+
+        –   A ticker is a member from (date_beg) until the day before (date_end). A missing
+            (date_beg) is since before the first record, and a missing (date_end) is
+            still a member.
+        –   The overlapping or adjacent intervals of a ticker are merged, so each date
+            falls within at most one interval of a ticker.
+        –   Build it from the dated changes with (from_changes), or load a snapshot
+            with (load).
+        '''
+
+        df = intervals.loc[:, ["ticker", "date_beg", "date_end"]].copy() 
+        df["ticker"] = df["ticker"].astype(str) 
+        df["date_beg"] = pd.to_datetime(df["date_beg"]) 
+        df["date_end"] = pd.to_datetime(df["date_end"]) 
+
+        # Dates as days since the epoch, with the open ends as the extremes. 
+        beg = _to_days(df["date_beg"], fill=_DAY_MIN) 
+        end = _to_days(df["date_end"], fill=_DAY_MAX) 
+
+        self.tickers = np.array(sorted(df["ticker"].unique()), dtype=object) 
+        code = np.searchsorted(self.tickers, df["ticker"].to_numpy(dtype=object)) 
+
+        # Merge the intervals of each ticker that overlap or touch. 
+        order = np.lexsort((beg, code)) 
+        code, beg, end = code[order], beg[order], end[order] 
+        keep = end > beg 
+        code, beg, end = code[keep], beg[keep], end[keep] 
+
+        # An interval starts a new one if it begins after all the previous ones of the ticker end. 
+        same = np.r_[False, code[1:] == code[:-1]] 
+        reach = np.r_[_DAY_MIN, _cummax_bygroup(end, code)[:-1]] 
+        start = ~same | (beg > reach) 
+
+        self.code = code[start] 
+        self.beg = beg[start] 
+        self.end = np.maximum.reduceat(end, np.flatnonzero(start)) if start.any() else end 
+
+        # Lookup key of each interval, sorted by ticker then start date. 
+        self.key = _to_key(self.code, self.beg) 
+
+
+    @classmethod 
+    def from_changes( 
+        cls, 
+        current:Iterable[str], 
+        df_changes:pd.DataFrame, 
+        datecol:str="date", 
+        addcol:str="added", 
+        removecol:str="removed", 
+    ) -> "IndexMembership": 
+        '''
+        Rebuild the intervals from the (current) members and the dated changes, e.g.
+        (get_snp_wikiinfo) and (get_snp_wikichanges).
+
+        –   The changes are replayed back in time from the current members. A ticker
+            added on a date is a member from that date, and a ticker removed on a date
+            is a member until the day before.
+        –   The members before the earliest change are members since before the first
+            record.
+        –   A change that contradicts the later ones, e.g. a ticker added while it was
+            already a member, is skipped and counted.
+        '''
+
+        df = df_changes.loc[:, [datecol, addcol, removecol]].copy() 
+        df[datecol] = pd.to_datetime(df[datecol]) 
+        df = df.dropna(subset=[datecol]).sort_values(datecol, ascending=False, kind="stable") 
+
+        # The open interval of each member, with its end date going back in time. 
+        opened = {str(t): pd.NaT for t in current} 
+        ls_row, skipped = list(), 0 
+
+        for date, df_date in df.groupby(datecol, sort=False): 
+            # Undo the additions of the date before its removals, since a ticker can be 
+            # removed and added back on the same date, e.g. a change of share class. 
+            for added in df_date[addcol].dropna(): 
+                if added in opened: 
+                    ls_row.append((added, date, opened.pop(added))) 
+                else: 
+                    skipped += 1 
+
+            for removed in df_date[removecol].dropna(): 
+                if removed not in opened: 
+                    opened[removed] = date 
+                else: 
+                    skipped += 1 
+
+        ls_row.extend((ticker, pd.NaT, end) for ticker, end in opened.items()) 
+
+        if skipped: 
+            print(f"Skipped ({skipped}) changes that contradict the later ones.") 
+
+        return cls(pd.DataFrame(ls_row, columns=["ticker", "date_beg", "date_end"])) 
+
+
+    @classmethod 
+    def load(cls, dirpath:str=DIR_DATASET_UTIL, filename:str=SNP_MEMBERSHIP_FILENAME) -> "IndexMembership": 
+        '''Load the intervals from a (csv) or (parquet) snapshot.'''
+
+        fileformat = "parquet" if filename.endswith(".parquet") else "csv" 
+
+        return cls(manage_files.pd_read_from(dirpath, filename, format=fileformat)) 
+
+
+    def save(self, dirpath:str=DIR_DATASET_UTIL, filename:str=SNP_MEMBERSHIP_FILENAME): 
+        '''Save the intervals as a (csv) or (parquet) snapshot.'''
+
+        fileformat = "parquet" if filename.endswith(".parquet") else "csv" 
+
+        manage_files.pd_write_to(self.to_frame(), dirpath, filename, format=fileformat) 
+
+
+    def to_frame(self) -> pd.DataFrame: 
+        '''Intervals of each ticker (ticker, date_beg, date_end), sorted by ticker and start.'''
+
+        return pd.DataFrame({ 
+            "ticker": self.tickers[self.code], 
+            "date_beg": _from_days(self.beg, fill=_DAY_MIN), 
+            "date_end": _from_days(self.end, fill=_DAY_MAX), 
+        }) 
+
+
+    def is_member(self, tickers:Iterable[str], dates:Iterable) -> np.ndarray: 
+        '''
+        Whether each ticker was a member on the date of the same position.
+
+        –   Each pair is looked up with a binary search over the intervals, so millions
+            of pairs, e.g. the rows of the feature panel, take a fraction of a second.
+        –   Unknown tickers and missing dates are not members.
+        '''
+
+        dates = np.asarray(pd.to_datetime(np.asarray(dates)), dtype="datetime64[D]") 
+        days = _to_days(dates, fill=_DAY_MIN) 
+
+        # Factorise the tickers first, since most panels repeat a few tickers many times. 
+        inverse, uniques = pd.factorize(np.asarray(tickers, dtype=object)) 
+        uniques = np.asarray(uniques, dtype=object) 
+
+        if not len(self.key) or not len(uniques): 
+            return np.zeros(len(inverse), dtype=bool) 
+
+        pos_unique = np.clip(np.searchsorted(self.tickers, uniques), 0, len(self.tickers) - 1) 
+        known = np.r_[self.tickers[pos_unique] == uniques, False][inverse] 
+        codes = np.r_[pos_unique, 0][inverse] 
+
+        # Latest interval of the ticker that starts on or before the date. 
+        pos = np.searchsorted(self.key, _to_key(codes, days), side="right") - 1 
+        pos_safe = np.clip(pos, 0, None) 
+
+        return ~np.isnat(dates) & known & (pos >= 0) & (self.code[pos_safe] == codes) & (days < self.end[pos_safe]) 
+
+
+    def members(self, date) -> List[str]: 
+        '''Tickers that were members on the date.'''
+
+        day = _to_days([date], fill=_DAY_MIN)[0] 
+        mask = (self.beg <= day) & (day < self.end) 
+
+        return self.tickers[self.code[mask]].tolist() 
+
+
+    def universe(self, date_beg, date_end) -> Set[str]: 
+        '''
+        Tickers that were members at any time between the dates, e.g. the tickers to
+        collect with (compile_features_each_ticker), including those removed since.
+        '''
+
+        day_beg, day_end = _to_days([date_beg, date_end], fill=_DAY_MIN) 
+        mask = (self.beg <= day_end) & (day_beg < self.end) 
+
+        return set(self.tickers[self.code[mask]]) 
+
+
+    def membership_matrix(self, dates:Iterable, tickers:Optional[Iterable[str]]=None) -> pd.DataFrame: 
+        '''
+        Boolean matrix of the membership of the (tickers) on each of the (dates), all
+        the tickers by default, e.g. to mask the signals of a backtest universe.
+
+        –   Each interval marks its first and last date with (searchsorted), then a
+            cumulative sum fills in the dates between, so it takes one pass over the
+            matrix rather than one per interval.
+        '''
+
+        dates = pd.DatetimeIndex(pd.to_datetime(list(dates))).sort_values() 
+        tickers = np.asarray(sorted(set(tickers)) if tickers is not None else self.tickers, dtype=object) 
+
+        days = _to_days(dates, fill=_DAY_MIN) 
+        cols = pd.Index(tickers).get_indexer(self.tickers[self.code]) 
+        keep = cols >= 0 
+
+        marks = np.zeros((len(dates) + 1, len(tickers)), dtype=np.int32) 
+        np.add.at(marks, (np.searchsorted(days, self.beg[keep], side="left"), cols[keep]), 1) 
+        np.add.at(marks, (np.searchsorted(days, self.end[keep], side="left"), cols[keep]), -1) 
+
+        return pd.DataFrame(np.cumsum(marks[:-1], axis=0) > 0, index=dates, columns=tickers) 
+
+
+    def filter_members(self, df:pd.DataFrame, datecol:str="date", tickercol:str="ticker") -> pd.DataFrame: 
+        '''Keep the rows of the tickers that were members on the date of the row.'''
+
+        return df.loc[self.is_member(df[tickercol].to_numpy(), df[datecol].to_numpy())] 
+
+
+
+# %% 
+# Open ends of the intervals, in days since the epoch. The dates fit within 32 bits. 
+_DAY_MIN, _DAY_MAX = -(2 ** 31), 2 ** 31 - 1 
+
+
+
+# %% 
+def _to_days(dates:Iterable, fill:int) -> np.ndarray: 
+    '''Days since the epoch of the dates, with the missing dates as (fill).'''
+
+    dates = np.asarray(pd.to_datetime(np.asarray(dates)), dtype="datetime64[D]") 
+    days = dates.astype(np.int64) 
+
+    return np.where(np.isnat(dates), fill, days) 
+
+
+
+# %% 
+def _from_days(days:np.ndarray, fill:int) -> pd.Series: 
+    '''Dates of the days since the epoch, with (fill) as missing.'''
+
+    dates = pd.to_datetime(np.where(days == fill, 0, days), unit="D") 
+
+    return pd.Series(dates).where(days != fill) 
+
+
+
+# %% 
+def _to_key(codes:np.ndarray, days:np.ndarray) -> np.ndarray: 
+    '''Sort key of (ticker, date) pairs, the ticker code in the high 32 bits and the date in the low.'''
+
+    return (codes.astype(np.int64) << 32) | (days.astype(np.int64) - _DAY_MIN) 
+
+
+
+# %% 
+def _cummax_bygroup(values:np.ndarray, groups:np.ndarray) -> np.ndarray: 
+    '''Running maximum of the values within each group of consecutive rows.'''
+
+    return pd.Series(values).groupby(groups).cummax().to_numpy() 
+
+
+
+# %% 
+@traced() 
+def build_snp_membership( 
+    dirpath:str=DIR_DATASET_UTIL, 
+    filename:str=SNP_MEMBERSHIP_FILENAME, 
+) -> IndexMembership: 
+    '''
+    Build the S&P 500 membership from the current list and the changes on Wikipedia,
+    and save it as a snapshot to load with (IndexMembership.load).
+    '''
+
+    from source.modules.processor_fundamental import get_snp_wikiinfo, get_snp_wikichanges 
+
+    membership = IndexMembership.from_changes(get_snp_wikiinfo()["ticker"], get_snp_wikichanges()) 
+    membership.save(dirpath, filename) 
+
+    print(f"Built the membership of ({len(membership.tickers)}) tickers over ({len(membership.key)}) intervals.") 
+
+    return membership 
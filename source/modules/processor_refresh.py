@@ -0,0 +1,261 @@
+# Python module. 
+import os 
+import numpy as np 
+import pandas as pd 
+from typing import Callable, Iterable, List, Optional, Tuple 
+
+# Custom modules. 
+from source.modules.manage_files import ManageFiles 
+from source.modules.fetch_scheduler import FetchScheduler 
+from source.modules.processor_ticker import get_ticker_yfinance, compute_forward_return, compute_clip_bounds 
+from source.modules.tracer import traced 
+
+# Custom configs. 
+from source.config_py.config import ( 
+    DIR_DATASET_CONSOLIDATED, TICKER_DATE_COLLECT, 
+    REFRESH_STATE_FILENAME, REFRESH_TAIL_MARGIN, REFRESH_ADJUST_RTOL, REFRESH_CHECK_RTOL, 
+) 
+
+
+
+# %% 
+# File management setup. 
+manage_files = ManageFiles() 
+
+
+
+# %% 
+def get_tail_length(params:dict, margin:int=REFRESH_TAIL_MARGIN) -> int: 
+    '''Number of bars the features of a new bar depend on, plus a (margin).'''
+
+    # The tscore of a bar needs (window) returns, each return needs (lag) bars 
+    # before it, and the autocorr features shift the tscore by (autolag) bars. 
+    return params["window"] + max(params["returns_lags"]) + max(params["autocorr_lags"]) + margin 
+
+
+
+# %% 
+def build_refresh_state( 
+    df_bars:pd.DataFrame, 
+    returns_lags:List[str]=[1], 
+    trim_out:float=0.0001, 
+    window:int=252, 
+    autocorr_lags:List[str]=[1,2,3], 
+    dirpath:str=DIR_DATASET_CONSOLIDATED, 
+    filename:str=REFRESH_STATE_FILENAME, 
+) -> dict: 
+    '''
+    Build the state for (refresh_features) from the bars the features were built from.
+
+    –   Keep the last bars of each ticker that the rolling windows and lags need.
+    –   Freeze the clip bounds of each ticker, so that the returns of the new bars
+        are trimmed the same way as the history.
+    –   Pass the same parameters as (compute_forward_return) was called with.
+    '''
+
+    params = dict(returns_lags=returns_lags, trim_out=trim_out, window=window, autocorr_lags=autocorr_lags) 
+
+    df_bars = df_bars.assign(date=pd.to_datetime(df_bars["date"])).sort_values(["ticker", "date"], kind="stable") 
+
+    state = dict( 
+        params=params, 
+        clip_bounds=compute_clip_bounds(df_bars, returns_lags=returns_lags, trim_out=trim_out), 
+        tail=df_bars.groupby("ticker", sort=False).tail(get_tail_length(params)).reset_index(drop=True), 
+    ) 
+
+    manage_files.save_cache_pk(dirpath, filename, state) 
+
+    return state 
+
+
+
+# %% 
+@traced() 
+def refresh_features( 
+    tickers:Iterable[str], 
+    date_end:str, 
+    filepath:str=os.path.join(DIR_DATASET_CONSOLIDATED, "consolidated_feature.parquet"), 
+    feature_steps:List[Callable[[pd.DataFrame],pd.DataFrame]]=list(), 
+    fetch_func:Callable=get_ticker_yfinance, 
+    scheduler:Optional[FetchScheduler]=None, 
+    date_beg:str=TICKER_DATE_COLLECT[0], 
+    statename:str=REFRESH_STATE_FILENAME, 
+    adjust_rtol:float=REFRESH_ADJUST_RTOL, 
+) -> Tuple[pd.DataFrame,List[str]]: 
+    '''
+    Append the features of the bars after the last refresh to the Parquet directory
+    (filepath), written by (ManageFiles.pd_write_dataset).
+
+    –   Only the bars after the tail of each ticker are fetched. The features are
+        computed over the tail and the new bars, and only the new rows are kept.
+    –   (feature_steps) are applied in order after (compute_forward_return), e.g.
+        (get_candlesticks) or (add_eventflag) with a fixed calendar. They must
+        only look back within the tail, as the merges and flags do.
+    –   The rows of each refresh are written as a new part of the directory, so the
+        previous parts are not rewritten.
+    –   Tickers without a tail are fetched from (date_beg).
+    –   Tickers whose refetched bars no longer match the tail were adjusted for a
+        split or dividend. They are skipped and returned to be rebuilt in full.
+    –   Raise (ValueError) if the (feature_steps) do not produce every column of the
+        dataset, e.g. the merged fundamental or sentiment features. The steps of
+        (build_features) in the pipeline are returned by (get_feature_steps).
+    –   Return the appended rows and the skipped tickers.
+    '''
+
+    dirpath = os.path.dirname(filepath) 
+    state = manage_files.load_cache_pk(dirpath, statename) 
+    params, tail = state["params"], state["tail"] 
+
+    # Refetch from the last bar of each ticker to check it against the tail. 
+    last_date = tail.groupby("ticker")["date"].max() 
+
+    def fetch(ticker:str) -> pd.DataFrame: 
+        beg = last_date[ticker].strftime("%Y-%m-%d") if ticker in last_date.index else date_beg 
+        return fetch_func(ticker, date_beg=beg, date_end=date_end) 
+
+    tickers = sorted(set(tickers)) 
+    results = scheduler.map(fetch, tickers) if scheduler else ((t, fetch(t)) for t in tickers) 
+
+    ls_df, stale = list(), list() 
+    for ticker, df in results: 
+        if df.empty: 
+            continue 
+        df = df.assign(date=pd.to_datetime(df["date"])) 
+
+        if ticker in last_date.index: 
+            # The prices are adjusted back in time, so a changed bar invalidates the history. 
+            df_old = tail.loc[tail["ticker"] == ticker, ["date", "close"]] 
+            df_overlap = df_old.merge(df[["date", "close"]], on="date", suffixes=("_old", "_new")) 
+            if not np.allclose(df_overlap["close_old"], df_overlap["close_new"], rtol=adjust_rtol): 
+                stale.append(ticker) 
+                continue 
+
+            df = df.loc[df["date"] > last_date[ticker]] 
+
+        ls_df.append(df) 
+
+    if stale: 
+        print(f"Skipped the adjusted tickers ({', '.join(stale)}). Rebuild them in full.") 
+
+    if not ls_df or not sum(map(len, ls_df)): 
+        print("No new bars to refresh.") 
+        return pd.DataFrame(), stale 
+
+    df_new = pd.concat(ls_df, axis="index", ignore_index=True) 
+    refreshed = set(df_new["ticker"]) 
+
+    # New tickers get their own clip bounds from their full history. 
+    clip_bounds = state["clip_bounds"] 
+    fresh = refreshed.difference(clip_bounds.index) 
+    if fresh: 
+        df_fresh = df_new.loc[df_new["ticker"].isin(fresh)] 
+        clip_bounds = pd.concat([ 
+            clip_bounds, 
+            compute_clip_bounds(df_fresh, returns_lags=params["returns_lags"], trim_out=params["trim_out"]), 
+        ]) 
+
+    # Compute the features over the tail and the new bars, then keep the new rows. 
+    df_calc = pd.concat([tail.loc[tail["ticker"].isin(refreshed)], df_new], axis="index", ignore_index=True) 
+    df_feature = build_features(df_calc, params, clip_bounds, feature_steps) 
+
+    prev = df_feature["ticker"].map(last_date) 
+    keep = prev.isna() | (df_feature["date"] > prev) 
+    df_feature = df_feature.loc[keep].reset_index(drop=True) 
+
+    manage_files.pd_append_dataset(df_feature, filepath) 
+
+    # Roll the tail forward and save the state only once the rows are appended. 
+    ntail = get_tail_length(params) 
+    df_tail = pd.concat([tail, df_new], axis="index", ignore_index=True) \
+        .sort_values(["ticker", "date"], kind="stable") 
+    state["tail"] = df_tail.groupby("ticker", sort=False).tail(ntail).reset_index(drop=True) 
+    state["clip_bounds"] = clip_bounds 
+
+    manage_files.save_cache_pk(dirpath, statename, state) 
+
+    print(f"Refreshed ({len(df_feature):,}) rows for ({len(refreshed)}) tickers.") 
+
+    return df_feature, stale 
+
+
+
+# %% 
+def build_features( 
+    df_bars:pd.DataFrame, 
+    params:dict, 
+    clip_bounds:pd.DataFrame, 
+    feature_steps:List[Callable[[pd.DataFrame],pd.DataFrame]]=list(), 
+) -> pd.DataFrame: 
+    '''Compute the features of the bars with fixed clip bounds, then apply the (feature_steps).'''
+
+    df_feature = compute_forward_return(df_bars.copy(), clip_bounds=clip_bounds, **params) 
+
+    for step in feature_steps: 
+        df_feature = step(df_feature) 
+
+    return df_feature 
+
+
+
+# %% 
+def check_refresh_consistency( 
+    df_bars:pd.DataFrame, 
+    filepath:str=os.path.join(DIR_DATASET_CONSOLIDATED, "consolidated_feature.parquet"), 
+    feature_steps:List[Callable[[pd.DataFrame],pd.DataFrame]]=list(), 
+    date_range:Optional[Tuple[str,str]]=None, 
+    statename:str=REFRESH_STATE_FILENAME, 
+    rtol:float=REFRESH_CHECK_RTOL, 
+) -> pd.DataFrame: 
+    '''
+    Compare the refreshed features with a full rebuild from (df_bars).
+
+    –   (df_bars) is the full history of the bars, e.g. fetched again up to the last refresh.
+    –   Only the rows within (date_range) are compared, e.g. the refreshed dates.
+    –   Return the number of mismatched rows and the max difference of each column.
+        Raise (AssertionError) if any row or value differs.
+    '''
+
+    dirpath, filename = os.path.split(filepath) 
+    state = manage_files.load_cache_pk(dirpath, statename) 
+
+    df_bars = df_bars.assign(date=pd.to_datetime(df_bars["date"])) 
+    df_full = build_features(df_bars, state["params"], state["clip_bounds"], feature_steps) 
+    df_file = manage_files.pd_read_dataset(dirpath, filename, tickers=set(df_bars["ticker"]), date_range=date_range) 
+    df_file["date"] = pd.to_datetime(df_file["date"]) 
+
+    if date_range is not None: 
+        date_beg, date_end = pd.Timestamp(date_range[0]), pd.Timestamp(date_range[1]) 
+        df_full = df_full.loc[df_full["date"].between(date_beg, date_end)] 
+
+    # Align both on the rows of the same ticker and date. 
+    keys = ["ticker", "date"] 
+    df_full = df_full.set_index(keys).sort_index() 
+    df_file = df_file.set_index(keys).sort_index() 
+
+    missing = df_full.index.difference(df_file.index) 
+    extra = df_file.index.difference(df_full.index) 
+    assert not len(missing) and not len(extra), \
+        f"Rows differ from the full rebuild: ({len(missing)}) missing and ({len(extra)}) extra." 
+
+    ls_row = list() 
+    for col in df_full.columns.intersection(df_file.columns): 
+        full, file = df_full[col], df_file.loc[df_full.index, col] 
+
+        if pd.api.types.is_numeric_dtype(full) and pd.api.types.is_numeric_dtype(file): 
+            full, file = full.to_numpy(dtype=float), file.to_numpy(dtype=float) 
+            same = np.isclose(full, file, rtol=rtol, equal_nan=True) 
+            diff = np.nanmax(np.abs(full - file), initial=0) 
+        else: 
+            same = (full == file).to_numpy() | (full.isna() & file.isna()).to_numpy() 
+            diff = np.nan 
+
+        ls_row.append({"column": col, "mismatch": int((~same).sum()), "max_diff": diff}) 
+
+    df_report = pd.DataFrame(ls_row) 
+
+    print(f"Compared ({len(df_full):,}) rows and ({len(df_report)}) columns with the full rebuild.") 
+
+    over = df_report.loc[df_report["mismatch"] > 0, "column"].to_list() 
+    assert not over, f"Columns differ from the full rebuild ({', '.join(over)})." 
+
+    return df_report 
@@ -1,10 +1,15 @@
 # Python module. 
-import os, re, talib 
+import os, re, functools 
+import numpy as np 
 import pandas as pd 
-from alpha_vantage.techindicators import TechIndicators 
 from typing import Tuple, List, Dict 
 
 
+# Custom modules. 
+from source.modules.fetch_scheduler import alphav_scheduler 
+from source.modules.response_cache import response_cache 
+from source.modules.tracer import traced 
+
 # Custom configs. 
 from source.config_py.config import (
     TICKER_DATE_COLLECT, TECHNIND_FEATURES, CANDLESTICK_FEATURES
@@ -13,12 +18,19 @@ from source.config_py.config import (
 
 
 # %%
-# Load Alpha Vantage object. 
-datasource = TechIndicators(os.environ["ALPHA_VANTAGE_API_SECRET"], output_format="pandas") 
+@functools.lru_cache(maxsize=None) 
+def get_datasource(): 
+    '''Load Alpha Vantage object.'''
+
+    # Build on first use, so that importing the module needs neither the package nor the API key. 
+    from alpha_vantage.techindicators import TechIndicators 
+    return TechIndicators(os.environ["ALPHA_VANTAGE_API_SECRET"], output_format="pandas") 
 
 
 
 # %%
+@traced() 
+@response_cache.cached("alphavantage") 
 def get_techind_alphav(
     ticker:str, 
     features:Dict[str,Dict]=TECHNIND_FEATURES, 
@@ -37,15 +49,11 @@ def get_techind_alphav(
 
     df_techind_compiled = pd.DataFrame(index=pd.date_range(daterange[0], daterange[1], freq="D")) 
 
-    # Get the technical indicator. 
-    dict_techind = dict() 
-    for f, p in features.items(): 
-        func = re.sub(r"_t\d+$", "", f) 
-        dict_techind[f] = f'''datasource.get_{func}("{ticker}", **{p})[0]''' 
-
-    # Concat the technical indicators. 
-    for techname, tech_ind in dict_techind.items(): 
-        df_tech_ind = eval(tech_ind) 
+    # Concat the technical indicators. Each call draws from the shared Alpha Vantage budget. 
+    for techname, p in features.items(): 
+        func = re.sub(r"_t\d+$", "", techname) 
+        func = getattr(get_datasource(), f"get_{func}") 
+        df_tech_ind = alphav_scheduler.call("techind", func, ticker, **p)[0] 
         df_tech_ind.columns = [f"{techname}_{c}" for c in df_tech_ind.columns] 
         df_techind_compiled = df_techind_compiled.merge(
             right=df_tech_ind, how="outer", left_index=True, right_index=True 
@@ -69,9 +77,99 @@ def get_techind_alphav(
 
 
 # %% 
+# Map the Alpha Vantage indicator names onto TA-Lib functions. The output names follow 
+# the Alpha Vantage columns so that (compute_techind_talib) matches (get_techind_alphav). 
+TALIB_INDICATORS = { 
+    "macd": ("MACD", ["MACD", "MACD_Signal", "MACD_Hist"]), 
+    "ema": ("EMA", ["EMA"]), 
+    "sma": ("SMA", ["SMA"]), 
+    "wma": ("WMA", ["WMA"]), 
+    "dema": ("DEMA", ["DEMA"]), 
+    "tema": ("TEMA", ["TEMA"]), 
+    "rsi": ("RSI", ["RSI"]), 
+    "mom": ("MOM", ["MOM"]), 
+    "willr": ("WILLR", ["WILLR"]), 
+    "cci": ("CCI", ["CCI"]), 
+    "adx": ("ADX", ["ADX"]), 
+    "atr": ("ATR", ["ATR"]), 
+    "obv": ("OBV", ["OBV"]), 
+    "stoch": ("STOCH", ["SlowK", "SlowD"]), 
+    "aroon": ("AROON", ["Aroon Down", "Aroon Up"]), 
+    "bbands": ("BBANDS", ["Real Upper Band", "Real Middle Band", "Real Lower Band"]), 
+} 
+
+# Alpha Vantage parameters that are named differently or not needed by TA-Lib. 
+TALIB_PARAM_RENAME = {"time_period": "timeperiod", "series_type": "price"} 
+TALIB_PARAM_IGNORE = {"interval"} 
+
+
+
+# %% 
+@traced() 
+def compute_techind_talib( 
+    df:pd.DataFrame, 
+    features:Dict[str,Dict]=TECHNIND_FEATURES, 
+    datecol:str="date", 
+) -> pd.DataFrame: 
+    '''
+    Compute the technical indicators locally from the OHLCV data of (get_ticker_yfinance). 
+
+    –   Reads the same (TECHNIND_FEATURES) spec as (get_techind_alphav) and returns the 
+        same columns (ticker, date, <name>_<col>), without any API call. 
+    –   All tickers are computed in one pass over the panel sorted by ticker and date. 
+    '''
+
+    from talib import abstract 
+
+    print(f"Compute technical indicators with (TA-Lib) for ({df['ticker'].nunique()}) tickers.") 
+
+    # Translate the Alpha Vantage spec into TA-Lib functions and parameters. 
+    dict_talib = dict() 
+    for techname, p in features.items(): 
+        funcname, outcols = TALIB_INDICATORS[re.sub(r"_t\d+$", "", techname)] 
+        params = {TALIB_PARAM_RENAME.get(k, k): v for k, v in p.items() if k not in TALIB_PARAM_IGNORE} 
+        dict_talib[techname] = (abstract.Function(funcname), params, outcols) 
+
+    # Sort once so that each ticker is a contiguous block. 
+    df_data = df.sort_values(by=["ticker", datecol], kind="stable").reset_index(drop=True) 
+    inputs = {c: df_data[c].to_numpy(dtype=np.float64) for c in ["open", "high", "low", "close", "volume"]} 
+
+    # Find the boundary of each ticker block. 
+    tickers = df_data["ticker"].to_numpy() 
+    bounds = np.flatnonzero(tickers[1:] != tickers[:-1]) + 1 
+    bounds = zip(np.r_[0, bounds], np.r_[bounds, len(tickers)]) 
+
+    # Compute the indicators for each block into preallocated arrays. 
+    dict_output = { 
+        f"{techname}_{c}": np.full(len(df_data), np.nan) 
+        for techname, (_, _, outcols) in dict_talib.items() for c in outcols 
+    } 
+    for beg, end in bounds: 
+        block = {k: v[beg:end] for k, v in inputs.items()} 
+        for techname, (func, params, outcols) in dict_talib.items(): 
+            output = func(block, **params) 
+            output = output if isinstance(output, list) else [output] 
+            for c, values in zip(outcols, output): 
+                dict_output[f"{techname}_{c}"][beg:end] = values 
+
+    df_techind = pd.DataFrame(dict_output) 
+    df_techind.insert(0, datecol, df_data[datecol]) 
+    df_techind.insert(0, "ticker", df_data["ticker"]) 
+
+    # Drop the rows without any indicator (warm-up period) like Alpha Vantage. 
+    df_techind = df_techind.dropna(axis="index", how="all", subset=list(dict_output.keys())) 
+
+    return df_techind.reset_index(drop=True) 
+
+
+
+# %% 
+@traced() 
 def get_candlesticks(df:pd.DataFrame, features:List[str]=CANDLESTICK_FEATURES) -> pd.DataFrame: 
 	'''Get candlesticks data.''' 
 
+	import talib 
+
 	for feature in features: 
 		open, high, low, close = df["open"], df["high"], df["low"], df["close"] 
 		df[f"candle_{feature.lower()}"] = eval(f'''talib.{feature}(open, high, low, close)''') 
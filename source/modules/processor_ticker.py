@@ -1,12 +1,32 @@
 # Python module. 
 import numpy as np 
 import pandas as pd 
-import yfinance as yf
-from typing import Tuple, List 
+from typing import Tuple, List, Optional 
+
+# Custom modules. 
+from source.modules.response_cache import response_cache 
+from source.modules.tracer import traced 
+
+
+
+# %% 
+# Return categories. 
+# 	– c2c == close to close 
+# 	– o2c == open to close (price change during market opening). 
+# 	– c2o == close to open (gapping during market closing). 
+RETURN_CATS = { 
+    "return_c2c": lambda x, lag: x["close"].pct_change(periods=lag), 
+
+    # # Comment out this. Not applicable beyond 1-day forward. 
+    # "return_o2c": lambda x, lag: np.log(x["close"]) - np.log(x["open"]), 
+    # "return_c2o": lambda x, lag: np.log(x["open"].shift(-1)) - np.log(x["close"]), 
+} 
 
 
 
 # %%
+@traced() 
+@response_cache.cached("yfinance") 
 def get_ticker_yfinance(ticker:str, date_beg:str, date_end:str) -> pd.DataFrame: 
     '''
     Get ticker data from Yahoo Finance. 
@@ -14,6 +34,9 @@ def get_ticker_yfinance(ticker:str, date_beg:str, date_end:str) -> pd.DataFrame:
 
     print(f"Getting ticker data from (Yahoo Finance) for ({ticker}).") 
 
+    # Import on use, since (yfinance) is only needed to fetch the data. 
+    import yfinance as yf 
+
     # Get the ticker history data. 
     df_ticker = yf \
         .Ticker(ticker) \
@@ -31,13 +54,16 @@ def get_ticker_yfinance(ticker:str, date_beg:str, date_end:str) -> pd.DataFrame:
 
 
 # %% 
+@traced() 
 def compute_forward_return(
     df:pd.DataFrame, 
     returns_lags:List[str]=[1,5,10,21,126,252], 
     trim_out:float=0.0001, 
     window:int=252, 
     autocorr_lags:List[str]=[1,2,3], 
-    volt_range:Tuple[int]=(.25, 1.0) 
+    volt_range:Tuple[int]=(.25, 1.0), 
+    as_float32:bool=False, 
+    clip_bounds:Optional[pd.DataFrame]=None, 
 ) -> pd.DataFrame: 
     '''
     Compute the forward price return (logret), volatility class (volt), mean reversion (tscore). 
@@ -49,9 +75,17 @@ def compute_forward_return(
         - 21  == 1-month forward. 
         - 126 == 6-month forward. 
         - 252 == 12-month forward. 
+
+    All tickers are computed together in grouped passes instead of one ticker at a time. 
+    Rows are returned grouped by ticker (in order of appearance) with their original index. 
+    Set (as_float32) to (True) to halve the memory of the computed columns. 
+
+    The outliers are trimmed with the quantiles of each ticker over the given rows, unless 
+    (clip_bounds) from (compute_clip_bounds) is passed. Fixed bounds give the same returns 
+    whether the history is computed at once or a few rows at a time. 
     ''' 
 
-    df_return = pd.DataFrame() 
+    print(f"Compute forward return for ({df['ticker'].nunique()}) tickers.") 
 
     # Rolling window and min period. 
     window_avg, window_std = window, window 
@@ -60,67 +94,98 @@ def compute_forward_return(
     # Market movement / volatility scale. 
     volt_lo, volt_hi = volt_range 
 
-    # Return categories. 
-    # 	– c2c == close to close 
-    # 	– o2c == open to close (price change during market opening). 
-    # 	– c2o == close to open (gapping during market closing). 
-    return_cats = {
-        "return_c2c": lambda x: np.log(x["close"]) - np.log(x["close"].shift(lag)), 
-
-        # # Comment out this. Not applicable beyond 1-day forward. 
-        # "return_o2c": lambda x: np.log(x["close"]) - np.log(x["open"]), 
-        # "return_c2o": lambda x: np.log(x["open"].shift(-1)) - np.log(x["close"]), 
-    } 
-
-    # Create labels for each ticker symbol. 
-    for ticker in df["ticker"].unique(): 
-        print(f"Compute forward return for ({ticker}).") 
-
-        # Make a copy of the filtered dataframe. 
-        df_data = df[df["ticker"] == ticker].copy() 
-
-        for keyname in return_cats.keys(): 
-            
-            for lag in returns_lags: 
-                return_cat = keyname.split("_")[-1] 
-
-                retname = f"{keyname}_lag{lag}" 
-                tscname = f"tscore_{return_cat}_lag{lag}" 
-                vltname = f"volt_{return_cat}_lag{lag}" 
-
-                # Compute the ticker price return. 
-                df_data[retname] = df_data.loc[:, "close"] \
-                    .pct_change(periods=lag) \
-                    .pipe(lambda x: x.clip(lower=x.quantile(trim_out), upper=x.quantile(1 - trim_out))) \
-                    .add(1) \
-                    .pow(1 / lag) \
-                    .sub(1) 
-
-                # Compute the tscore for price change. 
-                ret_ravg = df_data.loc[:, retname] \
-                    .rolling(window=window_avg, min_periods=period_avg, win_type=None) \
-                    .mean() 
-                ret_rstd = df_data.loc[:, retname] \
-                    .rolling(window=window_std, min_periods=period_std, win_type=None) \
-                    .std(ddof=1) 
-
-                df_data[tscname] = (df_data[retname] - ret_ravg) / ret_rstd 
-                
-                # # NOTICE: Considering... Might not needed. 
-                # # Define the volatility or price movement scale or class. 
-                # df_data[vltname] = 1 
-                # df_data.loc[df[tscname].abs() >= volt_hi, vltname] = 2 
-                # df_data.loc[df[tscname].abs() <= volt_lo, vltname] = 0 
-
-                # Create autocorrsselated features for the past N days. 
-                for autolag in autocorr_lags: 
-                    df_data[f"{retname}_autolag{autolag}"] = df_data.groupby(["ticker"])[retname].shift(autolag) 
-                    df_data[f"{tscname}_autolag{autolag}"] = df_data.groupby(["ticker"])[tscname].shift(autolag) 
-
-                    # # NOTICE: Considering... Might not needed. 
-                    # df_data[f"{vltname}_autolag{autolag}"] = df_data.groupby(["ticker"])[vltname].shift(autolag) 
-
-        # Concat the result
-        df_return = pd.concat([df_return, df_data], axis="index") 
+    # Group the rows of each ticker together (stable sort) so that every 
+    # grouped operation below returns its result in the same row order. 
+    codes, _ = pd.factorize(df["ticker"]) 
+    order = np.argsort(codes, kind="stable") 
+    df_data = df.iloc[order].copy() 
+    codes = pd.Series(codes[order], index=df_data.index) 
+
+    # Computed columns are collected here and attached in a single concat. 
+    dict_feature = dict() 
+
+    for keyname, return_func in RETURN_CATS.items(): 
+
+        for lag in returns_lags: 
+            return_cat = keyname.split("_")[-1] 
+
+            retname = f"{keyname}_lag{lag}" 
+            tscname = f"tscore_{return_cat}_lag{lag}" 
+            vltname = f"volt_{return_cat}_lag{lag}" 
+
+            # Compute the ticker price return. 
+            ret = return_func(df_data.groupby(codes, sort=False), lag) 
+
+            # Trim the outliers with the quantile of each ticker. 
+            if clip_bounds is None: 
+                ret_grp = ret.groupby(codes, sort=False) 
+                ret_lo = ret_grp.transform("quantile", trim_out) 
+                ret_hi = ret_grp.transform("quantile", 1 - trim_out) 
+            else: 
+                ret_lo = df_data["ticker"].map(clip_bounds[f"{retname}_lo"]).fillna(-np.inf) 
+                ret_hi = df_data["ticker"].map(clip_bounds[f"{retname}_hi"]).fillna(np.inf) 
+            ret = ret.clip(lower=ret_lo, upper=ret_hi) \
+                .add(1) \
+                .pow(1 / lag) \
+                .sub(1) 
+
+            # Compute the tscore for price change. 
+            ret_grp = ret.groupby(codes, sort=False) 
+            ret_ravg = ret_grp \
+                .rolling(window=window_avg, min_periods=period_avg, win_type=None) \
+                .mean() \
+                .to_numpy() 
+            ret_rstd = ret_grp \
+                .rolling(window=window_std, min_periods=period_std, win_type=None) \
+                .std(ddof=1) \
+                .to_numpy() 
+
+            tsc = (ret - ret_ravg) / ret_rstd 
+
+            dict_feature[retname] = ret 
+            dict_feature[tscname] = tsc 
+
+            # # NOTICE: Considering... Might not needed. 
+            # # Define the volatility or price movement scale or class. 
+            # dict_feature[vltname] = ... 
+
+            # Create autocorrsselated features for the past N days. 
+            for autolag in autocorr_lags: 
+                dict_feature[f"{retname}_autolag{autolag}"] = ret.groupby(codes, sort=False).shift(autolag) 
+                dict_feature[f"{tscname}_autolag{autolag}"] = tsc.groupby(codes, sort=False).shift(autolag) 
+
+    # Attach all the computed columns at once. 
+    df_feature = pd.DataFrame(dict_feature, index=df_data.index) 
+    if as_float32: 
+        df_feature = df_feature.astype(np.float32) 
+
+    df_return = pd.concat([df_data.drop(columns=df_feature.columns, errors="ignore"), df_feature], axis="columns") 
 
     return df_return 
+
+
+
+# %% 
+def compute_clip_bounds( 
+    df:pd.DataFrame, 
+    returns_lags:List[str]=[1,5,10,21,126,252], 
+    trim_out:float=0.0001, 
+) -> pd.DataFrame: 
+    '''
+    Compute the quantiles that (compute_forward_return) trims the returns with. 
+
+    Return one row per ticker with the columns ({retname}_lo, {retname}_hi). 
+    '''
+
+    grp = df.groupby("ticker", sort=False) 
+
+    dict_bound = dict() 
+    for keyname, return_func in RETURN_CATS.items(): 
+        for lag in returns_lags: 
+            retname = f"{keyname}_lag{lag}" 
+
+            ret_grp = return_func(grp, lag).groupby(df["ticker"], sort=False) 
+            dict_bound[f"{retname}_lo"] = ret_grp.quantile(trim_out) 
+            dict_bound[f"{retname}_hi"] = ret_grp.quantile(1 - trim_out) 
+
+    return pd.DataFrame(dict_bound) 
@@ -1,23 +1,63 @@
 # Python module. 
-import wrds 
+import os, json, shutil, hashlib, threading 
+import numpy as np 
 import pandas as pd 
+from typing import Any, Dict, Iterable, List, Optional, Tuple 
+
+# Custom modules. 
+from source.modules.manage_files import ManageFiles 
+from source.modules.response_cache import response_cache 
+from source.modules.tracer import traced 
+
+# Custom configs. 
+from source.config_py.config import ( 
+    DIR_DATASET_WRDS_RAVENPACK, DIR_DATASET_WRDS_COMPUSTAT, DIR_DATASET_FUNDAMENTAL, 
+    WRDS_BATCH_SIZE, WRDS_CHUNK_SIZE, WRDS_RP_COLUMNS, COMPUSTAT_FILTERS, COMPUSTAT_TO_ALPHAV, 
+) 
+
+
+
+# %%
+# The connection is opened on first use, then reused by all the queries. 
+_conn = None 
+_conn_lock = threading.Lock() 
+
+
+
+# %%
+def get_connection(): 
+    '''Get the WRDS connection. Open it on first use rather than on import.'''
+
+    global _conn 
+
+    with _conn_lock: 
+        if _conn is None: 
+            import wrds 
+            _conn = wrds.Connection() 
+
+    return _conn 
 
 
 
 # %%
-# Initiate connection to WRDS. 
-conn = wrds.Connection() 
+def get_engine(engine:Optional[Any]=None): 
+    '''Get the (SQLAlchemy) engine. Its connection pool is shared by all the bulk queries.'''
+
+    # Any engine with the same schema (e.g. a local SQLite or Postgres) can stand in for WRDS. 
+    return engine if engine is not None else get_connection().engine 
 
 
 
 # %%
+@traced() 
+@response_cache.cached("wrds") 
 def get_rp_sentiment(ticker:str, year:int) -> pd.DataFrame: 
     '''Get sentiment data from WRDS RavenPack.'''
 
     print(f"Getting sentiment data from (WRDS RavenPack) for ({ticker}, {year}).") 
 
     # Query the WRDS database. 
-    df = conn.raw_sql(
+    df = get_connection().raw_sql( 
         f'''
         SELECT *
         FROM rpna.dj_equities_{year} 
@@ -34,13 +74,15 @@ def get_rp_sentiment(ticker:str, year:int) -> pd.DataFrame:
 
 
 # %%
+@traced() 
+@response_cache.cached("wrds") 
 def get_compustat_fundamental(ticker:str, year_beg:int) -> pd.DataFrame: 
     '''Get sentiment data from WRDS RavenPack.'''
 
     print(f"Getting fundamental data from (WRDS Compustat) for ({ticker}, {year_beg} and above).") 
 
     # Query the WRDS database. 
-    df = conn.raw_sql(
+    df = get_connection().raw_sql( 
         f'''
         SELECT *
         FROM comp.funda
@@ -54,3 +96,422 @@ def get_compustat_fundamental(ticker:str, year_beg:int) -> pd.DataFrame:
     df.rename(columns={"tic": "ticker"}, inplace=True) 
 
     return df 
+
+
+
+# %%
+@traced() 
+def extract_rp_sentiment_bulk( 
+    tickers:Iterable[str], 
+    yearrange:Tuple[int,int], 
+    columns:List[str]=WRDS_RP_COLUMNS, 
+    dirpath:str=os.path.join(DIR_DATASET_WRDS_RAVENPACK, "dj_equities"), 
+    batch_size:int=WRDS_BATCH_SIZE, 
+    chunksize:int=WRDS_CHUNK_SIZE, 
+    engine:Optional[Any]=None, 
+    load_cache:bool=True, 
+) -> str: 
+    '''
+    Extract the RavenPack sentiment of all tickers into (dirpath/year=YYYY/).
+
+    –   Each year is queried in batches of (batch_size) tickers with an (IN) list,
+        and only the projected (columns) are sent over the network.
+    –   The rows are streamed from a server-side cursor in chunks of (chunksize)
+        and written as Parquet row groups, so the year never sits in memory at once.
+    –   Completed years are skipped when (load_cache) is True, unless they were
+        extracted for other tickers or columns.
+    '''
+
+    # The company code of (RavenPack) is the ticker prefixed with the country. 
+    companies = [f"US/{t}" for t in sorted(set(tickers))] 
+    columns = list(dict.fromkeys(["company", *columns])) 
+
+    for year in range(yearrange[0], yearrange[1] + 1): 
+        query = f'''
+            SELECT {_quote_columns(columns)}
+            FROM rpna.dj_equities_{year}
+            WHERE company IN :keys
+            ORDER BY company, timestamp_utc
+        '''
+
+        _extract_bulk( 
+            query, table=f"rpna.dj_equities_{year}", columns=columns, 
+            keys=companies, params=dict(), dirpath=dirpath, partition=f"year={year}", 
+            batch_size=batch_size, chunksize=chunksize, engine=engine, load_cache=load_cache, 
+            date_cols=["rpna_date_utc", "timestamp_utc"], 
+            transform=lambda df: df.assign(ticker=df["company"].str[3:]), 
+        ) 
+
+    return dirpath 
+
+
+
+# %%
+@traced() 
+def extract_compustat_bulk( 
+    tickers:Iterable[str], 
+    yearrange:Tuple[int,int], 
+    columns:Optional[List[str]]=None, 
+    table:str="comp.funda", 
+    filters:Dict[str,Any]=dict(), 
+    dirpath:Optional[str]=None, 
+    batch_size:int=WRDS_BATCH_SIZE, 
+    chunksize:int=WRDS_CHUNK_SIZE, 
+    engine:Optional[Any]=None, 
+    load_cache:bool=True, 
+) -> str: 
+    '''
+    Extract the Compustat fundamental of all tickers into (dirpath/year=YYYY/).
+
+    –   Same batching and streaming as (extract_rp_sentiment_bulk).
+    –   All columns are extracted if (columns) is None.
+    –   Only the rows whose columns equal the (filters) values are extracted, e.g.
+        (COMPUSTAT_FILTERS).
+    '''
+
+    dirpath = dirpath or os.path.join(DIR_DATASET_WRDS_COMPUSTAT, table.split(".")[-1]) 
+    tickers = sorted(set(tickers)) 
+    columns = list(dict.fromkeys(["tic", "datadate", *columns])) if columns else None 
+    select = _quote_columns(columns) if columns else "*" 
+    where = "".join(f'AND "{c}" = :filter_{c} ' for c in filters) 
+
+    for year in range(yearrange[0], yearrange[1] + 1): 
+        query = f'''
+            SELECT {select}
+            FROM {table}
+            WHERE tic IN :keys
+            AND datadate >= :date_beg AND datadate <= :date_end
+            {where}
+            ORDER BY tic, datadate
+        '''
+
+        params = dict(date_beg=f"{year}-01-01", date_end=f"{year}-12-31", **{f"filter_{c}": v for c, v in filters.items()}) 
+        _extract_bulk( 
+            query, table=table, columns=columns, keys=tickers, params=params, 
+            dirpath=dirpath, partition=f"year={year}", 
+            batch_size=batch_size, chunksize=chunksize, engine=engine, load_cache=load_cache, 
+            date_cols=["datadate"], 
+            transform=lambda df: df.rename(columns={"tic": "ticker"}), 
+        ) 
+
+    return dirpath 
+
+
+
+# %% 
+@traced() 
+def load_compustat_fundamental( 
+    tickers:Iterable[str], 
+    yearrange:Tuple[int,int], 
+    annual:bool=True, 
+    mapping:Dict[str,Dict[str,Any]]=COMPUSTAT_TO_ALPHAV, 
+    filters:Dict[str,Any]=COMPUSTAT_FILTERS, 
+    dirpath:str=DIR_DATASET_FUNDAMENTAL, 
+    rawpath:Optional[str]=None, 
+    engine:Optional[Any]=None, 
+    load_cache:bool=True, 
+) -> pd.DataFrame: 
+    '''
+    Load the financial statements of all tickers from Compustat, in the schema of
+    (get_fundamental_alphav), into (dirpath/financial_statement_{period}/year=YYYY/).
+
+    –   Only the mapped items are extracted with (extract_compustat_bulk), a few batched
+        queries per year instead of a request per ticker.
+    –   The items are mapped with (mapping), see (COMPUSTAT_TO_ALPHAV).
+    –   The year before (yearrange) is extracted as well for the quarterly statements,
+        so that the year-to-date items of the first quarters can be converted.
+    –   The raw items are extracted into (rawpath), by default the directory of the
+        table in (DIR_DATASET_WRDS_COMPUSTAT).
+    –   Completed years are not extracted again when (load_cache) is True, unless
+        they were extracted for other tickers, items or filters.
+    '''
+
+    period = "annual" if annual else "quarter" 
+    spec = mapping[period] 
+    fiscalcols = ["fyear"] if annual else ["fyearq", "fqtr"] 
+    year_beg = yearrange[0] if annual else yearrange[0] - 1 
+
+    # Extract the items of all the tickers, then map all the years at once, since a 
+    # fiscal year can span two calendar years. 
+    rawpath = extract_compustat_bulk( 
+        tickers, (year_beg, yearrange[1]), columns=list(dict.fromkeys([*fiscalcols, *_get_item_names(spec["items"], spec["ytd"])])), 
+        table=spec["table"], filters=filters, dirpath=rawpath, engine=engine, load_cache=load_cache, 
+    ) 
+
+    manage_files = ManageFiles() 
+    df_raw = manage_files.pd_read_dataset(rawpath, tickers=set(tickers), date_range=(f"{year_beg}-01-01", f"{yearrange[1]}-12-31"), datecol="datadate") 
+    df = map_compustat_fundamental(df_raw, spec["items"], ytd=spec["ytd"]) 
+    df = df.loc[pd.to_datetime(df["fiscalDateEnding"]).dt.year.between(*yearrange)] 
+
+    # Write each year as its own partition. 
+    outpath = os.path.join(dirpath, f"financial_statement_{period}") 
+    years = df["fiscalDateEnding"].str[:4] 
+    for year in range(yearrange[0], yearrange[1] + 1): 
+        manage_files.pd_write_partition(df.loc[years == str(year)], outpath, "year", str(year)) 
+
+    print(f"Loaded ({len(df):,}) ({period}) statements of ({df['ticker'].nunique()}) tickers from (Compustat).") 
+
+    return df.reset_index(drop=True) 
+
+
+
+# %% 
+def map_compustat_fundamental( 
+    df:pd.DataFrame, 
+    items:Dict[str,Any], 
+    ytd:List[str]=list(), 
+    scale:float=1e6, 
+) -> pd.DataFrame: 
+    '''
+    Map the Compustat items onto the statements of (get_fundamental_alphav).
+
+    –   Each item is a Compustat item or a combination ({"add": [...], "sub": [...]}).
+        A combination is missing if any of its items is.
+    –   The items are multiplied by (scale), from millions to units.
+    –   The (ytd) items are converted to the amount of each quarter by the difference
+        with the previous quarter of the same fiscal year (fyearq, fqtr). They are
+        missing if the previous quarter is.
+    –   A ticker with two rows of the same date keeps the last one.
+    –   The items are coerced to numbers, e.g. when extracted as strings, and those
+        that cannot be parsed are missing.
+    –   Raise (KeyError) if any of the items is not in (df).
+    '''
+
+    names = _get_item_names(items, ytd) 
+    missing = [i for i in [*names, *(["fyearq", "fqtr"] if ytd else [])] if i not in df.columns] 
+    if missing: 
+        raise KeyError(f"Items ({missing}) are missing from the Compustat extract.") 
+
+    df = df \
+        .drop_duplicates(subset=["ticker", "datadate"], keep="last") \
+        .sort_values(["ticker", "datadate"], kind="stable") \
+        .reset_index(drop=True) 
+
+    values = {col: pd.to_numeric(df[col], errors="coerce").to_numpy(dtype=np.float64) for col in names} 
+
+    if ytd: 
+        # The previous row is the previous quarter only if it is of the same ticker and fiscal year. 
+        fqtr = pd.to_numeric(df["fqtr"], errors="coerce") 
+        prev = fqtr.groupby([df["ticker"], df["fyearq"]], sort=False).shift() 
+        first = (fqtr == 1).to_numpy() 
+        consecutive = (fqtr - prev == 1).to_numpy() 
+
+        for col in ytd: 
+            cumul = values[col] 
+            values[col] = np.where(first, cumul, np.where(consecutive, cumul - np.roll(cumul, 1), np.nan)) 
+
+    df_mapped = pd.DataFrame({ 
+        "ticker": df["ticker"].astype(str).to_numpy(), 
+        "fiscalDateEnding": pd.to_datetime(df["datadate"]).dt.strftime("%Y-%m-%d").to_numpy(), 
+    }) 
+
+    for name, item in items.items(): 
+        if isinstance(item, str): 
+            value = values[item] 
+        else: 
+            value = sum(values[i] for i in item.get("add", [])) - sum(values[i] for i in item.get("sub", [])) 
+        df_mapped[name] = value * scale 
+
+    return df_mapped 
+
+
+
+# %% 
+def _get_item_names(items:Dict[str,Any], ytd:List[str]=list()) -> List[str]: 
+    '''Get the Compustat items named in (items), including those of the combinations, and (ytd).'''
+
+    names = [i for item in items.values() for i in ([item] if isinstance(item, str) else [*item.get("add", []), *item.get("sub", [])])] 
+
+    return list(dict.fromkeys([*names, *ytd])) 
+
+
+
+# %% 
+# Key of the inputs each partition was extracted with. The leading underscore hides 
+# it from the Parquet readers. 
+_EXTRACT_KEY_FILENAME = "_extract_key.json" 
+
+
+
+# %%
+def _extract_bulk( 
+    query:str, 
+    table:str, 
+    columns:Optional[List[str]], 
+    keys:List[str], 
+    params:dict, 
+    dirpath:str, 
+    partition:str, 
+    batch_size:int, 
+    chunksize:int, 
+    engine:Optional[Any], 
+    load_cache:bool, 
+    date_cols:List[str], 
+    transform, 
+): 
+    '''
+    Stream the batched query results into the Parquet files of one partition.
+
+    –   The Parquet schema is taken once from the column types of the (table), so
+        every batch file and row group is written with the same schema, even when a
+        chunk holds only nulls in a column.
+    –   The partition records the hash of the (query), (keys) and (params) it was
+        extracted with. With (load_cache), it is skipped only if they are unchanged.
+    '''
+
+    import pyarrow as pa 
+    import pyarrow.parquet as pq 
+    from sqlalchemy import text, bindparam 
+
+    manage_files = ManageFiles() 
+    manage_files._get_ready_for_file_operation(dirpath) 
+
+    # Hash the inputs of the extraction, so a partition of other tickers or columns is extracted again. 
+    payload = json.dumps({"query": query, "keys": sorted(keys), "params": params}, sort_keys=True, default=str) 
+    key = hashlib.sha256(payload.encode("utf-8")).hexdigest() 
+
+    partpath = os.path.join(dirpath, partition) 
+    keypath = os.path.join(partpath, _EXTRACT_KEY_FILENAME) 
+    if load_cache and os.path.isfile(keypath): 
+        with open(keypath, "r") as f: 
+            if json.load(f)["key"] == key: 
+                print(f"Skipped the completed partition ({partition}).") 
+                return 
+
+    # Write into a temporary directory, then rename, so that an interrupted 
+    # extraction never leaves a partial partition that looks completed. 
+    tmppath = f"{partpath}.tmp" 
+    shutil.rmtree(tmppath, ignore_errors=True) 
+    os.makedirs(tmppath) 
+
+    # Expand the (IN) list into bound parameters instead of formatting it into the query. 
+    statement = text(query).bindparams(bindparam("keys", expanding=True)) 
+    engine = get_engine(engine) 
+    nrows = 0 
+
+    # Declared dtypes of the projected columns, and the schema of their transformed frame. 
+    dtypes = _get_column_dtypes(engine, table, columns, date_cols) 
+    df_empty = pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in dtypes.items()}) 
+    schema = pa.Schema.from_pandas(_normalise_dtypes(transform(df_empty), dtypes), preserve_index=False) 
+
+    for b, i in enumerate(range(0, len(keys), batch_size)): 
+        batch = keys[i:i + batch_size] 
+        print(f"Extracting ({partition}) batch ({b + 1}) with ({len(batch)}) keys.") 
+
+        writer = None 
+        with engine.connect() as conn: 
+            # Stream the rows from a server-side cursor where the database supports it. 
+            conn = conn.execution_options(stream_results=True) 
+            chunks = pd.read_sql_query( 
+                statement, conn, params=dict(params, keys=batch), 
+                chunksize=chunksize, parse_dates=date_cols, 
+            ) 
+
+            for df in chunks: 
+                df = _normalise_dtypes(transform(df), dtypes) 
+
+                # Each chunk becomes a row group of the batch file. 
+                if writer is None: 
+                    writer = pq.ParquetWriter(os.path.join(tmppath, f"part-{b:05d}.parquet"), schema) 
+                writer.write_table(pa.Table.from_pandas(df.loc[:, schema.names], schema=schema, preserve_index=False)) 
+                nrows += len(df) 
+
+        if writer is not None: 
+            writer.close() 
+
+    # Record the key last, since the partition only counts as completed with it. 
+    with open(os.path.join(tmppath, _EXTRACT_KEY_FILENAME), "w") as f: 
+        json.dump({"key": key, "rows": nrows}, f) 
+
+    shutil.rmtree(partpath, ignore_errors=True) 
+    os.replace(tmppath, partpath) 
+
+    print(f"Extracted ({nrows:,}) rows into ({partpath}).") 
+
+
+
+# %%
+def _quote_columns(columns:List[str]) -> str: 
+    '''Quote the column names, since some are reserved words (e.g. group, type).'''
+
+    return ", ".join(f'"{c}"' for c in columns) 
+
+
+
+# %%
+def _get_column_dtypes( 
+    engine:Any, 
+    table:str, 
+    columns:Optional[List[str]], 
+    date_cols:List[str], 
+) -> Dict[str,str]: 
+    '''
+    Get the dtypes of the (columns) from the declared column types of the (table),
+    all its columns if (columns) is None.
+
+    –   Numeric and boolean types are float64, so that a null never changes the type.
+    –   Date and time types, and the (date_cols), are datetime64[ns].
+    –   Other types, and those without a Python type, are string.
+    '''
+
+    import datetime, decimal 
+    from sqlalchemy import inspect 
+
+    schema, name = table.split(".", 1) if "." in table else (None, table) 
+    dict_dtype = dict() 
+
+    for col in inspect(engine).get_columns(name, schema=schema): 
+        try: 
+            python_type = col["type"].python_type 
+        except NotImplementedError: 
+            python_type = str 
+
+        if issubclass(python_type, (int, float, decimal.Decimal)): 
+            dict_dtype[col["name"]] = "float64" 
+        elif issubclass(python_type, (datetime.date, datetime.datetime)): 
+            dict_dtype[col["name"]] = "datetime64[ns]" 
+        else: 
+            dict_dtype[col["name"]] = "string" 
+
+    for col in date_cols: 
+        if col in dict_dtype: 
+            dict_dtype[col] = "datetime64[ns]" 
+
+    if columns is None: 
+        return dict_dtype 
+
+    missing = [col for col in columns if col not in dict_dtype] 
+    if missing: 
+        raise KeyError(f"Columns ({missing}) are not in the table ({table}).") 
+
+    return {col: dict_dtype[col] for col in columns} 
+
+
+
+# %% 
+def _normalise_dtypes(df:pd.DataFrame, dtypes:Dict[str,str]=dict()) -> pd.DataFrame: 
+    '''
+    Fix the dtypes so that every chunk writes the same Parquet schema.
+
+    –   The columns in (dtypes) are cast to their declared dtype, so a column that
+        holds only nulls in a chunk keeps its numeric or date type.
+    –   The other columns, e.g. those added by a transform, are inferred.
+    '''
+
+    for col in df.columns: 
+        dtype = dtypes.get(col) 
+
+        if dtype == "float64": 
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype("float64") 
+        elif dtype == "datetime64[ns]": 
+            df[col] = pd.to_datetime(df[col], errors="coerce").astype("datetime64[ns]") 
+        elif dtype == "string": 
+            df[col] = df[col].astype("string") 
+        # A chunk can hold only nulls or only integers in a column that other chunks 
+        # fill with strings or floats, so the inferred dtypes would differ between chunks. 
+        elif pd.api.types.is_object_dtype(df[col]): 
+            df[col] = df[col].astype("string") 
+        elif pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_float_dtype(df[col]): 
+            df[col] = df[col].astype("float64") 
+
+    return df 
@@ -0,0 +1,197 @@
+# Python module. 
+import os, time, json, gzip, pickle, hashlib, inspect, functools, threading 
+from typing import Any, Callable, Dict, Optional, Tuple 
+
+# Custom modules. 
+from source.modules.manage_files import ManageFiles 
+
+# Custom configs. 
+from source.config_py.config import ( 
+    DIR_DATASET_CACHE, CACHE_ENABLED, CACHE_TTL, CACHE_MAX_BYTES, 
+) 
+
+
+
+# %% 
+class ResponseCache(): 
+    def __init__( 
+        self, 
+        dirpath:str=DIR_DATASET_CACHE, 
+        ttl:Dict[str,int]=CACHE_TTL, 
+        max_bytes:int=CACHE_MAX_BYTES, 
+        enabled:bool=CACHE_ENABLED, 
+    ): 
+        '''
+        Disk-backed cache for the responses from remote data sources.
+
+        –   Each response is keyed on the hash of (source, endpoint, normalised parameters)
+            and stored as a compressed pickle under (dirpath/source/).
+        –   Responses older than the TTL of their source are fetched again.
+        –   The least recently used responses are evicted once the cache exceeds (max_bytes).
+        '''
+
+        self.dirpath = dirpath 
+        self.ttl = ttl 
+        self.max_bytes = max_bytes 
+        self.enabled = enabled 
+
+        self.manage_files = ManageFiles() 
+        self.lock = threading.Lock() 
+        self.size = None 
+
+
+    def make_key(self, source:str, endpoint:str, params:Dict[str,Any]) -> str: 
+        '''Hash the source, endpoint and normalised parameters.'''
+
+        normalised = json.dumps([source, endpoint, _normalise(params)], sort_keys=True, default=str) 
+        return hashlib.sha256(normalised.encode("utf-8")).hexdigest() 
+
+
+    def get(self, source:str, endpoint:str, params:Dict[str,Any]) -> Tuple[bool,Any]: 
+        '''Get the cached response. Return (False, None) if it is missing or expired.'''
+
+        self.manage_files._confirm_current_working_directory() 
+        filepath = self._get_filepath(source, self.make_key(source, endpoint, params)) 
+
+        try: 
+            stat = os.stat(filepath) 
+        except FileNotFoundError: 
+            return False, None 
+
+        # The modified time tracks when the response was cached. 
+        if time.time() - stat.st_mtime > self.ttl.get(source, 0): 
+            return False, None 
+
+        with gzip.open(filepath, "rb") as f: 
+            value = pickle.load(f) 
+
+        # The access time tracks when the response was last used for eviction. 
+        os.utime(filepath, times=(time.time(), stat.st_mtime)) 
+
+        return True, value 
+
+
+    def put(self, source:str, endpoint:str, params:Dict[str,Any], value:Any): 
+        '''Cache the response, then evict the least recently used ones if needed.'''
+
+        filepath = self._get_filepath(source, self.make_key(source, endpoint, params)) 
+        self.manage_files._get_ready_for_file_operation(os.path.dirname(filepath)) 
+
+        # Write to a temporary file, then rename, so that readers never see a partial file. 
+        tmppath = f"{filepath}.{threading.get_ident()}.tmp" 
+        with gzip.open(tmppath, "wb", compresslevel=5) as f: 
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL) 
+        os.replace(tmppath, filepath) 
+
+        with self.lock: 
+            self.size = self._scan_size() if self.size is None else self.size + os.path.getsize(filepath) 
+            if self.size > self.max_bytes: 
+                self.evict() 
+
+
+    def evict(self, max_bytes:Optional[int]=None): 
+        '''Remove the least recently used responses until the cache fits in (max_bytes).'''
+
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes 
+
+        # Sort by the access time, oldest first. 
+        entries = sorted(self._scan_entries(), key=lambda e: e[1]) 
+        self.size = sum(e[2] for e in entries) 
+
+        for filepath, _, size in entries: 
+            if self.size <= max_bytes: 
+                break 
+            os.remove(filepath) 
+            self.size -= size 
+
+        print(f"Evicted the response cache down to ({self.size / 1024 ** 2:,.1f} MB).") 
+
+
+    def clear(self, source:Optional[str]=None): 
+        '''Remove all the cached responses, or only those of the (source).'''
+
+        prefix = os.path.join(self.dirpath, source) if source else self.dirpath 
+        with self.lock: 
+            for filepath, _, _ in self._scan_entries(): 
+                if filepath.startswith(prefix): 
+                    os.remove(filepath) 
+            self.size = None 
+
+
+    def cached(self, source:str, endpoint:Optional[str]=None) -> Callable: 
+        '''Decorator to serve the function calls from the cache.'''
+
+        def decorator(func:Callable) -> Callable: 
+            signature = inspect.signature(func) 
+            name = endpoint or func.__name__ 
+
+            @functools.wraps(func) 
+            def wrapper(*args, **kwargs): 
+                if not self.enabled: 
+                    return func(*args, **kwargs) 
+
+                # Include the default arguments so that changing them changes the key. 
+                bound = signature.bind(*args, **kwargs) 
+                bound.apply_defaults() 
+                params = dict(bound.arguments) 
+
+                found, value = self.get(source, name, params) 
+                if found: 
+                    print(f"Loaded cached response from ({source}) for ({name}).") 
+                    return value 
+
+                value = func(*args, **kwargs) 
+                self.put(source, name, params, value) 
+                return value 
+
+            return wrapper 
+
+        return decorator 
+
+
+    def _get_filepath(self, source:str, key:str) -> str: 
+        '''Get the file path of the key. Shard by the key prefix to keep directories small.'''
+
+        return os.path.join(self.dirpath, source, key[:2], f"{key}.pickle.gz") 
+
+
+    def _scan_entries(self): 
+        '''List the (filepath, access time, size) of all cached responses.'''
+
+        self.manage_files._get_ready_for_file_operation(self.dirpath) 
+
+        entries = list() 
+        for root, _, filenames in os.walk(self.dirpath): 
+            for filename in filenames: 
+                if filename.endswith(".pickle.gz"): 
+                    stat = os.stat(os.path.join(root, filename)) 
+                    entries.append((os.path.join(root, filename), stat.st_atime, stat.st_size)) 
+
+        return entries 
+
+
+    def _scan_size(self) -> int: 
+        '''Get the total size of the cache.'''
+
+        return sum(e[2] for e in self._scan_entries()) 
+
+
+
+# %% 
+def _normalise(value:Any) -> Any: 
+    '''Normalise the parameters so that equivalent calls share the same key.'''
+
+    if isinstance(value, dict): 
+        return {str(k): _normalise(v) for k, v in value.items()} 
+    if isinstance(value, (set, frozenset)): 
+        return sorted((_normalise(v) for v in value), key=str) 
+    if isinstance(value, (list, tuple)): 
+        return [_normalise(v) for v in value] 
+
+    return value 
+
+
+
+# %% 
+# Shared by all the (processor_*) fetch functions. 
+response_cache = ResponseCache() 
@@ -0,0 +1,356 @@
+# Python module. 
+import os, sys, json, time, inspect, resource, itertools, functools, threading, contextlib 
+from datetime import datetime 
+from typing import Any, Callable, Dict, List, Optional 
+
+# Custom configs. 
+from source.config_py.config import TRACE_ENABLED, TRACE_DIR 
+
+
+
+# %% 
+class Span(): 
+    def __init__(self, name:str, id:int, parent:Optional[int], attrs:Dict[str,Any]): 
+        '''A timed section of the run. Attach its row and byte counts with (set) or (add).'''
+
+        self.name = name 
+        self.id = id 
+        self.parent = parent 
+        self.attrs = dict(attrs) 
+
+
+    def set(self, **attrs): 
+        '''Set the attributes.'''
+
+        self.attrs.update(attrs) 
+
+
+    def add(self, **counts): 
+        '''Add to the counts, e.g. the rows of each chunk.'''
+
+        for key, value in counts.items(): 
+            self.attrs[key] = self.attrs.get(key, 0) + value 
+
+
+
+# %% 
+class Tracer(): 
+    def __init__(self, enabled:bool=TRACE_ENABLED, dirpath:str=TRACE_DIR): 
+        '''
+        Record the spans of the run to a JSONL file, one line per finished span.
+
+        –   Each span records its wall time, the CPU time of the process and of its
+            thread, and the peak RSS of the process at its end, with how much the
+            span raised it.
+        –   The spans nest within each thread. The parent is the enclosing span.
+        –   Nothing is recorded unless enabled, and the spans then cost a flag check.
+        –   See (export_chrome_trace) and (summarize_trace) to read the file.
+        '''
+
+        self.dirpath = dirpath 
+        self.filepath = None 
+        self.file = None 
+        self.enabled = False 
+
+        self.lock = threading.Lock() 
+        self.local = threading.local() 
+        self.ids = itertools.count(1) 
+
+        if enabled: 
+            self.enable() 
+
+
+    def enable(self, filepath:Optional[str]=None) -> str: 
+        '''Start recording to (filepath), by default a new file in (dirpath). Return the file path.'''
+
+        if filepath is None: 
+            filename = f"trace_{datetime.now():%Y%m%d_%H%M%S}_{os.getpid()}.jsonl" 
+            filepath = os.path.join(self.dirpath, filename) 
+
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True) 
+
+        with self.lock: 
+            if self.file is not None: 
+                self.file.close() 
+            # Line buffered, so each span is written as it finishes. 
+            self.file = open(filepath, "a", buffering=1) 
+            self.filepath = filepath 
+            self.enabled = True 
+
+        print(f"Trace the spans to ({filepath}).") 
+
+        return filepath 
+
+
+    def disable(self): 
+        '''Stop recording and close the file.'''
+
+        with self.lock: 
+            self.enabled = False 
+            if self.file is not None: 
+                self.file.close() 
+                self.file = None 
+
+
+    @contextlib.contextmanager 
+    def span(self, name:str, **attrs): 
+        '''Record the block as a span. Yield the (Span) to attach counts to.'''
+
+        if not self.enabled: 
+            yield Span(name, 0, None, attrs) 
+            return 
+
+        stack = self._get_stack() 
+        span = Span(name, next(self.ids), stack[-1].id if stack else None, attrs) 
+        stack.append(span) 
+
+        peak_beg = _get_peak_rss() 
+        ts, wall, cpu, cpu_thread = time.time(), time.perf_counter(), time.process_time(), time.thread_time() 
+        error = None 
+        try: 
+            yield span 
+        except BaseException as e: 
+            error = type(e).__name__ 
+            raise 
+        finally: 
+            wall, cpu, cpu_thread = time.perf_counter() - wall, time.process_time() - cpu, time.thread_time() - cpu_thread 
+            peak_end = _get_peak_rss() 
+            stack.pop() 
+
+            record = { 
+                "name": span.name, "id": span.id, "parent": span.parent, 
+                "pid": os.getpid(), "tid": threading.get_ident(), "thread": threading.current_thread().name, 
+                "ts": ts, "wall": wall, "cpu": cpu, "cpu_thread": cpu_thread, 
+                "peak_rss": peak_end, "peak_rss_delta": peak_end - peak_beg, 
+                **span.attrs, 
+            } 
+            if error is not None: 
+                record["error"] = error 
+
+            self._write(record) 
+
+
+    def _get_stack(self) -> List[Span]: 
+        '''Open spans of the current thread.'''
+
+        if not hasattr(self.local, "stack"): 
+            self.local.stack = list() 
+
+        return self.local.stack 
+
+
+    def _write(self, record:Dict[str,Any]): 
+        '''Append the span to the file.'''
+
+        line = json.dumps(record, default=str) + "\n" 
+        with self.lock: 
+            if self.file is not None: 
+                self.file.write(line) 
+
+
+
+# %% 
+# Tracer of the process. Enable it with (tracer.enable()) or (TRACE_ENABLED). 
+tracer = Tracer() 
+
+
+
+# %% 
+def traced( 
+    name:Optional[str]=None, 
+    rows:bool=True, 
+    io:Optional[str]=None, 
+    path:Optional[Callable[[Dict[str,Any]],str]]=None, 
+) -> Callable: 
+    '''
+    Decorate a function to run in a span of (tracer).
+
+    –   The span is named (module.function) unless (name) is given.
+    –   (rows) records the rows of the table arguments (rows_in) and of the
+        returned table, or the first table of a returned tuple (rows_out).
+    –   (io) is (read) or (write), to record the size of the files at the path
+        argument before (bytes_read) or after the call (bytes_written). The path
+        is (filepath), or (dirpath) joined with (filename), unless (path) gets it
+        from the bound arguments.
+    '''
+
+    def decorator(func:Callable) -> Callable: 
+        spanname = name or f"{func.__module__.rsplit('.', 1)[-1]}.{func.__qualname__}" 
+        signature = inspect.signature(func) if io else None 
+
+        @functools.wraps(func) 
+        def wrapper(*args, **kwargs): 
+            if not tracer.enabled: 
+                return func(*args, **kwargs) 
+
+            with tracer.span(spanname) as span: 
+                if rows: 
+                    nrows = [_get_rows(arg) for arg in (*args, *kwargs.values())] 
+                    if any(n is not None for n in nrows): 
+                        span.set(rows_in=sum(n for n in nrows if n is not None)) 
+
+                if io: 
+                    bound = signature.bind(*args, **kwargs) 
+                    bound.apply_defaults() 
+                    filepath = path(bound.arguments) if path else _get_path(bound.arguments) 
+                    if io == "read": 
+                        span.set(bytes_read=_get_size(filepath)) 
+
+                result = func(*args, **kwargs) 
+
+                if rows: 
+                    nrows = _get_rows(result[0] if isinstance(result, tuple) and result else result) 
+                    if nrows is not None: 
+                        span.set(rows_out=nrows) 
+
+                if io == "write": 
+                    span.set(bytes_written=_get_size(filepath)) 
+
+                return result 
+
+        return wrapper 
+
+    return decorator 
+
+
+
+# %% 
+def _get_rows(obj:Any) -> Optional[int]: 
+    '''Number of rows of a table or array, or None for other objects.'''
+
+    shape = getattr(obj, "shape", None) 
+    if isinstance(shape, tuple) and shape and not inspect.isclass(obj): 
+        return int(shape[0]) 
+
+    return None 
+
+
+
+# %% 
+def _get_path(arguments:Dict[str,Any]) -> Optional[str]: 
+    '''Path argument of a file operation.'''
+
+    if arguments.get("filepath"): 
+        return arguments["filepath"] 
+    if arguments.get("dirpath"): 
+        return os.path.join(arguments["dirpath"], arguments["filename"]) if arguments.get("filename") else arguments["dirpath"] 
+
+    return None 
+
+
+
+# %% 
+def _get_size(path:Optional[str]) -> int: 
+    '''Total bytes of the file, or of the files under the directory.'''
+
+    if not path or not os.path.exists(path): 
+        return 0 
+    if os.path.isfile(path): 
+        return os.path.getsize(path) 
+
+    return sum( 
+        os.path.getsize(os.path.join(root, filename)) 
+        for root, _, filenames in os.walk(path) for filename in filenames 
+    ) 
+
+
+
+# %% 
+def _get_peak_rss() -> int: 
+    '''Peak resident memory of the process in bytes.'''
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss 
+
+    # Reported in bytes on macOS and in kilobytes on Linux. 
+    return peak if sys.platform == "darwin" else peak * 1024 
+
+
+
+# %% 
+def read_trace(filepath:str) -> List[Dict[str,Any]]: 
+    '''Read the spans of a trace file.'''
+
+    with open(filepath, "r") as f: 
+        return [json.loads(line) for line in f if line.strip()] 
+
+
+
+# %% 
+def export_chrome_trace(filepath:str, outpath:Optional[str]=None) -> str: 
+    '''
+    Convert a trace file to the Chrome trace format and return its path.
+
+    –   Open it in (chrome://tracing) or (https://ui.perfetto.dev) to see the spans
+        of each thread on a timeline.
+    –   Written next to (filepath) as (.trace.json) unless (outpath) is given.
+    '''
+
+    outpath = outpath or f"{os.path.splitext(filepath)[0]}.trace.json" 
+    timing = {"name", "id", "parent", "pid", "tid", "thread", "ts", "wall"} 
+
+    events = [ 
+        { 
+            "name": record["name"], "cat": record["name"].split(".", 1)[0], "ph": "X", 
+            "ts": record["ts"] * 1e6, "dur": record["wall"] * 1e6, 
+            "pid": record["pid"], "tid": record["tid"], 
+            "args": {k: v for k, v in record.items() if k not in timing}, 
+        } 
+        for record in read_trace(filepath) 
+    ] 
+
+    with open(outpath, "w") as f: 
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f) 
+
+    print(f"Exported ({len(events):,}) spans to ({outpath}).") 
+
+    return outpath 
+
+
+
+# %% 
+def summarize_trace(filepath:str): 
+    '''
+    Total the spans of each name, sorted by the wall time.
+
+    –   The wall time of a span includes its nested spans, so the totals of
+        nested names overlap.
+    '''
+
+    import pandas as pd 
+
+    df = pd.DataFrame(read_trace(filepath)) 
+    for col in ("rows_in", "rows_out", "bytes_read", "bytes_written"): 
+        df[col] = df[col].fillna(0).astype("int64") if col in df.columns else 0 
+
+    df_summary = df.groupby("name").agg( 
+        calls=("id", "count"), 
+        wall=("wall", "sum"), 
+        wall_max=("wall", "max"), 
+        cpu_thread=("cpu_thread", "sum"), 
+        peak_rss=("peak_rss", "max"), 
+        peak_rss_delta=("peak_rss_delta", "max"), 
+        rows_in=("rows_in", "sum"), 
+        rows_out=("rows_out", "sum"), 
+        bytes_read=("bytes_read", "sum"), 
+        bytes_written=("bytes_written", "sum"), 
+    ) 
+
+    return df_summary.sort_values("wall", ascending=False).reset_index(drop=False) 
+
+
+
+# %% 
+if __name__ == "__main__": 
+    import pandas as pd 
+
+    # Export and summarise the given trace file, or the latest one. 
+    if sys.argv[1:]: 
+        filepath = sys.argv[1] 
+    else: 
+        filenames = sorted(f for f in os.listdir(TRACE_DIR) if f.endswith(".jsonl")) 
+        filepath = os.path.join(TRACE_DIR, filenames[-1]) 
+
+    export_chrome_trace(filepath) 
+
+    with pd.option_context("display.max_rows", 100, "display.width", 200): 
+        print(summarize_trace(filepath)) 
@@ -3,9 +3,6 @@
 import numpy as np 
 import pandas as pd 
 import altair as alt 
-import umap.plot 
-from matplotlib import pyplot as plt 
-from scipy.cluster.hierarchy import dendrogram 
 
 
 
@@ -13,6 +10,9 @@ from scipy.cluster.hierarchy import dendrogram
 def plot_umap(mapper, headline_id:np.array, latent_feature:np.array): 
 	height, width = 400, 500 
 
+	# Import on use, since (umap) takes seconds to import. 
+	import umap.plot 
+
 	# Get the topic label. 
 	latent_topic = np.argmax(latent_feature, axis=1) 
 	hover_topics = pd.DataFrame(data={"headline_id": headline_id, "topic": latent_topic}) 